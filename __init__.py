@@ -30,12 +30,20 @@ bl_info = {
     "tracker_url": "https://github.com/theli-ua/K2-Blender/issues",
     "support": "COMMUNITY",}
 
-if "bpy" not in locals():
-    print("init first load")
+try:
     import bpy
+except ImportError:
+    # plain Python (k2_cli.py), only the bpy-free modules can be used
+    bpy = None
+
+if bpy is None:
+    pass
+elif "k2_import" not in locals():
+    print("init first load")
     from . import k2_import
     from . import k2_export
-    from .operators import K2_OT_clip_importer, K2_OT_mesh_importer, K2_OT_clip_exporter, K2_OT_mesh_exporter
+    from .operators import K2_OT_clip_importer, K2_OT_mesh_importer, K2_OT_clip_exporter, K2_OT_mesh_exporter, \
+        K2_OT_indexed_clip_importer, K2_AddonPreferences
     # import register, unregister
 else:
     print("init reload")
@@ -50,6 +58,22 @@ else:
     from . import export_k2_clip
     from . import operators
     from . import mat_utils
+    from . import k2_log
+    from . import k2_skeleton
+    from . import clip_bake
+    from . import k2_reader
+    from . import k2_gltf
+    from . import k2_writer
+    from . import chunk_cache
+    from . import k2_index
+    from . import modal_import
+    from . import surf_hull
+    from . import two_sided
+    from . import chunk_writer
+    from . import mesh_split
+    from . import skin_weights
+    from . import vertex_cache
+    from . import parse_hon_file
     # from .operators import K2ImporterClip, K2Importer, K2ClipExporter, K2MeshExporter
 
     importlib.reload(k2_import)
@@ -60,6 +84,22 @@ else:
     importlib.reload(create_mesh_data)
     importlib.reload(export_k2_mesh)
     importlib.reload(export_k2_clip)
+    importlib.reload(k2_log)
+    importlib.reload(k2_skeleton)
+    importlib.reload(clip_bake)
+    importlib.reload(k2_reader)
+    importlib.reload(k2_gltf)
+    importlib.reload(k2_writer)
+    importlib.reload(chunk_cache)
+    importlib.reload(k2_index)
+    importlib.reload(modal_import)
+    importlib.reload(surf_hull)
+    importlib.reload(two_sided)
+    importlib.reload(chunk_writer)
+    importlib.reload(mesh_split)
+    importlib.reload(skin_weights)
+    importlib.reload(vertex_cache)
+    importlib.reload(parse_hon_file)
     importlib.reload(operators)
     importlib.reload(mat_utils)
     # importlib.reload(K2ImporterClip)
@@ -71,6 +111,7 @@ else:
 def menu_import(self, context):
     self.layout.operator(K2_OT_mesh_importer.bl_idname, text="K2 mesh (.model)")
     self.layout.operator(K2_OT_clip_importer.bl_idname, text="K2 clip (.clip)")
+    self.layout.operator(K2_OT_indexed_clip_importer.bl_idname, text="K2 clips from index")
 
 
 def menu_export(self, context):
@@ -79,7 +120,9 @@ def menu_export(self, context):
 
 
 def register():
+    bpy.utils.register_class(K2_AddonPreferences)
     bpy.utils.register_class(K2_OT_clip_importer)
+    bpy.utils.register_class(K2_OT_indexed_clip_importer)
     bpy.utils.register_class(K2_OT_mesh_importer)
     bpy.utils.register_class(K2_OT_clip_exporter)
     bpy.utils.register_class(K2_OT_mesh_exporter)
@@ -99,9 +142,11 @@ def unregister():
     # bpy.types.INFO_MT_file_import.remove(menu_import)
     # bpy.types.INFO_MT_file_export.remove(menu_export)
     bpy.utils.unregister_class(K2_OT_clip_importer)
+    bpy.utils.unregister_class(K2_OT_indexed_clip_importer)
     bpy.utils.unregister_class(K2_OT_mesh_importer)
     bpy.utils.unregister_class(K2_OT_clip_exporter)
     bpy.utils.unregister_class(K2_OT_mesh_exporter)
+    bpy.utils.unregister_class(K2_AddonPreferences)
 
 
 if __name__ == "__main__":
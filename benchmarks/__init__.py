@@ -0,0 +1,5 @@
+# Reproducible speed measurements of the K2 decoders, importers and exporters.
+#
+# generate.py writes deterministic synthetic .model/.clip files, run.py times
+# the bpy-free decoders in plain Python and the importers/exporters inside
+# headless Blender, writing the results as JSON.
@@ -0,0 +1,113 @@
+# Deterministic synthetic K2 files of configurable size. The same arguments
+# and seed always give byte identical files.
+
+import numpy as np
+
+from ..k2_reader import K2Model, K2Mesh, MKEY_Z, MKEY_PITCH, MKEY_YAW, MKEY_VISIBILITY, MKEY_SCALE_X, MKEY_COUNT
+from ..k2_writer import write_model, write_clip
+from ..skin_weights import SkinWeights
+from ..surf_hull import hull_surf
+
+# corners and outward wound triangles of the unit cube
+BOX_CORNERS = np.array([[x, y, z] for x in (0.0, 1.0) for y in (0.0, 1.0) for z in (0.0, 1.0)])
+BOX_TRIS = np.array([[0, 1, 3], [0, 3, 2], [4, 6, 7], [4, 7, 5], [0, 4, 5], [0, 5, 1],
+                     [2, 3, 7], [2, 7, 6], [0, 2, 6], [0, 6, 4], [1, 5, 7], [1, 7, 3]])
+
+
+class SyntheticSkeleton:
+    # names, parents and rest matrices like K2Skeleton
+    def __init__(self, num_bones, rng):
+        self.names = ['bone_%03d' % i for i in range(num_bones)]
+        # random tree, parents always come first
+        self.parents = np.array([-1] + [rng.randint(0, i) for i in range(1, num_bones)], dtype=np.int32)[:num_bones]
+        self.rest = np.tile(np.eye(4), (num_bones, 1, 1))
+        self.rest[:, :3, 3] = rng.uniform(-1.0, 1.0, (num_bones, 3))
+
+    def __len__(self):
+        return len(self.names)
+
+
+def grid_mesh(num_verts, rng):
+    cols = max(int(np.ceil(np.sqrt(num_verts))), 2)
+    rows = max(int(np.ceil(num_verts / cols)), 2)
+    y, x = np.mgrid[0:rows, 0:cols]
+    positions = np.stack([x.ravel() / cols, y.ravel() / rows, rng.uniform(0.0, 0.05, rows * cols)], axis=1)
+    quads = (y[:-1, :-1] * cols + x[:-1, :-1]).ravel()
+    faces = np.concatenate([np.stack([quads, quads + 1, quads + cols], axis=1),
+                            np.stack([quads + 1, quads + cols + 1, quads + cols], axis=1)])
+    return positions.astype(np.float32), faces
+
+
+def random_skin(num_verts, num_bones, influences, rng):
+    influences = max(min(influences, num_bones), 1)
+    bones = np.argsort(rng.rand(num_verts, num_bones), axis=1)[:, :influences].astype(np.uint32)
+    weights = rng.uniform(0.05, 1.0, (num_verts, influences)).astype(np.float32)
+    weights /= weights.sum(axis=1, keepdims=True)
+    offsets = np.arange(num_verts + 1, dtype=np.int64) * influences
+    return SkinWeights(offsets, bones.ravel(), weights.ravel())
+
+
+def box_surf(index, rng):
+    # randomly sized and placed box hull
+    points = BOX_CORNERS * rng.uniform(0.2, 1.0, 3) + rng.uniform(-1.0, 1.0, 3)
+    return hull_surf(points, BOX_TRIS, index)
+
+
+def generate_model(filename, num_verts=10000, num_bones=32, influences=4, num_meshes=1, seed=0, num_surfs=0):
+    """Writes a skinned .model of num_meshes grid meshes and num_surfs box
+    collision hulls.
+
+    :return: dict with the actual vertex and triangle counts
+    """
+    rng = np.random.RandomState(seed)
+    skeleton = SyntheticSkeleton(num_bones, rng)
+    model = K2Model(3, num_meshes, 0, 0, num_bones, None)
+    model.bone_names = skeleton.names
+    model.bone_parents = skeleton.parents
+    model.matrices = skeleton.rest
+    for index in range(num_meshes):
+        positions, faces = grid_mesh(max(num_verts // num_meshes, 4), rng)
+        positions[:, 2] += index
+        mesh = K2Mesh(index, 'mesh_%d' % index, 'material')
+        mesh.positions = positions
+        mesh.faces = faces
+        mesh.skin = random_skin(len(positions), num_bones, influences, rng)
+        mesh.texc = positions[:, :2]
+        mesh.tang = np.tile(np.array([1.0, 0.0, 0.0], dtype='<f4'), (len(positions), 1))
+        mesh.sign = np.zeros(len(positions), dtype=np.int8)
+        mesh.normals = np.tile(np.array([0.0, 0.0, 1.0], dtype='<f4'), (len(positions), 1))
+        model.meshes.append(mesh)
+    model.surfs = [box_surf(index, rng) for index in range(num_surfs)]
+    write_model(filename, model)
+    return {'vertices': sum(len(m.positions) for m in model.meshes),
+            'triangles': sum(len(m.faces) for m in model.meshes),
+            'bones': num_bones, 'influences': influences, 'meshes': num_meshes, 'surfs': num_surfs}
+
+
+def generate_clip(filename, num_bones=32, num_frames=100, constant_ratio=0.3, seed=0):
+    """Writes a .clip animating the bones of generate_model with the same seed.
+
+    About constant_ratio of the channels are written as a single key.
+    """
+    rng = np.random.RandomState(seed)
+    skeleton = SyntheticSkeleton(num_bones, rng)
+    t = np.arange(num_frames) / max(num_frames - 1, 1) * 2.0 * np.pi
+    motions = np.empty((num_bones, MKEY_COUNT, num_frames), dtype=np.float32)
+    for index in range(num_bones):
+        for key_type in range(MKEY_COUNT):
+            if key_type == MKEY_VISIBILITY:
+                motions[index, key_type] = 255
+                continue
+            if key_type <= MKEY_Z:
+                base = skeleton.rest[index, key_type, 3]
+            elif key_type >= MKEY_SCALE_X:
+                base = 1.0
+            else:
+                base = 0.0
+            if rng.rand() < constant_ratio:
+                motions[index, key_type] = base
+            else:
+                amplitude = 30.0 if MKEY_PITCH <= key_type <= MKEY_YAW else 0.1
+                motions[index, key_type] = base + amplitude * np.sin(t + rng.uniform(0.0, np.pi))
+    write_clip(filename, skeleton.names, motions)
+    return {'bones': num_bones, 'frames': num_frames}
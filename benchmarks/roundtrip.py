@@ -0,0 +1,315 @@
+"""Round-trip fidelity and performance check, runs inside Blender.
+
+Every case is imported, exported again and both files are decoded with
+k2_reader and compared within tolerances (positions, UVs, skin weights,
+bone rest poses, collision hull planes, per frame bone transforms). Time
+and tracemalloc peak memory are recorded per stage, tracemalloc only sees
+allocations made through Python (including NumPy), not Blender's own.
+
+    blender -b --factory-startup --python benchmarks/roundtrip.py -- --json roundtrip.json
+    blender -b --factory-startup --python benchmarks/roundtrip.py -- --model a.model --clip a.clip
+"""
+
+import argparse
+import importlib
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import numpy as np
+
+TOLERANCES = {
+    'position': 1e-4,
+    'uv': 1e-4,
+    'weight': 2e-3,
+    'bone': 1e-3,
+    'translation': 1e-3,
+    'rotation': 1e-3,  # rotation matrix elements
+    'scale': 1e-3,
+    'surf': 1e-4,  # hull plane coefficients
+}
+
+
+class StageProfiler:
+    """Wall time and tracemalloc peak of named stages."""
+
+    def __init__(self):
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name):
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1] - before
+            self.stages[name] = {'seconds': seconds, 'peak_bytes': max(peak, 0)}
+
+
+def model_corners(model):
+    """Per triangle corner positions, UVs and skin weights of all meshes.
+
+    Weights are dense over the bone names sorted alphabetically, so files with
+    a different bone order compare equal.
+    """
+    names = sorted(model.bone_names)
+    column = np.array([names.index(name) for name in model.bone_names], dtype=np.int64)
+    positions = []
+    uvs = []
+    weights = []
+    for mesh in model.meshes:
+        if mesh.positions is None or mesh.faces is None:
+            continue
+        corners = mesh.faces.ravel().astype(np.int64)
+        positions.append(mesh.positions[corners])
+        uvs.append(mesh.texc[corners] if mesh.texc is not None else np.zeros((len(corners), 2)))
+        dense = np.zeros((len(mesh.positions), len(names)))
+        if mesh.skin is not None and len(mesh.skin.bones):
+            np.add.at(dense, (mesh.skin.rows(), column[mesh.skin.bones.astype(np.int64)]), mesh.skin.weights)
+        weights.append(dense[corners])
+    if not positions:
+        return np.zeros((0, 3, 3)), np.zeros((0, 3, 2)), np.zeros((0, 3, len(names)))
+    return (np.concatenate(positions).reshape(-1, 3, 3), np.concatenate(uvs).reshape(-1, 3, 2),
+            np.concatenate(weights).reshape(-1, 3, len(names)))
+
+
+def triangle_order(positions, uvs, quantum=1e-3):
+    """Canonical triangle order that ignores triangle order and first corner.
+
+    Triangles are sorted by their quantized positions, then UVs to break ties
+    between overlapping triangles.
+
+    :return: (triangle order, (tris, 3) corner rotation)
+    """
+    # the odd offset keeps round numbers away from the rounding boundaries,
+    # float32 noise then almost never moves a value to another cell
+    keys = np.floor(np.concatenate([positions, uvs], axis=-1) / quantum + 0.3183).astype(np.int64)
+    # smallest corner of every triangle, compared x, then y, then z
+    smaller = lambda p, q: (p[:, 0] < q[:, 0]) | (p[:, 0] == q[:, 0]) & (
+        (p[:, 1] < q[:, 1]) | (p[:, 1] == q[:, 1]) & (p[:, 2] < q[:, 2]))
+    first = np.zeros(len(keys), dtype=np.int64)
+    for corner in (1, 2):
+        best = keys[np.arange(len(keys)), first]
+        first = np.where(smaller(keys[:, corner], best), corner, first)
+    rotation = (first[:, None] + np.arange(3)[None, :]) % 3
+    rotated = np.take_along_axis(keys, rotation[..., None], axis=1)
+    rotated = np.concatenate([rotated[..., :3].reshape(-1, 9), rotated[..., 3:].reshape(-1, 6)], axis=1)
+    return np.lexsort(rotated.T[::-1]), rotation
+
+
+def rotate_corners(values, order, rotation):
+    return np.take_along_axis(values, rotation[..., None], axis=1)[order]
+
+
+def max_error(a, b):
+    if a.shape != b.shape:
+        return float('inf')
+    return float(np.abs(a - b).max(initial=0.0))
+
+
+def surf_planes(model):
+    # planes of all hulls in a canonical order, hulls may come back reordered
+    planes = np.concatenate([np.asarray(surf.planes, dtype=np.float64).reshape(-1, 4) for surf in model.surfs]
+                            or [np.zeros((0, 4))])
+    return planes[np.lexsort(np.round(planes, 3).T[::-1])]
+
+
+def compare_models(a, b, tolerances=TOLERANCES):
+    """:return: (problems, max errors by attribute)"""
+    problems = []
+    errors = {}
+    if sorted(a.bone_names) != sorted(b.bone_names):
+        problems.append('bone names differ')
+    else:
+        index_b = {name: i for i, name in enumerate(b.bone_names)}
+        order = [index_b[name] for name in a.bone_names]
+        errors['bone'] = max_error(a.matrices, b.matrices[order])
+        parents_a = [a.bone_names[p] if p >= 0 else None for p in a.bone_parents]
+        parents_b = [b.bone_names[p] if p >= 0 else None for p in b.bone_parents[order]]
+        if parents_a != parents_b:
+            problems.append('bone hierarchy differs')
+
+    corners_a = model_corners(a)
+    corners_b = model_corners(b)
+    if len(corners_a[0]) != len(corners_b[0]):
+        problems.append('%d triangles, expected %d' % (len(corners_b[0]), len(corners_a[0])))
+    else:
+        order_a, rotation_a = triangle_order(*corners_a[:2])
+        order_b, rotation_b = triangle_order(*corners_b[:2])
+        for name, values_a, values_b in zip(('position', 'uv', 'weight'), corners_a, corners_b):
+            errors[name] = max_error(rotate_corners(values_a, order_a, rotation_a),
+                                     rotate_corners(values_b, order_b, rotation_b))
+    if len(a.surfs) != len(b.surfs):
+        problems.append('%d surfs, expected %d' % (len(b.surfs), len(a.surfs)))
+    elif a.surfs:
+        errors['surf'] = max_error(surf_planes(a), surf_planes(b))
+    for name, error in errors.items():
+        if error > tolerances[name]:
+            problems.append('%s error %g above %g' % (name, error, tolerances[name]))
+    return problems, errors
+
+
+def clip_channel(motion, key_type, default, frames):
+    # one key holds for the whole clip, the importer does the same
+    keys = np.asarray(motion.get(key_type, [default]), dtype=np.float64)
+    if len(keys) == 1:
+        return np.full(frames, keys[0])
+    if len(keys) != frames:
+        return np.full(frames, np.nan)
+    return keys
+
+
+def clip_transforms(clip, bone_names):
+    """(bones, frames, 4, 4) local transforms in bone_names order."""
+    from ..clip_bake import euler_matrices
+    from ..k2_reader import MKEY_X, MKEY_Y, MKEY_Z, MKEY_PITCH, MKEY_ROLL, MKEY_YAW, MKEY_SCALE_X, MKEY_SCALE_Y, \
+        MKEY_SCALE_Z
+
+    frames = clip.num_frames
+    transforms = np.tile(np.eye(4), (len(bone_names), frames, 1, 1))
+    for i, name in enumerate(bone_names):
+        motion = clip.motions[name]
+        channels = [clip_channel(motion, key_type, default, frames) for key_type, default in (
+            (MKEY_X, 0.0), (MKEY_Y, 0.0), (MKEY_Z, 0.0), (MKEY_PITCH, 0.0), (MKEY_ROLL, 0.0), (MKEY_YAW, 0.0),
+            (MKEY_SCALE_X, 1.0), (MKEY_SCALE_Y, 1.0), (MKEY_SCALE_Z, 1.0))]
+        euler = np.radians(np.stack(channels[3:6], -1))
+        scale = np.stack(channels[6:9], -1)
+        transforms[i, :, :3, :3] = euler_matrices(euler, 'YXZ') * scale[:, None, :]
+        transforms[i, :, :3, 3] = np.stack(channels[:3], -1)
+    return transforms
+
+
+def compare_clips(a, b, tolerances=TOLERANCES):
+    problems = []
+    errors = {}
+    if a.num_frames != b.num_frames:
+        problems.append('%d frames, expected %d' % (b.num_frames, a.num_frames))
+        return problems, errors
+    if sorted(a.motions) != sorted(b.motions):
+        problems.append('animated bones differ')
+    names = sorted(set(a.motions) & set(b.motions))
+    ta = clip_transforms(a, names)
+    tb = clip_transforms(b, names)
+    scale_a = np.linalg.norm(ta[..., :3, :3], axis=-2)
+    scale_b = np.linalg.norm(tb[..., :3, :3], axis=-2)
+    errors['translation'] = max_error(ta[..., :3, 3], tb[..., :3, 3])
+    errors['scale'] = max_error(scale_a, scale_b)
+    errors['rotation'] = max_error(ta[..., :3, :3] / scale_a[..., None, :], tb[..., :3, :3] / scale_b[..., None, :])
+    for name, error in errors.items():
+        if not error <= tolerances[name]:
+            problems.append('%s error %g above %g' % (name, error, tolerances[name]))
+    return problems, errors
+
+
+def roundtrip_case(name, model, clip, directory):
+    import bpy
+    from .. import k2_log
+    from ..create_blender_clip import create_blender_clip
+    from ..create_blender_mesh import create_blender_mesh
+    from ..export_k2_clip import export_k2_clip
+    from ..export_k2_mesh import export_k2_mesh
+    from ..k2_reader import read_model, read_clip
+
+    k2_log.set_level(0)
+    profiler = StageProfiler()
+    result = {'case': name, 'model': model, 'clip': clip}
+    out_model = os.path.join(directory, name + '.out.model')
+    out_clip = os.path.join(directory, name + '.out.clip')
+
+    bpy.ops.wm.read_factory_settings(use_empty=True)
+    with profiler.stage('decode'):
+        original = read_model(model)
+        original_clip = read_clip(clip) if clip else None
+    with profiler.stage('import_mesh'):
+        create_blender_mesh(model, name, True)
+    objects = bpy.context.view_layer.objects
+    rig = [obj for obj in objects if obj.type == 'ARMATURE']
+    if clip:
+        for obj in objects:
+            obj.select_set(obj in rig)
+        objects.active = rig[0]
+        with profiler.stage('import_clip'):
+            create_blender_clip(clip, name)
+
+    for obj in objects:
+        obj.select_set(True)
+    with profiler.stage('export_mesh'):
+        export_k2_mesh(bpy.context, out_model, True, optimize_cache=True, max_influences=4)
+    if clip:
+        for obj in objects:
+            obj.select_set(obj in rig)
+        with profiler.stage('export_clip'):
+            export_k2_clip(out_clip, True, 0, original_clip.num_frames)
+
+    with profiler.stage('compare'):
+        problems, errors = compare_models(original, read_model(out_model))
+        if clip:
+            clip_problems, clip_errors = compare_clips(original_clip, read_clip(out_clip))
+            problems += ['clip: %s' % msg for msg in clip_problems]
+            errors.update(clip_errors)
+    result.update({'ok': not problems, 'problems': problems, 'errors': errors, 'stages': profiler.stages})
+    return result
+
+
+def main(argv=None):
+    from .generate import generate_model, generate_clip
+
+    if argv is None:
+        argv = sys.argv[sys.argv.index('--') + 1:] if '--' in sys.argv else sys.argv[1:]
+    parser = argparse.ArgumentParser(prog='benchmarks/roundtrip.py')
+    parser.add_argument('--model', action='append', default=[], help='sample .model, may be repeated')
+    parser.add_argument('--clip', action='append', default=[], help='.clip for the --model at the same position')
+    parser.add_argument('--verts', type=int, default=5000)
+    parser.add_argument('--bones', type=int, default=16)
+    parser.add_argument('--frames', type=int, default=30)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json')
+    args = parser.parse_args(argv)
+
+    tracemalloc.start()
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        model = os.path.join(directory, 'generated.model')
+        clip = os.path.join(directory, 'generated.clip')
+        surf_model = os.path.join(directory, 'generated_surfs.model')
+        generate_model(model, args.verts, args.bones, 4, 1, args.seed)
+        generate_clip(clip, args.bones, args.frames, seed=args.seed)
+        # collision-only model, no mesh chunks at all
+        generate_model(surf_model, 0, args.bones, 4, 0, args.seed, num_surfs=2)
+        cases = [('generated', model, clip), ('generated_surfs', surf_model, None)]
+        for i, sample in enumerate(args.model):
+            name = os.path.splitext(os.path.basename(sample))[0]
+            cases.append((name, sample, args.clip[i] if i < len(args.clip) else None))
+        for name, model, clip in cases:
+            try:
+                results.append(roundtrip_case(name, model, clip, directory))
+            except Exception as e:
+                results.append({'case': name, 'ok': False, 'problems': ['%s: %s' % (type(e).__name__, e)]})
+    tracemalloc.stop()
+
+    for result in results:
+        print('%s %s' % ('ok    ' if result['ok'] else 'FAILED', result['case']))
+        for msg in result['problems']:
+            print('    %s' % msg)
+        for stage, info in result.get('stages', {}).items():
+            print('    %-12s %8.3fs %10.1f KiB peak' % (stage, info['seconds'], info['peak_bytes'] / 1024.0))
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump({'tolerances': TOLERANCES, 'results': results}, file, indent=1)
+    return 0 if all(result['ok'] for result in results) else 1
+
+
+if __name__ == '__main__':
+    if __package__:
+        sys.exit(main())
+    # run as a script: import the add-on as a package, see k2_cli.load_package
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    cli = importlib.import_module('k2_cli').load_package()
+    sys.exit(importlib.import_module(cli.__package__ + '.benchmarks.roundtrip').main())
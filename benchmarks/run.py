@@ -0,0 +1,249 @@
+"""Benchmark runner, writes timings as JSON.
+
+Decoders, plain Python:
+
+    python benchmarks/run.py decode --verts 100000 --bones 64 --json decode.json
+
+Importers and exporters, inside headless Blender:
+
+    blender -b --factory-startup --python benchmarks/run.py -- blender --json blender.json
+
+Compare two result files:
+
+    python benchmarks/run.py compare old.json new.json
+"""
+
+import argparse
+import chunk
+import importlib
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def measure(func, repeat, setup=None):
+    runs = []
+    for i in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        runs.append(time.perf_counter() - start)
+    return {'best': min(runs), 'median': sorted(runs)[len(runs) // 2], 'runs': runs}
+
+
+def generate_files(args, directory):
+    from .generate import generate_model, generate_clip
+    model = os.path.join(directory, 'bench.model')
+    clip = os.path.join(directory, 'bench.clip')
+    info = {'model': generate_model(model, args.verts, args.bones, args.influences, args.meshes, args.seed),
+            'clip': generate_clip(clip, args.bones, args.frames, seed=args.seed)}
+    return model, clip, info
+
+
+def decode_chunks(data, bone_names, decoders, timings):
+    # one pass of the parse_hon_file decoders over every chunk of a model
+    from ..parse_hon_file import read_int
+    file = io.BytesIO(data)
+    file.seek(4)
+    head = chunk.Chunk(file, bigendian=0, align=0)
+    version = read_int(head)
+    head.skip()
+    while True:
+        try:
+            hon_chunk = chunk.Chunk(file, bigendian=0, align=0)
+        except EOFError:
+            break
+        name = hon_chunk.getname().decode()
+        decoder = decoders.get(name)
+        if decoder is not None:
+            start = time.perf_counter()
+            decoder(hon_chunk, version, bone_names)
+            timings[name] = timings.get(name, 0.0) + time.perf_counter() - start
+        hon_chunk.skip()
+
+
+def cmd_decode(args):
+    from .. import k2_log
+    from .. import parse_hon_file as ph
+    from ..k2_gltf import convert_to_glb
+    from ..k2_reader import read_model, read_clip
+
+    k2_log.set_level(0)
+    decoders = {
+        'vrts': lambda c, version, bones: ph.parse_vertices(c),
+        'face': lambda c, version, bones: ph.parse_faces(c, version),
+        'nrml': lambda c, version, bones: ph.parse_normals(c),
+        'texc': lambda c, version, bones: ph.parse_texc(c, version),
+        'sign': lambda c, version, bones: ph.parse_sign(c),
+        'colr': lambda c, version, bones: ph.parse_colr(c),
+        'lnk1': lambda c, version, bones: ph.parse_links(c, bones),
+        'surf': lambda c, version, bones: ph.parse_surf(c),
+    }
+    with tempfile.TemporaryDirectory() as directory:
+        model, clip, info = generate_files(args, directory)
+        with open(model, 'rb') as file:
+            model_data = file.read()
+        bone_names = read_model(model).bone_names
+
+        results = {}
+        runs = []
+        for i in range(args.repeat):
+            timings = {}
+            decode_chunks(model_data, bone_names, decoders, timings)
+            runs.append(timings)
+        for name in runs[0]:
+            values = [timings[name] for timings in runs]
+            results['parse_hon_file.%s' % name] = {'best': min(values), 'median': sorted(values)[len(values) // 2],
+                                                   'runs': values}
+
+        def read_motions():
+            with open(clip, 'rb') as file:
+                file.seek(4)
+                head = chunk.Chunk(file, bigendian=0, align=0)
+                version = ph.read_int(head)
+                head.skip()
+                ph.read_clip_motions(file, version)
+
+        results['parse_hon_file.read_clip_motions'] = measure(read_motions, args.repeat)
+        results['k2_reader.read_model'] = measure(lambda: read_model(model), args.repeat)
+        results['k2_reader.read_clip'] = measure(lambda: read_clip(clip), args.repeat)
+        results['k2_gltf.convert_to_glb'] = measure(
+            lambda: convert_to_glb(model, [clip], os.path.join(directory, 'bench.glb')), args.repeat)
+    return info, results
+
+
+def cmd_blender(args):
+    # runs inside Blender, every run starts from an empty scene
+    import bpy
+    from .. import k2_log
+    from ..create_blender_clip import create_blender_clip
+    from ..create_blender_mesh import create_blender_mesh
+    from ..export_k2_clip import export_k2_clip
+    from ..export_k2_mesh import export_k2_mesh
+
+    k2_log.set_level(0)
+
+    def empty_scene():
+        bpy.ops.wm.read_factory_settings(use_empty=True)
+
+    def select(objects):
+        for obj in bpy.context.view_layer.objects:
+            obj.select_set(obj in objects)
+
+    def rig():
+        return [obj for obj in bpy.context.view_layer.objects if obj.type == 'ARMATURE']
+
+    def select_model():
+        empty_scene()
+        create_blender_mesh(model, 'bench', True)
+        select(list(bpy.context.view_layer.objects))
+
+    def select_rig():
+        empty_scene()
+        create_blender_mesh(model, 'bench', True)
+        select(rig())
+        bpy.context.view_layer.objects.active = rig()[0]
+
+    def select_animated_rig():
+        select_rig()
+        create_blender_clip(clip, 'bench')
+        select(rig())
+
+    with tempfile.TemporaryDirectory() as directory:
+        model, clip, info = generate_files(args, directory)
+        out = os.path.join(directory, 'out')
+        results = {
+            'create_blender_mesh': measure(lambda: create_blender_mesh(model, 'bench', True), args.repeat,
+                                           empty_scene),
+            'create_blender_clip': measure(lambda: create_blender_clip(clip, 'bench'), args.repeat, select_rig),
+            'export_k2_mesh': measure(lambda: export_k2_mesh(bpy.context, out + '.model', True, max_influences=4),
+                                      args.repeat, select_model),
+        }
+        for mode in ('FCURVES', 'SCENE'):
+            results['export_k2_clip.%s' % mode.lower()] = measure(
+                lambda: export_k2_clip(out + '.clip', True, 0, args.frames, mode), args.repeat, select_animated_rig)
+    info['blender'] = bpy.app.version_string
+    return info, results
+
+
+def cmd_compare(args):
+    with open(args.old) as file:
+        old = json.load(file)['results']
+    with open(args.new) as file:
+        new = json.load(file)['results']
+    regressions = 0
+    for name in sorted(set(old) | set(new)):
+        if name not in old or name not in new:
+            print('%-40s only in %s' % (name, args.old if name in old else args.new))
+            continue
+        ratio = new[name]['best'] / old[name]['best'] if old[name]['best'] > 0 else float('inf')
+        flag = ''
+        if ratio > 1.0 + args.threshold:
+            flag = '  SLOWER'
+            regressions += 1
+        elif ratio < 1.0 - args.threshold:
+            flag = '  faster'
+        print('%-40s %10.4fs %10.4fs %6.2fx%s' % (name, old[name]['best'], new[name]['best'], ratio, flag))
+    return 1 if regressions else 0
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[sys.argv.index('--') + 1:] if '--' in sys.argv else sys.argv[1:]
+    parser = argparse.ArgumentParser(prog='benchmarks/run.py', description='K2 import/export benchmarks')
+    sub = parser.add_subparsers(dest='command')
+    sub.required = True
+    for name, func in (('decode', cmd_decode), ('blender', cmd_blender)):
+        p = sub.add_parser(name)
+        p.add_argument('--verts', type=int, default=20000)
+        p.add_argument('--bones', type=int, default=32)
+        p.add_argument('--influences', type=int, default=4)
+        p.add_argument('--meshes', type=int, default=1)
+        p.add_argument('--frames', type=int, default=100)
+        p.add_argument('--seed', type=int, default=0)
+        p.add_argument('--repeat', type=int, default=5)
+        p.add_argument('--json', help='write the results to this file')
+        p.set_defaults(func=func)
+    p = sub.add_parser('compare')
+    p.add_argument('old')
+    p.add_argument('new')
+    p.add_argument('--threshold', type=float, default=0.1, help='relative change reported as a regression')
+    p.set_defaults(func=cmd_compare)
+    args = parser.parse_args(argv)
+    if args.command == 'compare':
+        return args.func(args)
+
+    info, results = args.func(args)
+    package = importlib.import_module(__package__.rsplit('.', 1)[0])
+    report = {
+        'benchmark': args.command,
+        'version': '.'.join(map(str, package.bl_info['version'])),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'params': {key: value for key, value in vars(args).items() if key not in ('func', 'json', 'command')},
+        'data': info,
+        'results': results,
+    }
+    for name, result in sorted(results.items()):
+        print('%-40s best %.4fs median %.4fs' % (name, result['best'], result['median']))
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(report, file, indent=1)
+    return 0
+
+
+if __name__ == '__main__':
+    if __package__:
+        sys.exit(main())
+    # run as a script: import the add-on as a package, see k2_cli.load_package
+    package_dir = os.path.dirname(BENCH_DIR)
+    sys.path.insert(0, package_dir)
+    cli = importlib.import_module('k2_cli').load_package()
+    sys.exit(importlib.import_module(cli.__package__ + '.benchmarks.run').main())
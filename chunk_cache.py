@@ -0,0 +1,50 @@
+from collections import OrderedDict
+
+
+class ChunkCache:
+    """Least recently used cache of encoded chunks, bounded by payload bytes.
+
+    Entries are looked up by a content fingerprint, so a stale entry is never
+    hit, it only ages out.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        item = self.entries.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return item[0]
+
+    def put(self, key, value, nbytes):
+        if key in self.entries:
+            self.nbytes -= self.entries.pop(key)[1]
+        if nbytes > self.max_bytes:
+            return
+        self.entries[key] = (value, nbytes)
+        self.nbytes += nbytes
+        self.evict()
+
+    def resize(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.evict()
+
+    def evict(self):
+        while self.nbytes > self.max_bytes:
+            key, (value, nbytes) = self.entries.popitem(last=False)
+            self.nbytes -= nbytes
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
@@ -0,0 +1,65 @@
+import os
+import struct
+import tempfile
+
+BUFFER_SIZE = 4 * 1024 * 1024
+
+
+class ChunkWriter:
+    """Streams K2 chunks into a temporary file and renames it into place.
+
+    Chunk payloads are written piece by piece (bytes, memoryviews or
+    contiguous NumPy arrays) and the chunk size is back-patched once the
+    chunk is complete, so payloads never have to be joined in memory.
+    """
+
+    def __init__(self, filename, signature):
+        self.filename = filename
+        dirname = os.path.dirname(os.path.abspath(filename))
+        fd, self.tmp_name = tempfile.mkstemp(prefix='.%s.' % os.path.basename(filename), suffix='.tmp',
+                                             dir=dirname)
+        self.file = os.fdopen(fd, 'wb', BUFFER_SIZE)
+        self.file.write(signature)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def tell(self):
+        return self.file.tell()
+
+    def write_chunk(self, name, *pieces):
+        """Writes a chunk and returns the file offset of its payload."""
+        self.file.write(name.encode('utf8')[:4])
+        size_pos = self.file.tell()
+        self.file.write(struct.pack("<i", 0))
+        for piece in pieces:
+            self.file.write(piece)
+        end = self.file.tell()
+        self.patch(size_pos, struct.pack("<i", end - size_pos - 4))
+        return size_pos + 4
+
+    def patch(self, offset, data):
+        end = self.file.tell()
+        self.file.seek(offset)
+        self.file.write(data)
+        self.file.seek(end)
+
+    def close(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        # mkstemp creates the file as 0600, use the usual permissions instead
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(self.tmp_name, 0o666 & ~umask)
+        os.replace(self.tmp_name, self.filename)
+
+    def abort(self):
+        self.file.close()
+        os.remove(self.tmp_name)
@@ -0,0 +1,195 @@
+# Baking of armature animation into (frames, bones, 4, 4) arrays of armature
+# space pose matrices, in K2Skeleton order.
+
+import numpy as np
+
+BAKE_MODES = (
+    ('AUTO', "Auto", "Evaluate F-curves directly unless the rig has constraints, drivers, NLA tracks or "
+             "bones with non-default inheritance, connection or local location settings"),
+    ('FCURVES', "F-Curves", "Evaluate the action F-curves directly, FK rigs only"),
+    ('SCENE', "Scene", "Step the scene frame by frame, supports constraints and IK"),
+)
+
+
+def needs_scene_bake(arm_ob):
+    anim = arm_ob.animation_data
+    if anim and anim.drivers:
+        return True
+    if anim and anim.use_nla and any(not track.mute and track.strips for track in anim.nla_tracks):
+        return True
+    # bake_action_pose composes plain parent @ rest @ basis matrices, connected
+    # bones (location locked) and non local location need the scene
+    if any(not bone.use_inherit_rotation or bone.inherit_scale != 'FULL' or bone.use_connect
+           or not bone.use_local_location for bone in arm_ob.data.bones):
+        return True
+    return any(pbone.constraints for pbone in arm_ob.pose.bones)
+
+
+def bake_pose(arm_ob, skeleton, frames, mode='AUTO'):
+    if mode == 'SCENE' or (mode == 'AUTO' and needs_scene_bake(arm_ob)):
+        return bake_scene_pose(arm_ob, skeleton, frames)
+    anim = arm_ob.animation_data
+    return bake_action_pose(arm_ob, anim.action if anim else None, skeleton, frames)
+
+
+def bake_scene_pose(arm_ob, skeleton, frames):
+    import bpy
+    scene = bpy.context.scene
+    pose_bones = [arm_ob.pose.bones[name] for name in skeleton.names]
+    matrices = np.empty((len(frames), len(pose_bones), 4, 4))
+    frame_current = scene.frame_current
+    try:
+        for i, frame in enumerate(frames):
+            scene.frame_set(frame)
+            for j, pbone in enumerate(pose_bones):
+                matrices[i, j] = pbone.matrix
+    finally:
+        scene.frame_set(frame_current)
+    return matrices
+
+
+def fcurve_channel(fcurves, data_path, defaults, frames):
+    # (frames, len(defaults)) values, channels without an F-curve keep the
+    # current pose value
+    values = np.tile(np.array(defaults, dtype=np.float64), (len(frames), 1))
+    for index in range(len(defaults)):
+        fcurve = fcurves.get((data_path, index))
+        if fcurve is not None:
+            values[:, index] = [fcurve.evaluate(frame) for frame in frames]
+    return values
+
+
+def bake_action_pose(arm_ob, action, skeleton, frames):
+    """Evaluates the action F-curves without touching the scene.
+
+    Only the location, rotation and scale channels are used, so constraints,
+    drivers and NLA strips are ignored.
+    """
+    fcurves = {}
+    if action is not None:
+        for fcurve in action.fcurves:
+            fcurves[(fcurve.data_path, fcurve.array_index)] = fcurve
+
+    num_frames = len(frames)
+    basis = np.empty((num_frames, len(skeleton), 4, 4))
+    for j, name in enumerate(skeleton.names):
+        pbone = arm_ob.pose.bones[name]
+        path = 'pose.bones["%s"].' % bpy_escape(name)
+        location = fcurve_channel(fcurves, path + 'location', pbone.location, frames)
+        scale = fcurve_channel(fcurves, path + 'scale', pbone.scale, frames)
+        if pbone.rotation_mode == 'QUATERNION':
+            rotation = quaternion_matrices(
+                fcurve_channel(fcurves, path + 'rotation_quaternion', pbone.rotation_quaternion, frames))
+        elif pbone.rotation_mode == 'AXIS_ANGLE':
+            rotation = axis_angle_matrices(
+                fcurve_channel(fcurves, path + 'rotation_axis_angle', pbone.rotation_axis_angle, frames))
+        else:
+            rotation = euler_matrices(
+                fcurve_channel(fcurves, path + 'rotation_euler', pbone.rotation_euler, frames), pbone.rotation_mode)
+        basis[:, j] = 0.0
+        basis[:, j, :3, :3] = rotation * scale[:, None, :]
+        basis[:, j, :3, 3] = location
+        basis[:, j, 3, 3] = 1.0
+    return compose_hierarchy(skeleton, basis)
+
+
+def compose_hierarchy(skeleton, basis):
+    """Armature space pose matrices from (frames, bones, 4, 4) basis matrices.
+
+    Bones of one depth are composed together for all frames, parents are
+    always complete since the skeleton is sorted by depth.
+    """
+    matrices = skeleton.rest[None] @ basis
+    depths = skeleton.depths
+    for depth in range(1, depths.max(initial=0) + 1):
+        level = np.flatnonzero(depths == depth)
+        matrices[:, level] = matrices[:, skeleton.parents[level]] @ skeleton.local_rest[level] @ basis[:, level]
+    return matrices
+
+
+def bpy_escape(name):
+    return name.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def axis_rotations(angles, axis):
+    c = np.cos(angles)
+    s = np.sin(angles)
+    m = np.zeros(angles.shape + (3, 3))
+    a, b = [(1, 2), (2, 0), (0, 1)][axis]
+    m[..., axis, axis] = 1.0
+    m[..., a, a] = c
+    m[..., a, b] = -s
+    m[..., b, a] = s
+    m[..., b, b] = c
+    return m
+
+
+def euler_matrices(euler, order='XYZ'):
+    # the first axis of the order is applied first
+    matrix = None
+    for axis_name in order:
+        axis = 'XYZ'.index(axis_name)
+        rotation = axis_rotations(euler[..., axis], axis)
+        matrix = rotation if matrix is None else rotation @ matrix
+    return matrix
+
+
+def quaternion_matrices(quat):
+    length = np.linalg.norm(quat, axis=-1, keepdims=True)
+    quat = np.where(length > 0.0, quat / np.where(length > 0.0, length, 1.0), [1.0, 0.0, 0.0, 0.0])
+    w, x, y, z = np.moveaxis(quat, -1, 0)
+    m = np.empty(quat.shape[:-1] + (3, 3))
+    m[..., 0, 0] = 1.0 - 2.0 * (y * y + z * z)
+    m[..., 0, 1] = 2.0 * (x * y - w * z)
+    m[..., 0, 2] = 2.0 * (x * z + w * y)
+    m[..., 1, 0] = 2.0 * (x * y + w * z)
+    m[..., 1, 1] = 1.0 - 2.0 * (x * x + z * z)
+    m[..., 1, 2] = 2.0 * (y * z - w * x)
+    m[..., 2, 0] = 2.0 * (x * z - w * y)
+    m[..., 2, 1] = 2.0 * (y * z + w * x)
+    m[..., 2, 2] = 1.0 - 2.0 * (x * x + y * y)
+    return m
+
+
+def axis_angle_matrices(axis_angle):
+    angle = axis_angle[..., 0]
+    axis = axis_angle[..., 1:]
+    length = np.linalg.norm(axis, axis=-1, keepdims=True)
+    axis = axis / np.where(length > 0.0, length, 1.0)
+    half = angle[..., None] / 2.0
+    return quaternion_matrices(np.concatenate([np.cos(half), axis * np.sin(half)], axis=-1))
+
+
+# axis order and parity of Blender's Euler orders
+EULER_ORDERS = {
+    'XYZ': ((0, 1, 2), False),
+    'XZY': ((0, 2, 1), True),
+    'YXZ': ((1, 0, 2), True),
+    'YZX': ((1, 2, 0), False),
+    'ZXY': ((2, 0, 1), False),
+    'ZYX': ((2, 1, 0), True),
+}
+
+
+def matrices_to_euler(m, order='XYZ'):
+    """Euler angles of (..., 3, 3) rotation matrices with normalized columns.
+
+    Matches mathutils Matrix.to_euler(): of the two solutions the one with
+    the smaller sum of absolute angles is returned.
+    """
+    (i, j, k), parity = EULER_ORDERS[order]
+    cy = np.hypot(m[..., i, i], m[..., j, i])
+    regular = cy > 16.0 * np.finfo(np.float32).eps
+    eul1 = np.empty(m.shape[:-2] + (3,))
+    eul2 = np.empty(m.shape[:-2] + (3,))
+    eul1[..., i] = np.where(regular, np.arctan2(m[..., k, j], m[..., k, k]), np.arctan2(-m[..., j, k], m[..., j, j]))
+    eul1[..., j] = np.arctan2(-m[..., k, i], cy)
+    eul1[..., k] = np.where(regular, np.arctan2(m[..., j, i], m[..., i, i]), 0.0)
+    eul2[..., i] = np.where(regular, np.arctan2(-m[..., k, j], -m[..., k, k]), eul1[..., i])
+    eul2[..., j] = np.where(regular, np.arctan2(-m[..., k, i], -cy), eul1[..., j])
+    eul2[..., k] = np.where(regular, np.arctan2(-m[..., j, i], -m[..., i, i]), 0.0)
+    if parity:
+        eul1 = -eul1
+        eul2 = -eul2
+    use_second = np.abs(eul1).sum(axis=-1) > np.abs(eul2).sum(axis=-1)
+    return np.where(use_second[..., None], eul2, eul1)
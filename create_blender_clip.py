@@ -1,20 +1,18 @@
 import chunk
 import math
-import struct
 
 import bpy
 import mathutils
 
-from .create_blender_mesh import err
-from .parse_hon_file import IMPORT_LOG_LEVEL, log, read_int, vlog
+from .k2_log import err, log, vlog, dlog, stage
+from .k2_reader import MKEY_X, MKEY_Y, MKEY_Z, MKEY_PITCH, MKEY_ROLL, MKEY_YAW, MKEY_SCALE_X, MKEY_SCALE_Y, MKEY_SCALE_Z
+from .k2_skeleton import K2Skeleton
+from .modal_import import run_steps
+from .parse_hon_file import read_int, read_clip_motions
 
 ##############################
 # CLIPS
 ##############################
-MKEY_X, MKEY_Y, MKEY_Z, MKEY_PITCH, MKEY_ROLL, MKEY_YAW, MKEY_VISIBILITY, MKEY_SCALE_X, MKEY_SCALE_Y, MKEY_SCALE_Z = range(10)
-
-def dlog(msg):
-    if IMPORT_LOG_LEVEL >= 3: print(msg)
 
 
 def get_transform_matrix(motions, bone, i, version):
@@ -81,39 +79,56 @@ def get_transform_matrix(motions, bone, i, version):
     return bone_rotation_matrix, scale
 
 
-def animate_bone(name, pose, motions, num_frames, armature, arm_ob, version):
-    if name not in armature.bones.keys():
-        log('%s not found in armature' % name)
+def animate_bone(name, pose, motions, num_frames, skeleton, armature, version):
+    if name not in skeleton.index:
+        log('%s not found in armature', name)
         return
-    motion = motions[name]
     bone = armature.bones[name]
-    bone_rest_matrix = mathutils.Matrix(bone.matrix_local)
-
-    if bone.parent is not None:
-        parent_bone = bone.parent
-        parent_rest_bone_matrix = mathutils.Matrix(parent_bone.matrix_local)
-        parent_rest_bone_matrix.invert()
-        bone_rest_matrix = parent_rest_bone_matrix @ bone_rest_matrix
-
-    bone_rest_matrix_inv = mathutils.Matrix(bone_rest_matrix)
-    bone_rest_matrix_inv.invert()
+    bone_rest_matrix = mathutils.Matrix(skeleton.local_rest[skeleton.index[name]].tolist())
+    bone_rest_matrix_inv = bone_rest_matrix.inverted()
 
     pbone = pose.bones[name]
     prev_euler = mathutils.Euler()
     for i in range(0, num_frames):
         transform, size = get_transform_matrix(motions, bone, i, version)
-        transform = bone_rest_matrix_inv @ transform
-        pbone.rotation_quaternion = transform.to_quaternion()
-        pbone.location = transform.to_translation()
+        transform = bone_rest_matrix_inv @ transform @ mathutils.Matrix.Diagonal(size).to_4x4()
+        pbone.location, pbone.rotation_quaternion, pbone.scale = transform.decompose()
         pbone.keyframe_insert(data_path='rotation_quaternion', frame=i)
         pbone.keyframe_insert(data_path='location', frame=i)
+        pbone.keyframe_insert(data_path='scale', frame=i)
 
 
-def create_blender_clip(filename, clip_name):
-    file = open(filename, 'rb')  # open the file for reading
-    if not file:  # if the file doesn't exist then
-        log("can't open file")  # output to the log: "unable to open file"
-        return
+def create_blender_clip(filename, clip_name, arm_obj=None):
+    return run_steps(import_clip_steps(filename, clip_name, [], arm_obj))
+
+
+def import_clip_steps(filename, clip_name, created, arm_obj=None):
+    """Imports a .clip onto arm_obj (by default the selected armature),
+    yielding the progress after parsing and after each animated bone.
+    Returns the new action.
+
+    Everything created or changed is recorded in created, see
+    modal_import.rollback.
+    """
+    with open(filename, 'rb') as file:
+        return (yield from read_clip_chunks(file, clip_name, created, arm_obj))
+
+
+def restore_animation(arm_obj, had_animation, prev_action, pose_state):
+    # undoes the action assignment and the keyframed pose of a cancelled import
+    def restore():
+        for pbone, location, rotation, scale in pose_state:
+            pbone.location = location
+            pbone.rotation_quaternion = rotation
+            pbone.scale = scale
+        if not had_animation:
+            arm_obj.animation_data_clear()
+        elif arm_obj.animation_data:
+            arm_obj.animation_data.action = prev_action
+    return restore
+
+
+def read_clip_chunks(file, clip_name, created, arm_obj=None):
     sig = file.read(4)  # read the first 4 bytes - file descriptor
     if sig != b'CLIP':  # if the descriptor is not CLIP, then
         err('unknown file signature')  # we display an error: "unknown file signature"
@@ -127,9 +142,9 @@ def create_blender_clip(filename, clip_name):
     version = read_int(clip_chunk)  # read the file version
     num_bones = read_int(clip_chunk)  # read the number of bones
     num_frames = read_int(clip_chunk)  # read the number of frames
-    vlog("version: %d" % version)  # output the version of the file to the log
-    vlog("num bones: %d" % num_bones)  # log the number of bones
-    vlog("num frames: %d" % num_frames)  # log the number of frames
+    vlog("version: %d", version)  # output the version of the file to the log
+    vlog("num bones: %d", num_bones)  # log the number of bones
+    vlog("num frames: %d", num_frames)  # log the number of frames
 
     # objList = Blender.Object.GetSelected()
     # if len(objList) != 1:
@@ -139,62 +154,45 @@ def create_blender_clip(filename, clip_name):
     # action.setActive(arm_obj)
     # pose = arm_obj.getPose()
     # armature = arm_obj.getData()
-    arm_obj = bpy.context.selected_objects[0]
-    print("bpy.data.armatures:", bpy.data.armatures.values())
-
-    for ob in bpy.context.editable_objects:
-        print("ob.name:", ob.name)
-
-        try:
-            if(ob.data in bpy.data.armatures.values()):
-                print("armatures!")
-                arm_obj = ob
-        except AttributeError:
-            print("nope")
-        # print(ob.data.nodes)
+    if arm_obj is None:
+        arm_obj = bpy.context.selected_objects[0]
+        dlog("bpy.data.armatures: %s", bpy.data.armatures.values())
+
+        for ob in bpy.context.editable_objects:
+            dlog("ob.name: %s", ob.name)
+
+            try:
+                if(ob.data in bpy.data.armatures.values()):
+                    dlog("armatures!")
+                    arm_obj = ob
+            except AttributeError:
+                dlog("nope")
+            # print(ob.data.nodes)
     if arm_obj.data not in bpy.data.armatures.values():
         raise TypeError("Selected object not an armature")
 
+    had_animation = arm_obj.animation_data is not None
+    prev_action = arm_obj.animation_data.action if had_animation else None
+    pose_state = [(pbone, pbone.location.copy(), pbone.rotation_quaternion.copy(), pbone.scale.copy())
+                  for pbone in arm_obj.pose.bones]
+    created.append(restore_animation(arm_obj, had_animation, prev_action, pose_state))
     if not arm_obj.animation_data:
         arm_obj.animation_data_create()
 
     armature = arm_obj.data
+    skeleton = K2Skeleton(armature)
     action = bpy.data.actions.new(name=clip_name)
+    created.append(('actions', action))
     arm_obj.animation_data.action = action
     pose = arm_obj.pose
 
-    bone_index = -1  # create a variable bone_index with a value of -1
-    motions = {}  # creating a dictionary motions
-
-    while 1:  # execute the loop body as long as the loop condition is true
-        try:  # run the try statement
-            clip_chunk = chunk.Chunk(file, bigendian=0, align=0)  # read the block name
-        except EOFError:  # if during the execution of the try statement we stumbled upon the end of the file, then
-            break  # terminate the cycle ahead of schedule
-        if version == 1:  # if the file version is 1, then
-            name = clip_chunk.read(32)  # read the next 32 bytes - the name of the bone
-            if '\0' in name:  # if, while reading, they stumbled upon the value 0, then
-                name = name[:name.index('\0')]  # save the read bytes into the name variable
-        boneindex = read_int(clip_chunk)  # read the bone index
-        keytype = read_int(clip_chunk)  # read the animation key type
-        numkeys = read_int(clip_chunk)  # read the number of animation keys
-        if version > 1:  # if the file version is greater than 1, then
-            namelength = struct.unpack("B", clip_chunk.read(1))[0]  # read the length of the bone name
-            name = clip_chunk.read(namelength)  # we read the name of the bone taking into account its length
-            clip_chunk.read(1)  # read 1 byte - value 0
-        name = name.decode("utf8")  # recode the bone name in UTF-8 encoding
-
-        if name not in motions:  # if the name of the bone is not in the motions dictionary, then
-            motions[name] = {}
-        dlog("%s,boneindex: %d,keytype: %d,numkeys: %d" % \
-             (name, boneindex, keytype, numkeys))
-        if keytype == MKEY_VISIBILITY:  # if the key type is visibility, then
-            data = struct.unpack("%dB" % numkeys, clip_chunk.read(numkeys))  # read Byte
-        else:  # if not, then
-            data = struct.unpack("<%df" % numkeys, clip_chunk.read(numkeys * 4))  # read Float
-        motions[name][keytype] = list(data)  # convert the data string to a list
-        clip_chunk.skip()  # skip the error test
+    with stage('parse'):
+        motions = read_clip_motions(file, version)
+    yield 0.0
     # file read, now animate that bastard!
-    for bone_name in motions:  # for each bone in the motions dictionary do
-        animate_bone(bone_name, pose, motions, num_frames, armature, arm_obj, version)
-    # pose.update()
\ No newline at end of file
+    for done, bone_name in enumerate(motions, 1):  # for each bone in the motions dictionary do
+        with stage('keyframes'):
+            animate_bone(bone_name, pose, motions, num_frames, skeleton, armature, version)
+        yield done / len(motions)
+    # pose.update()
+    return action
@@ -1,23 +1,92 @@
 import chunk
+import os
 import struct
 
 import bpy
 import mathutils
 
+from .k2_log import err, log, vlog, stage
+from .k2_reader import c_string
 from .mat_utils import round_matrix, mat3_to_vec_roll
-from .parse_hon_file import log, read_int, vlog, parse_vertices, parse_faces, parse_normals, parse_texc, parse_colr, \
+from .modal_import import run_steps
+from .parse_hon_file import read_int, parse_vertices, parse_faces, parse_normals, parse_texc, parse_colr, \
     parse_links, parse_sign, parse_surf
+from .surf_hull import SURF_PROPERTY, SURF_FLAGS_PROPERTY
+from .two_sided import TWO_SIDED_ATTRIBUTE, find_two_sided, drop_faces
+
+
+# vertex group assignments and UV polygons between two progress updates
+WEIGHT_BATCH = 20000
+UV_BATCH = 20000
+
+
+def read_bone_matrices(hon_chunk, version):
+    """Reads the inverse and the base matrix of a bone in one go.
+
+    Version 1 stores two 4x4 matrices, version 3 the first three rows of two
+    4x4 matrices column by column. The matrices are returned as stored, i.e.
+    transposed.
+    """
+    if version == 1:
+        values = struct.unpack('<32f', hon_chunk.read(128))
+        rows = [values[i:i + 4] for i in range(0, 32, 4)]
+    else:
+        values = struct.unpack('<24f', hon_chunk.read(96))
+        rows = [values[i:i + 3] + ((1.0,) if i % 12 == 9 else (0.0,)) for i in range(0, 24, 3)]
+    return mathutils.Matrix(rows[:4]), mathutils.Matrix(rows[4:])
+
+
+def merge_back_faces(verts, faces, nrml, texc, v_groups):
+    """Merges triangles with a reversed duplicate into two-sided faces.
+
+    :return: verts, faces, texc and v_groups without the duplicates and the
+        vertices only they used, and the two-sided flag of every face
+    """
+    keep, two_sided = find_two_sided(verts, faces, nrml if len(nrml) == len(verts) else None)
+    if keep.all():
+        return verts, faces, texc, v_groups, two_sided
+    faces, order, remap = drop_faces(faces, keep, len(verts))
+    if len(texc) == len(verts):
+        texc = [texc[i] for i in order]
+    verts = [verts[i] for i in order]
+    remap = remap.tolist()
+    v_groups = {name: [(remap[v], w) for v, w in weights if remap[v] >= 0] for name, weights in v_groups.items()}
+    return verts, faces.tolist(), texc, v_groups, two_sided[keep]
+
+
+def create_surf_object(surf, obj_name, scn, created):
+    # collision hull as a wire object, marked so the exporter writes it back
+    name = '%s_surf%d' % (obj_name, surf.index)
+    vlog('surf %d: %d planes, %d points, %d edges, %d triangles, flags %d', surf.index, len(surf.planes),
+         len(surf.points), len(surf.edges), len(surf.tris), surf.flags)
+    bpy_mesh = bpy.data.meshes.new(name=name)
+    created.append(('meshes', bpy_mesh))
+    bpy_mesh.from_pydata(surf.points.tolist(), [], surf.tris.tolist())
+    bpy_mesh.update()
+    bpy_object = bpy.data.objects.new('%s_Object' % name, bpy_mesh)
+    created.append(('objects', bpy_object))
+    scn.collection.objects.link(bpy_object)
+    bpy_object.display_type = 'WIRE'
+    bpy_object[SURF_PROPERTY] = True
+    bpy_object[SURF_FLAGS_PROPERTY] = surf.flags
+    return bpy_object
 
 
-def err(msg):
-    log(msg)
+def create_blender_mesh(filename, obj_name, flip_uv):
+    return run_steps(import_mesh_steps(filename, obj_name, flip_uv, []))
 
 
-def create_blender_mesh(filename, obj_name, flip_uv):
-    file = open(filename, 'rb')
-    if not file:
-        log("can't open file")
-        return
+def import_mesh_steps(filename, obj_name, flip_uv, created):
+    """Imports a .model, yielding the progress between pieces of work.
+
+    Everything created is appended to created, see modal_import.rollback.
+    """
+    with open(filename, 'rb') as file:
+        return (yield from read_mesh_chunks(file, obj_name, flip_uv, created))
+
+
+def read_mesh_chunks(file, obj_name, flip_uv, created):
+    file_size = os.fstat(file.fileno()).st_size
     sig = file.read(4)  # file descriptor
     if sig != b'SMDL':
         err('unknown file signature')
@@ -37,12 +106,12 @@ def create_blender_mesh(filename, obj_name, flip_uv):
     num_surfs = read_int(hon_chunk)  # number of surfaces?
     num_bones = read_int(hon_chunk)  # number of bones
 
-    vlog("Version %d" % version)
-    vlog("%d mesh(es)" % num_meshes)
-    vlog("%d sprites(es)" % num_sprites)
-    vlog("%d surfs(es)" % num_surfs)
-    vlog("%d bones(es)" % num_bones)
-    vlog("bounding box: (%f,%f,%f) - (%f,%f,%f)" % struct.unpack("<ffffff", hon_chunk.read(24)))
+    vlog("Version %d", version)
+    vlog("%d mesh(es)", num_meshes)
+    vlog("%d sprites(es)", num_sprites)
+    vlog("%d surfs(es)", num_surfs)
+    vlog("%d bones(es)", num_bones)
+    vlog("bounding box: (%f,%f,%f) - (%f,%f,%f)", *struct.unpack("<ffffff", hon_chunk.read(24)))
     hon_chunk.skip()
 
     scn = bpy.context.scene
@@ -57,8 +126,10 @@ def create_blender_mesh(filename, obj_name, flip_uv):
 
     # create armature object
     armature_data = bpy.data.armatures.new('%s_Armature' % obj_name)
+    created.append(('armatures', armature_data))
     armature_data.show_names = True
     rig = bpy.data.objects.new('%s_Rig' % obj_name, armature_data)
+    created.append(('objects', rig))
     scn.collection.objects.link(rig)
     bpy.context.view_layer.objects.active = rig
     # rig.select = True
@@ -73,79 +144,57 @@ def create_blender_mesh(filename, obj_name, flip_uv):
     # armature.envelopes = False
     # armature.vertexGroups = True
 
-    bpy.ops.object.mode_set(mode='EDIT')
-
-    bones = []
-    bone_names = []
-    parents = []
-    for i in range(num_bones):
-        group_name = ''
-        parent_bone_index = read_int(hon_chunk)  # parent bone index
-
-        if version == 3:
-            # and the inverse coordinates of the bone
-            inv_matrix = mathutils.Matrix((struct.unpack('<3f', hon_chunk.read(12)) + (0.0,),
-                                           struct.unpack('<3f', hon_chunk.read(12)) + (0.0,),
-                                           struct.unpack('<3f', hon_chunk.read(12)) + (0.0,),
-                                           struct.unpack('<3f', hon_chunk.read(12)) + (1.0,)))
-            # bone coordinates
-            matrix = mathutils.Matrix((struct.unpack('<3f', hon_chunk.read(12)) + (0.0,),
-                                       struct.unpack('<3f', hon_chunk.read(12)) + (0.0,),
-                                       struct.unpack('<3f', hon_chunk.read(12)) + (0.0,),
-                                       struct.unpack('<3f', hon_chunk.read(12)) + (1.0,)))
-
-            name_length = struct.unpack("B", hon_chunk.read(1))[0]  # length of the bone name string
-            group_name = hon_chunk.read(name_length)  # bone name
-
-            hon_chunk.read(1)  # zero
-        elif version == 1:
+    with stage('geometry'):
+        bpy.ops.object.mode_set(mode='EDIT')
+
+        bones = []
+        bone_names = []
+        parents = []
+        for i in range(num_bones):
             group_name = ''
-            pos = hon_chunk.tell() - 4
-            b = hon_chunk.read(1)
-            while b != '\0':
-                group_name += b
-                b = hon_chunk.read(1)
-            hon_chunk.seek(pos + 0x24)
-            inv_matrix = mathutils.Matrix((struct.unpack('<4f', hon_chunk.read(16)),  # transformation matrix 4x4 MAX
-                                           struct.unpack('<4f', hon_chunk.read(16)),
-                                           struct.unpack('<4f', hon_chunk.read(16)),
-                                           struct.unpack('<4f', hon_chunk.read(16))))
-
-            matrix = mathutils.Matrix((struct.unpack('<4f', hon_chunk.read(16)),  # 4x4 Savage transformation matrix
-                                       struct.unpack('<4f', hon_chunk.read(16)),
-                                       struct.unpack('<4f', hon_chunk.read(16)),
-                                       struct.unpack('<4f', hon_chunk.read(16))))
-
-        group_name = group_name.decode()
-        log("bone name: %s,parent %d" % (group_name, parent_bone_index))
-        bone_names.append(group_name)
-        matrix.transpose()
-        #matrix = round_matrix(matrix, 4)
-        pos = matrix.translation
-        axis, roll = mat3_to_vec_roll(matrix.to_3x3())
-        bone = armature_data.edit_bones.new(group_name)
-        bone.head = pos
-        bone.tail = pos + axis
-        bone.roll = roll
-        parents.append(parent_bone_index)
-        bones.append(bone)
-    for i in range(num_bones):
-        if parents[i] != -1:
-            bones[i].parent = bones[parents[i]]
+            parent_bone_index = read_int(hon_chunk)  # parent bone index
 
-    hon_chunk.skip()
+            if version == 3:
+                inv_matrix, matrix = read_bone_matrices(hon_chunk, version)
+                name_length = struct.unpack("B", hon_chunk.read(1))[0]  # length of the bone name string
+                group_name = hon_chunk.read(name_length).decode('utf8', 'replace')  # bone name
+                hon_chunk.read(1)  # zero
+            elif version == 1:
+                group_name = c_string(hon_chunk.read(32))  # NUL padded bone name
+                inv_matrix, matrix = read_bone_matrices(hon_chunk, version)
+
+            vlog("bone name: %s,parent %d", group_name, parent_bone_index)
+            bone_names.append(group_name)
+            matrix.transpose()
+            #matrix = round_matrix(matrix, 4)
+            pos = matrix.translation
+            axis, roll = mat3_to_vec_roll(matrix.to_3x3())
+            bone = armature_data.edit_bones.new(group_name)
+            bone.head = pos
+            bone.tail = pos + axis
+            bone.roll = roll
+            parents.append(parent_bone_index)
+            bones.append(bone)
+        for i in range(num_bones):
+            if parents[i] != -1:
+                bones[i].parent = bones[parents[i]]
+
+        hon_chunk.skip()
 
     bpy.ops.object.mode_set(mode='OBJECT')
     # rig.show_x_ray = True
     rig.show_in_front = True
     rig.update_tag()
     # scn.update()
+    yield file.tell() / file_size
 
     try:
         hon_chunk = chunk.Chunk(file, bigendian=0, align=0)
     except EOFError:
         log('error reading mesh chunk')
         return
+    # the last mesh object, or the first hull of a collision-only model
+    bpy_object = None
     while hon_chunk and hon_chunk.getname() in [b'mesh', b'surf']:
         verts = []
         faces = []
@@ -153,47 +202,31 @@ def create_blender_mesh(filename, obj_name, flip_uv):
         nrml = []
         texc = []
         colors = []
-        surf_planes = []
-        surf_points = []
-        surf_edges = []
-        surf_tris = []
+        v_groups = {}
         if hon_chunk.getname() == b'mesh':  # section title
-            surf = False
             # read mesh chunk
-            vlog("mesh index: %d" % read_int(hon_chunk))  # wireframe index
+            vlog("mesh index: %d", read_int(hon_chunk))  # wireframe index
             mode = 1
             if version == 3:
                 mode = read_int(hon_chunk)  # is there a modifier Skin: 1 - yes, 2 - no
-                vlog("mode: %d" % mode)
-                vlog("vertices count: %d" % read_int(hon_chunk))  # number of vertices
-                vlog("bounding box: (%f,%f,%f) - (%f,%f,%f)" % struct.unpack("<ffffff", hon_chunk.read(24)))  # coordinates of the overall container
+                vlog("mode: %d", mode)
+                vlog("vertices count: %d", read_int(hon_chunk))  # number of vertices
+                vlog("bounding box: (%f,%f,%f) - (%f,%f,%f)", *struct.unpack("<ffffff", hon_chunk.read(24)))  # coordinates of the overall container
                 bone_link = read_int(hon_chunk)  # количество связей кости?
-                vlog("bone link: %d" % bone_link)
+                vlog("bone link: %d", bone_link)
                 size_name = struct.unpack('B', hon_chunk.read(1))[0]  # length of the line with the name of the framework
                 size_mat = struct.unpack('B', hon_chunk.read(1))[0]  # length of the line with the name of the material
-                mesh_name = hon_chunk.read(size_name)  # frame name
+                mesh_name = hon_chunk.read(size_name).decode('utf8', 'replace')  # frame name
                 hon_chunk.read(1)  # zero
-                material_name = hon_chunk.read(size_mat)  # name of material
+                material_name = hon_chunk.read(size_mat).decode('utf8', 'replace')  # name of material
             elif version == 1:
                 bone_link = -1
-                pos = hon_chunk.tell() - 4
-                b = hon_chunk.read(1)
-                mesh_name = ''
-                while b != '\0':
-                    mesh_name += b
-                    b = hon_chunk.read(1)
-                hon_chunk.seek(pos + 0x24)
-
-                b = hon_chunk.read(1)
-                material_name = ''
-                while b != '\0':
-                    material_name += b
-                    b = hon_chunk.read(1)
+                # NUL padded mesh and material names
+                mesh_name = c_string(hon_chunk.read(32))
+                material_name = c_string(hon_chunk.read(32))
 
             hon_chunk.skip()
 
-            mesh_name = mesh_name.decode()
-            material_name = material_name.decode()
             while 1:
                 try:
                     hon_chunk = chunk.Chunk(file, bigendian=0, align=0)
@@ -206,96 +239,113 @@ def create_blender_mesh(filename, obj_name, flip_uv):
                 elif mode != 1 and False:  # SKIP_NON_PHYSIQUE_MESHES:
                     hon_chunk.skip()
                 else:
-                    if hon_chunk.getname() == b'vrts':
-                        verts = parse_vertices(hon_chunk)
-                    elif hon_chunk.getname() == b'face':
-                        faces = parse_faces(hon_chunk, version)
-                    elif hon_chunk.getname() == b'nrml':
-                        nrml = parse_normals(hon_chunk)
-                    elif hon_chunk.getname() == b'texc':
-                        texc = parse_texc(hon_chunk, version)
-                    elif hon_chunk.getname() == b'colr':
-                        colors = parse_colr(hon_chunk)
-                    elif hon_chunk.getname() == b'lnk1' or hon_chunk.getname() == b'lnk3':
-                        v_groups = parse_links(hon_chunk, bone_names)
-                    elif hon_chunk.getname() == b'sign':
-                        signs = parse_sign(hon_chunk)
-                    elif hon_chunk.getname() == b'tang':
-                        hon_chunk.skip()
-                    else:
-                        vlog('unknown chunk: %s' % hon_chunk.chunkname)
-                        hon_chunk.skip()
+                    with stage('parse'):
+                        if hon_chunk.getname() == b'vrts':
+                            verts = parse_vertices(hon_chunk)
+                        elif hon_chunk.getname() == b'face':
+                            faces = parse_faces(hon_chunk, version)
+                        elif hon_chunk.getname() == b'nrml':
+                            nrml = parse_normals(hon_chunk)
+                        elif hon_chunk.getname() == b'texc':
+                            texc = parse_texc(hon_chunk, version)
+                        elif hon_chunk.getname() == b'colr':
+                            colors = parse_colr(hon_chunk)
+                        elif hon_chunk.getname() == b'lnk1' or hon_chunk.getname() == b'lnk3':
+                            v_groups = parse_links(hon_chunk, bone_names)
+                        elif hon_chunk.getname() == b'sign':
+                            signs = parse_sign(hon_chunk)
+                        elif hon_chunk.getname() == b'tang':
+                            hon_chunk.skip()
+                        else:
+                            vlog('unknown chunk: %s', hon_chunk.chunkname)
+                            hon_chunk.skip()
+                    yield file.tell() / file_size
         elif hon_chunk.getname() == b'surf':
-            surf_planes, surf_points, surf_edges, surf_tris = parse_surf(hon_chunk)
-            print(surf_planes)
-            print(surf_points)
-            print(surf_edges)
-            print(surf_tris)
-            verts = surf_points
-            faces = surf_tris
-            surf = True
-            mesh_name = obj_name + '_surf'
+            with stage('parse'):
+                surf = parse_surf(hon_chunk)
             hon_chunk.skip()
-            mode = 1
+            with stage('geometry'):
+                hull = create_surf_object(surf, obj_name, scn, created)
+            if bpy_object is None:
+                bpy_object = hull
+            yield file.tell() / file_size
             try:
                 hon_chunk = chunk.Chunk(file, bigendian=0, align=0)
             except EOFError:
                 vlog('done reading chunks')
                 hon_chunk = None
+            continue
 
         if mode != 1 and False:  # SKIP_NON_PHYSIQUE_MESHES:
             continue
 
-        bpy_mesh = bpy.data.meshes.new(name=mesh_name)
-        bpy_mesh.from_pydata(verts, [], faces)
-        bpy_mesh.update()
-
-        if material_name is not None:
-            bpy_mesh.materials.append(bpy.data.materials.new(material_name))
+        with stage('geometry'):
+            verts, faces, texc, v_groups, two_sided = merge_back_faces(verts, faces, nrml, texc, v_groups)
+            bpy_mesh = bpy.data.meshes.new(name=mesh_name)
+            created.append(('meshes', bpy_mesh))
+            bpy_mesh.from_pydata(verts, [], faces)
+            bpy_mesh.update()
+            if two_sided.any():
+                vlog('%d two-sided faces', two_sided.sum())
+                attribute = bpy_mesh.attributes.new(TWO_SIDED_ATTRIBUTE, 'BOOLEAN', 'FACE')
+                attribute.data.foreach_set('value', two_sided.tolist())
+
+            if material_name is not None:
+                material = bpy.data.materials.new(material_name)
+                created.append(('materials', material))
+                bpy_mesh.materials.append(material)
+        yield file.tell() / file_size
 
         if len(texc) > 0:
-            if flip_uv:
-                for t in range(len(texc)):
-                    texc[t] = (texc[t][0], 1 - texc[t][1])
-
-            # Generate texCoords for faces
-            tex_coords = []
-            for face in faces:
-                tex_coords.extend([texc[vert_id] for vert_id in face])
-
-            # uvMain = createTextureLayer("UVMain", bpy_mesh, tex_coords)
-            bpy_mesh.uv_layers.new()
-            uv_layer = bpy_mesh.uv_layers.active.data
-
-            for tris in bpy_mesh.polygons:
-                for loopIndex in range(tris.loop_start, tris.loop_start + tris.loop_total):
-                    vertex_index = bpy_mesh.loops[loopIndex].vertex_index
-                    uv_layer[loopIndex].uv = tex_coords[vertex_index]
+            with stage('geometry'):
+                if flip_uv:
+                    for t in range(len(texc)):
+                        texc[t] = (texc[t][0], 1 - texc[t][1])
+
+                # uvMain = createTextureLayer("UVMain", bpy_mesh, tex_coords)
+                bpy_mesh.uv_layers.new()
+                uv_layer = bpy_mesh.uv_layers.active.data
+
+            polygons = bpy_mesh.polygons
+            for start in range(0, len(polygons), UV_BATCH):
+                with stage('geometry'):
+                    for tris in polygons[start:start + UV_BATCH]:
+                        for loopIndex in range(tris.loop_start, tris.loop_start + tris.loop_total):
+                            vertex_index = bpy_mesh.loops[loopIndex].vertex_index
+                            uv_layer[loopIndex].uv = texc[vertex_index]
+                yield file.tell() / file_size
 
             # uvtex = bpy_mesh.uv_textures.new()
             # uvtex.name = 'UVMain' + mesh_name
             # uvloop = bpy_mesh.uv_layers[-1]
-            # for n, f in enumerate(tex_coords):
+            # for n, f in enumerate(texc):
             #     uvloop.data[n].uv = f
 
         bpy_object = bpy.data.objects.new('%s_Object' % mesh_name, bpy_mesh)
+        created.append(('objects', bpy_object))
         # Link object to scene
         scn.collection.objects.link(bpy_object)
         # scn.objects.active = bpy_object
         bpy.context.view_layer.objects.active = bpy_object
         # scn.update()
 
-        if surf or (mode != 1 and False):
+        if mode != 1 and False:
             bpy_object.display_type = 'WIRE'
         else:
-            # vertex groups
+            # vertex groups, in batches
             if bone_link >= 0:
-                grp = bpy_object.vertex_groups.new(bone_names[bone_link])
+                grp = bpy_object.vertex_groups.new(name=bone_names[bone_link])
                 grp.add(list(range(len(bpy_mesh.vertices))), 1.0, 'REPLACE')
+            added = 0
             for group_name in v_groups.keys():
-                grp = bpy_object.vertex_groups.new(name=group_name)
-                for (v, w) in v_groups[group_name]:
-                    grp.add([v], w, 'REPLACE')
+                with stage('weights'):
+                    grp = bpy_object.vertex_groups.new(name=group_name)
+                    for (v, w) in v_groups[group_name]:
+                        grp.add([v], w, 'REPLACE')
+                added += len(v_groups[group_name])
+                if added >= WEIGHT_BATCH:
+                    added = 0
+                    yield file.tell() / file_size
 
             mod = bpy_object.modifiers.new('MyRigModif', 'ARMATURE')
             mod.object = rig
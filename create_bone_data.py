@@ -1,44 +1,33 @@
 import struct
 from io import BytesIO
 
-# from .export_k2_clip import bone_depth
+import numpy as np
 
 
-def create_bone_data(armature, arm_matrix, transform):
-    bones = []
-    for bone in sorted(armature.bones.values(), key=bone_depth):
-        bones.append(bone.name)
-    bone_data = BytesIO()
+def create_bone_data(skeleton, arm_matrix, transform):
+    base = skeleton.rest
+    if transform:
+        base = base @ np.array(arm_matrix)
+    inv_matrices = np.linalg.inv(base)
+    return bone_chunk_data(skeleton.names, skeleton.parents, inv_matrices, base), inv_matrices
+
+
+def bone_chunk_data(names, parents, inv_matrices, base):
+    # K2 stores the first three rows of every matrix column by column
+    inv_rows = inv_matrices[:, :3, :].transpose(0, 2, 1).astype('<f4')
+    base_rows = base[:, :3, :].transpose(0, 2, 1).astype('<f4')
 
-    for name in bones:
-        bone = armature.bones[name]
-        base = bone.matrix_local.copy()
-        if transform:
-            base @= arm_matrix
-        base_inv = base.copy()
-        base_inv.invert()
-        if bone.parent:
-            parent_index = bones.index(bone.parent.name)
-        else:
-            parent_index = -1
-        base_inv.transpose()
-        base.transpose()
+    bone_data = BytesIO()
+    for index, name in enumerate(names):
         # parent bone index
-        bone_data.write(struct.pack("<i", parent_index))
+        bone_data.write(struct.pack("<i", parents[index]))
         # inverted matrix
-        bone_data.write(struct.pack('<12f', *sum([list(row[0:3]) for row in base_inv], [])))
+        bone_data.write(inv_rows[index].tobytes())
         # base matrix
-        bone_data.write(struct.pack('<12f', *sum([list(row[0:3]) for row in base], [])))
+        bone_data.write(base_rows[index].tobytes())
         # bone name
         name = name.encode('utf8')
         bone_data.write(struct.pack("B", len(name)))
         bone_data.write(name)
         bone_data.write(struct.pack("B", 0))
-    return bones, bone_data.getvalue()
-
-
-def bone_depth(bone):
-    if not bone.parent:
-        return 0
-    else:
-        return 1 + bone_depth(bone.parent)
+    return bone_data.getvalue()
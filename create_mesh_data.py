@@ -1,27 +1,35 @@
 import struct
 from io import BytesIO
 
+import numpy as np
 
-def generate_bounding_box(meshes):
-    # need to transform verts here?
-    xx = []
-    yy = []
-    zz = []
-    for mesh in meshes:
-        nv = [v.co for v in mesh.verts]
-        xx += [co[0] for co in nv]
-        yy += [co[1] for co in nv]
-        zz += [co[2] for co in nv]
-    return [min(xx), min(yy), min(zz), max(xx), max(yy), max(zz)]
 
+def positions_bounding_box(positions):
+    if len(positions) == 0:
+        return [0.0] * 6
+    return positions.min(axis=0).tolist() + positions.max(axis=0).tolist()
 
-def create_mesh_data(mesh, vert, index, name, m_name):
+
+def empty_bounding_boxes(count):
+    boxes = np.empty((count, 6))
+    boxes[:, :3] = np.inf
+    boxes[:, 3:] = -np.inf
+    return boxes
+
+
+def merge_bounding_boxes(boxes):
+    # boxes: sequence of (..., 6) arrays of min xyz, max xyz
+    boxes = np.asarray(boxes, dtype=np.float64)
+    return np.concatenate([boxes[..., :3].min(axis=0), boxes[..., 3:].max(axis=0)], axis=-1)
+
+
+def create_mesh_data(bounds, num_verts, index, name, m_name, mode=1, bone_link=-1):
     mesh_data = BytesIO()
     mesh_data.write(struct.pack("<i", index))
-    mesh_data.write(struct.pack("<i", 1))  # mode? huh? dunno...
-    mesh_data.write(struct.pack("<i", len(vert)))  # vertices count
-    mesh_data.write(struct.pack("<6f", *generate_bounding_box([mesh])))  # bounding box
-    mesh_data.write(struct.pack("<i", -1))  # bone link... dunno... TODO
+    mesh_data.write(struct.pack("<i", mode))  # mode? huh? dunno...
+    mesh_data.write(struct.pack("<i", num_verts))  # vertices count
+    mesh_data.write(struct.pack("<6f", *bounds))  # bounding box
+    mesh_data.write(struct.pack("<i", bone_link))  # bone of rigid meshes without lnk1
     mesh_data.write(struct.pack("<B", len(name)))
     mesh_data.write(struct.pack("<B", len(m_name)))
     mesh_data.write(name)
@@ -1,128 +1,151 @@
-import struct
-from io import BytesIO
-from math import degrees
+import os
 
 import bpy
+import numpy as np
 from mathutils import Matrix
 
+from .clip_bake import bake_pose, matrices_to_euler
+from .k2_log import err, vlog, log, stage
+from .k2_reader import MKEY_X, MKEY_Z, MKEY_PITCH, MKEY_YAW, MKEY_VISIBILITY, MKEY_SCALE_X, MKEY_SCALE_Z, MKEY_COUNT
+from .k2_skeleton import K2Skeleton
+from .k2_writer import channel_tolerances, write_clip
+
 ##############################
 # CLIPS
 ##############################
-MKEY_X, MKEY_Y, MKEY_Z, MKEY_PITCH, MKEY_ROLL, MKEY_YAW, MKEY_VISIBILITY, MKEY_SCALE_X, MKEY_SCALE_Y, MKEY_SCALE_Z, MKEY_COUNT = range(11)
-
-IMPORT_LOG_LEVEL = 3
 
 
-def log(msg):
-    if IMPORT_LOG_LEVEL >= 1:
-        print(msg)
+def pose_channels(pose_matrices, skeleton, worldmat):
+    """Decomposes baked pose matrices into K2 motion channels.
 
+    The inverse of the clip importer: a bone's channels are its transform
+    relative to its parent's pose, translation @ rotation @ scale, with the
+    rotation as YXZ Euler angles in degrees.
 
-def vlog(msg):
-    if IMPORT_LOG_LEVEL >= 2:
-        print(msg)
+    :param pose_matrices: (frames, bones, 4, 4) armature space pose matrices
+    :return: (bones, MKEY_COUNT, frames) channel values
+    """
+    matrices = pose_matrices.copy()
+    has_parent = skeleton.parents >= 0
+    inv_parents = np.linalg.inv(pose_matrices[:, skeleton.parents[has_parent]])
+    matrices[:, has_parent] = inv_parents @ pose_matrices[:, has_parent]
+    matrices[:, ~has_parent] = pose_matrices[:, ~has_parent] @ np.array(worldmat)
 
+    rotation = matrices[..., :3, :3]
+    scale = np.linalg.norm(rotation, axis=-2)
+    euler = matrices_to_euler(rotation / np.where(scale > 0.0, scale, 1.0)[..., None, :], 'YXZ')
 
-def err(msg):
-    log(msg)
+    channels = np.empty((len(skeleton), MKEY_COUNT, len(pose_matrices)))
+    channels[:, MKEY_X:MKEY_Z + 1] = matrices[..., :3, 3].transpose(1, 2, 0)
+    channels[:, MKEY_PITCH:MKEY_YAW + 1] = np.degrees(euler).transpose(1, 2, 0)
+    channels[:, MKEY_VISIBILITY] = 255
+    channels[:, MKEY_SCALE_X:MKEY_SCALE_Z + 1] = scale.transpose(1, 2, 0)
+    return channels
 
 
-def bone_depth(bone):
-    if not bone.parent:
-        return 0
-    else:
-        return 1 + bone_depth(bone.parent)
-
-
-def write_block(file, name, data):
-    file.write(name.encode('utf8')[:4])
-    file.write(struct.pack("<i", len(data)))
-    file.write(data)
-
-
-def clip_bone(file, bone_name, motion, index):
-    for key_type in range(MKEY_COUNT):
-        key_data = BytesIO()
-        key = motion[key_type]
-        # if key_type != MKEY_VISIBILITY:
-        # key = map(lambda k: round(k,ROUND_KEYS), key)
-        if min(key) == max(key):
-            key = [key[0]]
-        num_keys = len(key)
-        key_data.write(struct.pack("<i", index))
-        key_data.write(struct.pack("<i", key_type))
-        key_data.write(struct.pack("<i", num_keys))
-        key_data.write(struct.pack("B", len(bone_name)))
-        key_data.write(bone_name)
-        key_data.write(struct.pack("B", 0))
-        if key_type == MKEY_VISIBILITY:
-            key_data.write(struct.pack('%dB' % num_keys, *key))
-        else:
-            key_data.write(struct.pack('<%df' % num_keys, *key))
-        write_block(file, 'bmtn', key_data.getvalue())
-
-
-def export_k2_clip(filename, transform, frame_start, frame_end):
+def selected_armature():
     obj_list = bpy.context.selected_objects
     if len(obj_list) != 1 or obj_list[0].type != 'ARMATURE':
         err('Select needed armature only')
-        return
-    arm_ob = obj_list[0]
-    vlog('baking animation')
-    armature = arm_ob.data
-    if transform:
-        worldmat = arm_ob.matrix_world
-    else:
-        worldmat = Matrix([[1, 0, 0, 0], [0, 1, 0, 0], [0, 0, 1, 0], [0, 0, 0, 1]])
-
-    scene = bpy.context.scene
-    pose = arm_ob.pose
-
-    motions = {}
-    for frame in range(frame_start, frame_end):
-        scene.frame_set(frame)
-        for bone in pose.bones.values():
-            append_bone_motion(bone, motions, worldmat)
-
-    head_data = BytesIO()
-    head_data.write(struct.pack("<i", 2))
-    head_data.write(struct.pack("<i", len(motions.keys())))
-    head_data.write(struct.pack("<i", frame_end - frame_start))
-
-    file = open(filename, 'wb')
-    file.write(b'CLIP')
-    write_block(file, 'head', head_data.getvalue())
-
-    index = 0
-    for bone_name in sorted(armature.bones.keys(), key=lambda x: bone_depth(armature.bones[x])):
-        clip_bone(file, bone_name.encode('utf8'), motions[bone_name], index)
-        index += 1
-    file.close()
-    print("done!")
-
-
-def append_bone_motion(bone, motions, worldmat):
-    matrix = bone.matrix
-    if bone.parent:
-        matrix = matrix @ (bone.parent.matrix.copy().inverted())
+        return None
+    return obj_list[0]
+
+
+def export_k2_clip(filename, transform, frame_start, frame_end, bake_mode='AUTO', tolerances=None):
+    arm_ob = selected_armature()
+    if arm_ob is None:
+        return []
+    if tolerances is None:
+        tolerances = channel_tolerances()
+    worldmat = arm_ob.matrix_world if transform else Matrix.Identity(4)
+    skeleton = K2Skeleton(arm_ob.data)
+    return [write_clip_file(filename, arm_ob, skeleton, worldmat, range(frame_start, frame_end), bake_mode,
+                            tolerances)]
+
+
+def animated_bones(action):
+    # names of the pose bones the F-curves of action animate
+    return set(fcurve.data_path.split('"')[1] for fcurve in action.fcurves
+               if fcurve.data_path.startswith('pose.bones["'))
+
+
+def batch_clips(arm_ob, source):
+    """Lists the clips of a batch export.
+
+    Frame ranges exclude the end frame like the single clip export, so a
+    looping clip does not repeat its first pose.
+
+    :param source: 'ACTIONS' for every action animating only bones of the
+        armature, 'NLA' for the selected NLA strips of the armature (all
+        strips if none is selected)
+    :return: list of (name, action, frames)
+    """
+    clips = []
+    if source == 'NLA':
+        anim = arm_ob.animation_data
+        strips = [strip for track in anim.nla_tracks for strip in track.strips if strip.action] if anim else []
+        if any(strip.select for strip in strips):
+            strips = [strip for strip in strips if strip.select]
+        for strip in strips:
+            frames = range(round(strip.action_frame_start), round(strip.action_frame_end))
+            clips.append((strip.name, strip.action, frames))
     else:
-        matrix = matrix @ worldmat
-    if bone.name not in motions:
-        motions[bone.name] = []
-        for i in range(MKEY_COUNT):
-            motions[bone.name].append([])
-    motion = motions[bone.name]
-    translation = matrix.translation
-    rotation = matrix.to_euler('YXZ')
-    scale = matrix.to_scale()
-    visibility = 255
-    motion[MKEY_X].append(translation[0])
-    motion[MKEY_Y].append(translation[1])
-    motion[MKEY_Z].append(translation[2])
-    motion[MKEY_PITCH].append(-degrees(rotation[0]))
-    motion[MKEY_ROLL].append(-degrees(rotation[1]))
-    motion[MKEY_YAW].append(-degrees(rotation[2]))
-    motion[MKEY_SCALE_X].append(scale[0])
-    motion[MKEY_SCALE_Y].append(scale[1])
-    motion[MKEY_SCALE_Z].append(scale[2])
-    motion[MKEY_VISIBILITY].append(visibility)
+        bone_names = set(bone.name for bone in arm_ob.data.bones)
+        for action in bpy.data.actions:
+            bones = animated_bones(action)
+            if bones and bones <= bone_names:
+                start, end = action.frame_range
+                clips.append((action.name, action, range(round(start), round(end))))
+    return clips
+
+
+def export_k2_clips(directory, transform, source, bake_mode='AUTO', tolerances=None):
+    # one .clip per action or NLA strip, named after it
+    arm_ob = selected_armature()
+    if arm_ob is None:
+        return []
+    if tolerances is None:
+        tolerances = channel_tolerances()
+    worldmat = arm_ob.matrix_world if transform else Matrix.Identity(4)
+    skeleton = K2Skeleton(arm_ob.data)
+
+    clips = batch_clips(arm_ob, source)
+    filenames = [os.path.join(directory, bpy.path.clean_name(name) + '.clip') for name, action, frames in clips]
+    duplicates = sorted(set(name for name in filenames if filenames.count(name) > 1))
+    if duplicates:
+        # clean names can collide, don't let clips overwrite each other
+        for name in duplicates:
+            err('several clips would be written to %s', name)
+        return ['nothing exported, several clips share the file name %s' % os.path.basename(name)
+                for name in duplicates]
+
+    report = []
+    anim = arm_ob.animation_data or arm_ob.animation_data_create()
+    action = anim.action
+    use_nla = anim.use_nla
+    try:
+        # every clip is baked from its action alone
+        anim.use_nla = False
+        for (name, clip_action, frames), filename in zip(clips, filenames):
+            anim.action = clip_action
+            report.append(write_clip_file(filename, arm_ob, skeleton, worldmat, frames, bake_mode, tolerances))
+    finally:
+        anim.action = action
+        anim.use_nla = use_nla
+    if not report:
+        report.append('no clips to export')
+    return report
+
+
+def write_clip_file(filename, arm_ob, skeleton, worldmat, frames, bake_mode, tolerances):
+    vlog('baking %s', os.path.basename(filename))
+    with stage('keyframes'):
+        pose_matrices = bake_pose(arm_ob, skeleton, list(frames), bake_mode)
+        motions = pose_channels(pose_matrices, skeleton, worldmat)
+
+    with stage('write'):
+        collapsed, saved, size = write_clip(filename, skeleton.names, motions, tolerances)
+    msg = '%s: %d of %d channels constant, %d bytes saved (%.1f%%)' % (
+        os.path.basename(filename), collapsed, len(skeleton) * MKEY_COUNT, saved, 100.0 * saved / (size + saved))
+    log(msg)
+    return msg
@@ -1,262 +1,622 @@
+import copy
+import hashlib
+import json
+import multiprocessing
+import os
 import struct
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import nullcontext
 from io import BytesIO
 
 import bmesh
 import bpy
+import numpy as np
 
+from .chunk_cache import ChunkCache
 from .create_bone_data import create_bone_data
-from .create_mesh_data import generate_bounding_box, create_mesh_data
-from .export_k2_clip import write_block, vlog
-
-##############################
-# CLIPS
-##############################
-
-MKEY_X, MKEY_Y, MKEY_Z, MKEY_PITCH, MKEY_ROLL, MKEY_YAW, MKEY_VISIBILITY, MKEY_SCALE_X, MKEY_SCALE_Y, MKEY_SCALE_Z, MKEY_COUNT = range(11)
-
-
-def create_vrts_data(verts, mesh_index):
-    data = BytesIO()
-    data.write(struct.pack("<i", mesh_index))
-    for v in verts:
-        data.write(struct.pack("<3f", *v.co))
-    return data.getvalue()
-
+from .chunk_writer import ChunkWriter
+from .create_mesh_data import positions_bounding_box, merge_bounding_boxes, empty_bounding_boxes, \
+    create_mesh_data
+from .k2_log import log, vlog, stage
+from .k2_skeleton import K2Skeleton
+from .k2_writer import create_vrts_data, create_face_data, create_tang_data, create_texc_data, create_colr_data, \
+    create_nrml_data, create_lnk1_data, create_sign_data, create_surf_data
+from .mesh_split import split_faces
+from .skin_weights import SkinWeights, skin_weights_from_groups
+from .surf_hull import SURF_PROPERTY, SURF_FLAGS_PROPERTY, hull_surf
+from .two_sided import TWO_SIDED_ATTRIBUTE, back_faces
+from .vertex_cache import optimize_mesh
+
+# encoded meshes of earlier exports in this session, by mesh_fingerprint
+mesh_cache = ChunkCache(256 * 1024 * 1024)
+
+
+def flip_uv(texc):
+    # Blender puts the UV origin at the bottom left, K2 at the top left
+    texc = texc.astype('<f4')
+    texc[:, 1] = 1.0 - texc[:, 1]
+    return texc
+
+
+def bitangent_signs_to_k2(bitangent_sign):
+    # K2 stores 0 for a right handed tangent frame, -1 for a mirrored one
+    return np.where(bitangent_sign < 0.0, -1, 0).astype(np.int8)
+
+
+def face_to_vertices(faces, f_data, num_verts):
+    # f_data holds one row per face corner, the last corner using a vertex wins
+    v_data = np.zeros((num_verts,) + f_data.shape[1:], dtype=f_data.dtype)
+    v_data[faces.ravel()] = f_data
+    return v_data
+
+
+class MeshExportSettings:
+    def __init__(self, optimize_cache=True, max_verts=0, threads=0, max_influences=0, min_weight=0.0,
+                 bone_bounds=False, use_cache=False):
+        self.optimize_cache = optimize_cache
+        self.max_verts = max_verts
+        self.threads = threads
+        self.max_influences = max_influences
+        self.min_weight = min_weight
+        self.bone_bounds = bone_bounds
+        self.use_cache = use_cache
+
+    def output_key(self):
+        # the settings that change the written chunks
+        return (self.optimize_cache, self.max_verts, self.max_influences, self.min_weight, self.bone_bounds)
+
+
+class MeshArrays:
+    # everything needed to encode one mesh, detached from bpy so it can be
+    # handed to worker threads
+    def __init__(self, name, material, positions, normals, faces):
+        self.name = name
+        self.material = material
+        self.positions = positions
+        self.normals = normals
+        self.faces = faces
+        self.corner_uv = None
+        self.corner_tang = None
+        self.corner_sign = None
+        self.corner_colr = None
+        self.two_sided = None
+        self.skin = None
+
+
+def triangulated_bmesh(obj, deps_graph):
+    if deps_graph is not None:
+        org_mesh = obj.to_mesh(preserve_all_data_layers=True, depsgraph=deps_graph)
+    else:
+        org_mesh = obj.data
+    bm = bmesh.new()
+    bm.from_mesh(org_mesh)
+    bmesh.ops.triangulate(bm, faces=bm.faces)
+    bm.transform(obj.matrix_world)
+    if deps_graph is not None:
+        obj.to_mesh_clear()
+    return bm
 
-def create_face_data(verts, faces, mesh_index):
-    data = BytesIO()
-    data.write(struct.pack("<i", mesh_index))
-    data.write(struct.pack("<i", len(faces)))
 
-    if len(verts) < 255:
-        data.write(struct.pack("<B", 1))
-        string = '<3B'
-    else:
-        data.write(struct.pack("<B", 2))
-        string = '<3H'
-    for f in faces:
-        data.write(struct.pack(string, *f))
-    return data.getvalue()
-
-
-def create_tang_data(tang, mesh_index):
-    data = BytesIO()
-    data.write(struct.pack("<i", mesh_index))
-    data.write(struct.pack("<i", 0))  # huh?
-    for t in tang:
-        data.write(struct.pack('<3f', *list(t)))
-    return data.getvalue()
-
-
-def create_texc_data(texc, mesh_index):
-    # if flip_uv:
-    for i in range(len(texc)):
-        texc[i] = [texc[i][0], 1.0 - texc[i][1]]
-    data = BytesIO()
-    data.write(struct.pack("<i", mesh_index))
-    data.write(struct.pack("<i", 0))  # huh?
-    for t in texc:
-        data.write(struct.pack("<2f", *t))
-    return data.getvalue()
-
-
-def create_colr_data(colr, mesh_index):
-    data = BytesIO()
-    data.write(struct.pack("<i", mesh_index))
-    for c in colr:
-        data.write(struct.pack("<4B", c.r, c.g, c.b, c.a))
-    return data.getvalue()
-
-
-def create_nrml_data(verts, mesh_index):
-    data = BytesIO()
-    data.write(struct.pack("<i", mesh_index))
-    for v in verts:
-        data.write(struct.pack("<3f", *v.normal))
-    return data.getvalue()
-
-
-def create_lnk1_data(lnk1, mesh_index, bone_indices):
-    data = BytesIO()
-    data.write(struct.pack("<i", mesh_index))
-    data.write(struct.pack("<i", len(lnk1)))
-    for influences in lnk1:
-        influences = [inf for inf in influences if inf[0] in bone_indices]
-        l = len(influences)
-        data.write(struct.pack("<i", l))
-        if l > 0:
-            data.write(struct.pack('<%df' % l, *[inf[1] for inf in influences]))
-            data.write(struct.pack('<%dI' % l, *[bone_indices[inf[0]] for inf in influences]))
-    return data.getvalue()
-
-
-def create_sign_data(mesh_index, sign):
-    data = BytesIO()
-    data.write(struct.pack("<i", mesh_index))
-    data.write(struct.pack("<i", 0))
-    for s in sign:
-        data.write(struct.pack("<b", s))
-    return data.getvalue()
-
-
-def calc_face_signs(ftexc):
-    fsigns = []
-    for uv in ftexc:
-        if ((uv[1][0] - uv[0][0]) * (uv[2][1] - uv[1][1]) - (uv[1][1] - uv[0][1]) * (uv[2][0] - uv[1][0])) > 0:
-            fsigns.append((0, 0, 0))
-        else:
-            fsigns.append((-1, -1, -1))
-    return fsigns
+def parse_lod_levels(text):
+    # "0.5, 0.25" or "5000, 2000": ratios up to 1.0, triangle counts above
+    return [float(item) for item in text.replace(';', ',').split(',') if item.strip()]
 
 
-def face_to_vertices(faces, f_data, verts):
-    vdata = [None] * len(verts)
-    print("blääää___", f_data)
-    for fi, f in enumerate(faces):
-        print(fi, f)
-        for vi, v in enumerate(f):
-            print(vi, v)
-            vdata[v] = f_data[fi][vi]
-    return vdata
+def lod_filename(filename, level):
+    base, ext = os.path.splitext(filename)
+    return '%s_lod%d%s' % (base, level, ext)
 
 
-def export_k2_mesh(context, filename, apply_mods):
-    meshes = []
+def export_k2_mesh(context, filename, apply_mods, optimize_cache=True, max_verts=0, threads=0, max_influences=0,
+                   min_weight=0.0, bone_bounds=False, lods='', use_cache=False):
+    settings = MeshExportSettings(optimize_cache, max_verts, threads, max_influences, min_weight, bone_bounds,
+                                  use_cache)
+    objects = []
+    hulls = []
     armature = None
     for obj in bpy.context.selected_objects:
-        if obj.type == 'MESH':
-            matrix = obj.matrix_world
-
-            if apply_mods:
-                deps_graph = context.evaluated_depsgraph_get()
-                org_mesh = obj.to_mesh(preserve_all_data_layers=True, depsgraph=deps_graph)
-            else:
-                org_mesh = obj.data
-            bm = bmesh.new()
-            bm.from_mesh(org_mesh)
-            b_mesh = bm
-            bmesh.ops.triangulate(b_mesh, faces=bm.faces)
-            b_mesh.transform(matrix)
-
-            meshes.append((obj, b_mesh))
+        if obj.type == 'MESH' and obj.get(SURF_PROPERTY):
+            hulls.append(obj)
+        elif obj.type == 'MESH':
+            objects.append(obj)
         elif obj.type == 'ARMATURE':
             armature = obj.data
             arm_matrix = obj.matrix_world
 
+    # skeleton and vertex group -> bone tables are shared by all LOD levels
+    bone_names = []
+    bone_data = b''
+    inv_bind = np.zeros((0, 4, 4))
+    group_bones = {obj.name: {} for obj in objects}
     if armature:
-        armature.pose_position = 'REST'
-        bone_indices, bone_data = create_bone_data(armature, arm_matrix, apply_mods)
-
+        skeleton = K2Skeleton(armature)
+        bone_names = skeleton.names
+        bone_data, inv_bind = create_bone_data(skeleton, arm_matrix, apply_mods)
+        for obj in objects:
+            group_bones[obj.name] = skeleton.group_bones(obj.vertex_groups)
+
+    report = []
+    pose_position = armature.pose_position if armature else None
+    try:
+        if armature:
+            armature.pose_position = 'REST'
+        # meshes are evaluated one at a time while writing
+        deps_graph = context.evaluated_depsgraph_get() if apply_mods else None
+        with stage('hulls'):
+            surfs = [extract_hull_surf(obj, deps_graph, index) for index, obj in enumerate(hulls)]
+        if surfs:
+            msg = '%d collision hulls: %d planes' % (len(surfs), sum(len(surf.planes) for surf in surfs))
+            log(msg)
+            report.append(msg)
+        num_tris = write_model_file(filename, objects, deps_graph, group_bones, bone_names, bone_data, inv_bind,
+                                    settings, report, surfs)
+
+        lod_settings = copy.copy(settings)
+        lod_settings.bone_bounds = False
+        for level, value in enumerate(parse_lod_levels(lods), 1):
+            ratio = value if value <= 1.0 else value / max(num_tris, 1)
+            # decimate on top of the evaluated modifier stack, one depsgraph
+            # evaluation per level for all objects
+            modifiers = []
+            disabled = []
+            try:
+                if not apply_mods:
+                    # like the base file, only the decimation is applied
+                    for obj in objects:
+                        for mod in obj.modifiers:
+                            if mod.show_viewport:
+                                mod.show_viewport = False
+                                disabled.append(mod)
+                for obj in objects:
+                    mod = obj.modifiers.new('K2 LOD', 'DECIMATE')
+                    mod.ratio = min(ratio, 1.0)
+                    modifiers.append((obj, mod))
+                lod_name = lod_filename(filename, level)
+                lod_tris = write_model_file(lod_name, objects, context.evaluated_depsgraph_get(), group_bones,
+                                            bone_names, bone_data, inv_bind, lod_settings, report)
+            finally:
+                for obj, mod in modifiers:
+                    obj.modifiers.remove(mod)
+                for mod in disabled:
+                    mod.show_viewport = True
+            msg = '%s: %d of %d triangles' % (os.path.basename(lod_name), lod_tris, num_tris)
+            log(msg)
+            report.append(msg)
+    finally:
+        if armature:
+            armature.pose_position = pose_position
+    return report
+
+
+def write_model_file(filename, objects, deps_graph, group_bones, bone_names, bone_data, inv_bind, settings,
+                     report, surfs=()):
     head_data = BytesIO()
     head_data.write(struct.pack("<i", 3))
-    head_data.write(struct.pack("<i", len(meshes)))
+    head_data.write(struct.pack("<i", len(objects)))  # patched once meshes are split
     head_data.write(struct.pack("<i", 0))
-    head_data.write(struct.pack("<i", 0))
-    if armature:
-        head_data.write(struct.pack("<i", len(armature.bones.values())))
-    else:
-        head_data.write(struct.pack("<i", 0))
-
-    head_data.write(struct.pack("<6f", *generate_bounding_box([x for _, x in meshes])))  # bounding box
+    head_data.write(struct.pack("<i", len(surfs)))
+    head_data.write(struct.pack("<i", len(bone_names)))
+    head_data.write(struct.pack("<6f", *[0.0] * 6))  # bounding box, patched after writing meshes
 
     mesh_index = 0
 
-    file = open(filename, 'wb')
-    file.write(b'SMDL')
-
-    write_block(file, 'head', head_data.getvalue())
-    write_block(file, 'bone', bone_data)
-
-    write_model_data(bone_indices, file, mesh_index, meshes)
-
-
-def write_model_data(bone_indices, file, mesh_index, meshes):
-    for obj, org_mesh in meshes:
-        vert = [vert for vert in org_mesh.verts]
-        faces = []
-        f_texc = []
-        f_tang = []
-        f_colr = []
-        f_lnk1 = []
-        # faces = [[v.index for v in f.verts] for f in org_mesh.faces]
-        # f_tang = [[
-        # f_texc = org_mesh.uv_layers.active.data
-
-        # if org_mesh.vertexColors:
-        # f_colr = [[c for c in f.col] for f in org_mesh.faces]
-        # else:
-        # f_colr = None
-        uv_lay = org_mesh.loops.layers.uv.active
-        if not uv_lay:
-            f_texc = None
-        col_lay = org_mesh.loops.layers.color.active
-        if not col_lay:
-            f_colr = None
-        dvert_lay = org_mesh.verts.layers.deform.active
-
-        f_lnk1 = [vert[dvert_lay].items() for vert in org_mesh.verts]
-
-        for f in org_mesh.faces:
-            uv = []
-            col = []
-            v_index = []
-            tang = []
-            for loop in f.loops:
-                if f_texc is not None:
-                    uv.append(loop[uv_lay].uv)
-                v_index.append(loop.vert.index)
-                if f_colr is not None:
-                    col.append(loop[col_lay].color)
-                tang.append(loop.calc_tangent())
-            if f_texc is not None:
-                f_texc.append(uv)
-            f_tang.append(tang)
-            faces.append(v_index)
-            if f_colr:
-                f_colr.append(col)
-
-        # duplication
-        if f_texc:
-            # texc = face_to_vertices_dup(faces,f_texc,vert)
-            fsign = calc_face_signs(f_texc)
-            # duplication
-            # sign = face_to_vertices_dup(faces,fsign,vert)
-            sign = face_to_vertices(faces, fsign, vert)
-            # recreate texc data due to duplicated vertices
-            texc = face_to_vertices(faces, f_texc, vert)
-            tang = face_to_vertices(faces, f_tang, vert)
-        # Gram-Schmidt orthogonalize
-        for i in range(len(vert)):
-            # tang[i] = (tang[i] - vert[i].normal * DotVecs(tang[i],vert[i].normal)).normalize()
-            tang[i] = (tang[i] - vert[i].normal * tang[i].dot(vert[i].normal))
-            tang[i].normalize()
-
-        # lnk1 = face_to_vertices(faces,f_lnk1,vert)
-        lnk1 = f_lnk1
-        if f_colr is not None:
-            colr = face_to_vertices(faces, f_colr, vert)
+    with ChunkWriter(filename, b'SMDL') as out:
+        head_pos = out.write_chunk('head', head_data.getvalue())
+        out.write_chunk('bone', bone_data)
+
+        num_meshes, num_tris, bounds, bone_bounds = write_model_data(group_bones, inv_bind, out, mesh_index,
+                                                                     objects, deps_graph, settings, report)
+        out.patch(head_pos + 4, struct.pack("<i", num_meshes))
+        with stage('write'):
+            for surf_index, surf in enumerate(surfs):
+                out.write_chunk('surf', *create_surf_data(surf, surf_index))
+        if bounds is not None:
+            out.patch(head_pos + 20, struct.pack("<6f", *bounds))
+
+    if bone_bounds is not None:
+        bounds_name = os.path.splitext(filename)[0] + '.bounds.json'
+        write_bone_bounds(bounds_name, bone_names, bone_bounds)
+        report.append('bone bounds written to %s' % bounds_name)
+    return num_tris
+
+
+def extract_hull_surf(obj, deps_graph, index):
+    """Convex hull of the evaluated object in world space as a K2Surf."""
+    bm = triangulated_bmesh(obj, deps_graph)
+    try:
+        result = bmesh.ops.convex_hull(bm, input=bm.verts)
+        hull_verts = [ele for ele in result['geom'] if isinstance(ele, bmesh.types.BMVert)]
+        hull_faces = [ele for ele in result['geom'] if isinstance(ele, bmesh.types.BMFace)]
+        bm.verts.index_update()
+        remap = np.full(len(bm.verts), -1, dtype=np.int64)
+        remap[[v.index for v in hull_verts]] = np.arange(len(hull_verts))
+        points = np.array([v.co[:] for v in hull_verts], dtype=np.float64).reshape(-1, 3)
+        # hull faces are convex, fan triangulate them
+        tris = [(f.verts[0].index, f.verts[i].index, f.verts[i + 1].index)
+                for f in hull_faces for i in range(1, len(f.verts) - 1)]
+    finally:
+        bm.free()
+    tris = remap[np.array(tris, dtype=np.int64).reshape(-1, 3)]
+    return hull_surf(points, tris, index, int(obj.get(SURF_FLAGS_PROPERTY, 0)))
+
+
+def write_bone_bounds(filename, bone_names, bone_bounds):
+    bones = {}
+    for name, box in zip(bone_names, bone_bounds.tolist()):
+        if box[0] <= box[3]:
+            bones[name] = {'min': box[:3], 'max': box[3:]}
+    with open(filename, 'w') as file:
+        json.dump({'space': 'bone', 'bones': bones}, file, indent=1)
+
+
+def foreach_array(collection, attr, dtype, width):
+    data = np.empty(len(collection) * width, dtype=dtype)
+    collection.foreach_get(attr, data)
+    return data.reshape(-1, width) if width > 1 else data
+
+
+def vertex_normals(mesh):
+    if hasattr(mesh, 'vertex_normals'):
+        return foreach_array(mesh.vertex_normals, 'vector', np.float32, 3)
+    return foreach_array(mesh.vertices, 'normal', np.float32, 3)
+
+
+def active_colors(mesh):
+    """Active color layer as (domain, (n, 4) sRGB floats) or None."""
+    if not hasattr(mesh, 'color_attributes'):
+        # before Blender 3.2: byte corner colors, read as sRGB
+        layer = mesh.vertex_colors.active
+        return ('CORNER', foreach_array(layer.data, 'color', np.float32, 4)) if layer else None
+    color = mesh.color_attributes.active_color
+    if color is None or color.domain not in ('CORNER', 'POINT'):
+        return None
+    # .color of byte colors is scene linear, K2 stores the sRGB bytes
+    attr = 'color'
+    if color.data_type == 'BYTE_COLOR' and len(color.data) and hasattr(color.data[0], 'color_srgb'):
+        attr = 'color_srgb'
+    return color.domain, foreach_array(color.data, attr, np.float32, 4)
+
+
+def extract_mesh_arrays(obj, bm):
+    # copy the triangulated bmesh into a temporary mesh so everything can be
+    # read in bulk, including MikkTSpace tangents from calc_tangents()
+    mesh = bpy.data.meshes.new('.k2_export')
+    try:
+        bm.to_mesh(mesh)
+        positions = foreach_array(mesh.vertices, 'co', np.float32, 3)
+        normals = vertex_normals(mesh)
+        faces = foreach_array(mesh.loops, 'vertex_index', np.int32, 1).astype(np.int64).reshape(-1, 3)
+
+        data = MeshArrays(obj.name, obj.data.materials[0].name, positions, normals, faces)
+        two_sided = mesh.attributes.get(TWO_SIDED_ATTRIBUTE)
+        if two_sided is not None and two_sided.domain == 'FACE' and two_sided.data_type == 'BOOLEAN':
+            data.two_sided = foreach_array(two_sided.data, 'value', bool, 1)
+        uv_layer = mesh.uv_layers.active
+        if uv_layer:
+            data.corner_uv = foreach_array(uv_layer.data, 'uv', np.float32, 2)
+            mesh.calc_tangents(uvmap=uv_layer.name)
+            data.corner_tang = foreach_array(mesh.loops, 'tangent', np.float32, 3)
+            bitangent_sign = foreach_array(mesh.loops, 'bitangent_sign', np.float32, 1)
+            data.corner_sign = bitangent_signs_to_k2(bitangent_sign)
+            mesh.free_tangents()
+        colors = active_colors(mesh)
+        if colors is not None:
+            domain, colr = colors
+            data.corner_colr = colr if domain == 'CORNER' else colr[faces.ravel()]
+    finally:
+        bpy.data.meshes.remove(mesh)
+    return data
+
+
+def extract_skin_weights(bm, group_bones):
+    dvert_lay = bm.verts.layers.deform.active
+    if not dvert_lay:
+        return skin_weights_from_groups([0] * len(bm.verts), [], [], group_bones)
+    # one (group, weight) tuple list per vertex straight from C, flattened once
+    items = [v[dvert_lay].items() for v in bm.verts]
+    pairs = np.array([pair for vert_items in items for pair in vert_items], dtype=np.float64).reshape(-1, 2)
+    return skin_weights_from_groups(list(map(len, items)), pairs[:, 0], pairs[:, 1], group_bones)
+
+
+def take_vertices(data, order):
+    if data is None or order is None:
+        return data
+    if isinstance(data, SkinWeights):
+        return data.take(order)
+    return data[order]
+
+
+def optimize_vertex_cache(faces, num_verts, cache_pool):
+    # the optimization is pure Python holding the GIL, in worker processes
+    # meshes optimize in parallel while this thread waits without it
+    if cache_pool is not None:
+        try:
+            return cache_pool.submit(optimize_mesh, faces, num_verts).result()
+        except (BrokenProcessPool, OSError) as e:
+            # e.g. a Blender whose sys.executable can't start Python workers
+            vlog('vertex cache optimization in this thread: %s', e)
+    return optimize_mesh(faces, num_verts)
+
+
+def prepare_mesh(data, settings, inv_bind, cache_pool=None):
+    """Builds per vertex attributes, optimizes and splits one mesh.
+
+    :return: list of (name, faces, per vertex attributes, bounds) parts,
+        per bone influence bounds (or None) and report messages
+    """
+    report = []
+    num_verts = len(data.positions)
+    faces = data.faces
+    attrs = {
+        'positions': data.positions,
+        'normals': data.normals,
+        'skin': data.skin,
+        'texc': None,
+        'sign': None,
+        'tang': None,
+        'colr': None,
+    }
+    with stage('geometry'):
+        if data.corner_uv is not None:
+            texc = face_to_vertices(faces, data.corner_uv, num_verts)
+            sign = face_to_vertices(faces, data.corner_sign, num_verts)
+            tang = face_to_vertices(faces, data.corner_tang, num_verts)
+            # Gram-Schmidt orthogonalize against the smooth vertex normal
+            normals = data.normals
+            tang = tang - normals * np.einsum('ij,ij->i', tang, normals)[:, None]
+            length = np.linalg.norm(tang, axis=1)
+            tang /= np.where(length > 0.0, length, 1.0)[:, None]
+            attrs['texc'] = texc
+            attrs['sign'] = sign
+            attrs['tang'] = tang
+        if data.corner_colr is not None:
+            attrs['colr'] = face_to_vertices(faces, data.corner_colr, num_verts)
+    with stage('weights'):
+        if settings.max_influences > 0 or settings.min_weight > 0.0:
+            attrs['skin'], dropped = data.skin.limit(settings.max_influences, settings.min_weight)
+            report.append('%s: dropped %d of %d influences' % (data.name, dropped, len(data.skin.weights)))
+
+        bone_bounds = None
+        if settings.bone_bounds:
+            bone_bounds = attrs['skin'].bone_bounds(data.positions, inv_bind)
+
+    with stage('geometry'):
+        if data.two_sided is not None and data.two_sided.any():
+            # K2 has no two-sided flag, add reversed copies facing the other way
+            back, order = back_faces(faces, data.two_sided, num_verts)
+            attrs = {k: take_vertices(v, np.concatenate([np.arange(num_verts), order])) for k, v in attrs.items()}
+            attrs['normals'][num_verts:] *= -1.0
+            if attrs['sign'] is not None:
+                attrs['sign'][num_verts:] = -1 - attrs['sign'][num_verts:]
+            faces = np.concatenate([faces, back])
+            num_verts = len(attrs['positions'])
+            report.append('%s: %d two-sided faces' % (data.name, len(back)))
+
+        if settings.optimize_cache and len(faces) > 0:
+            face_list, order, acmr, new_acmr = optimize_vertex_cache(faces.tolist(), num_verts, cache_pool)
+            faces = np.array(face_list, dtype=np.int64).reshape(-1, 3)
+            attrs = {k: take_vertices(v, order) for k, v in attrs.items()}
+            report.append('%s: ACMR %.3f -> %.3f' % (data.name, acmr, new_acmr))
+
+        if settings.max_verts > 0 and num_verts > settings.max_verts:
+            parts = []
+            split = split_faces(faces.tolist(), settings.max_verts)
+            for part, (part_faces, order) in enumerate(split):
+                part_attrs = {k: take_vertices(v, order) for k, v in attrs.items()}
+                parts.append(('%s_%d' % (data.name, part), np.array(part_faces, dtype=np.int64), part_attrs,
+                              positions_bounding_box(part_attrs['positions'])))
+            report.append('%s: split into %d meshes' % (data.name, len(parts)))
         else:
-            colr = None
-
-        write_block(file, 'org_mesh', create_mesh_data(org_mesh, vert, mesh_index, obj.name.encode('utf8'),
-                                                       obj.data.materials[0].name.encode('utf8')))
-        write_block(file, 'vrts', create_vrts_data(vert, mesh_index))
-        new_indices = {}
-        print(bone_indices)
-        for group in obj.vertex_groups:
-            new_indices[group.index] = bone_indices.index(group.name)
-        write_block(file, 'lnk1', create_lnk1_data(lnk1, mesh_index, new_indices))
-        if len(faces) > 0:
-            write_block(file, 'face', create_face_data(vert, faces, mesh_index))
-            if f_texc is not None:
-                write_block(file, "texc", create_texc_data(texc, mesh_index))
-                for i in range(len(tang)):
-                    if sign[i] == 0:
-                        tang[i] = -(tang[i].copy())
-                write_block(file, "tang", create_tang_data(tang, mesh_index))
-                write_block(file, "sign", create_sign_data(mesh_index, sign))
-            write_block(file, "nrml", create_nrml_data(vert, mesh_index))
-        if f_colr is not None:
-            write_block(file, "colr", create_colr_data(colr, mesh_index))
-        mesh_index += 1
-        vlog('total vertices duplicated: %d' % (len(vert) - len(org_mesh.verts)))
\ No newline at end of file
+            parts = [(data.name, faces, attrs, positions_bounding_box(attrs['positions']))]
+    return parts, bone_bounds, report
+
+
+def encode_mesh_part(part, mesh_index, data):
+    with stage('write'):
+        return encode_mesh_chunks(part, mesh_index, data)
+
+
+def encode_mesh_chunks(part, mesh_index, data):
+    name, faces, attrs, bounds = part
+    positions = attrs['positions']
+    chunks = [
+        ('mesh', [create_mesh_data(bounds, len(positions), mesh_index, name.encode('utf8'),
+                                   data.material.encode('utf8'))]),
+        ('vrts', create_vrts_data(positions, mesh_index)),
+        ('lnk1', create_lnk1_data(attrs['skin'], mesh_index)),
+    ]
+    if len(faces) > 0:
+        chunks.append(('face', create_face_data(positions, faces, mesh_index)))
+        if attrs['texc'] is not None:
+            chunks.append(("texc", create_texc_data(flip_uv(attrs['texc']), mesh_index)))
+            chunks.append(("tang", create_tang_data(attrs['tang'], mesh_index)))
+            chunks.append(("sign", create_sign_data(mesh_index, attrs['sign'])))
+        chunks.append(("nrml", create_nrml_data(attrs['normals'], mesh_index)))
+    if attrs['colr'] is not None:
+        chunks.append(("colr", create_colr_data(attrs['colr'], mesh_index)))
+    return chunks
+
+
+class EncodedMesh:
+    # encoded chunks of one object; cached entries hold joined payloads and
+    # are written again under other mesh indices
+    def __init__(self, parts, bone_bounds, messages, num_tris):
+        self.parts = parts  # (bounds or None for empty parts, [(chunk name, pieces or payload)])
+        self.bone_bounds = bone_bounds
+        self.messages = messages
+        self.num_tris = num_tris
+
+    def nbytes(self):
+        return sum(len(payload) for bounds, chunks in self.parts for name, payload in chunks)
+
+
+def rna_state(struct_value):
+    # comparable values of all properties, ID pointers by name
+    values = []
+    for prop in struct_value.bl_rna.properties:
+        if prop.identifier == 'rna_type' or prop.type == 'COLLECTION':
+            continue
+        value = getattr(struct_value, prop.identifier)
+        if prop.type == 'POINTER':
+            value = getattr(value, 'name_full', None)
+        elif isinstance(value, set):
+            value = sorted(value)
+        elif getattr(prop, 'is_array', False):
+            value = tuple(value)
+        values.append((prop.identifier, value))
+    return values
+
+
+def mesh_fingerprint(obj, deps_graph, settings, group_bones, inv_bind):
+    """Hash of everything the encoded chunks of obj depend on.
+
+    Covers the evaluated mesh (positions, topology, UVs, smooth and sharp
+    flags, normals, colors and vertex group weights), the modifier
+    stack, vertex groups, transform, material and the export settings.
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    mesh = obj.evaluated_get(deps_graph).data if deps_graph is not None else obj.data
+    state = [obj.name, obj.data.materials[0].name if obj.data.materials else None,
+             [tuple(row) for row in obj.matrix_world], settings.output_key(), sorted(group_bones.items()),
+             [group.name for group in obj.vertex_groups], [rna_state(mod) for mod in obj.modifiers]]
+    digest.update(repr(state).encode('utf8'))
+    if settings.bone_bounds:
+        digest.update(np.ascontiguousarray(inv_bind).tobytes())
+    digest.update(foreach_array(mesh.vertices, 'co', np.float32, 3).tobytes())
+    digest.update(foreach_array(mesh.polygons, 'loop_total', np.int32, 1).tobytes())
+    digest.update(foreach_array(mesh.loops, 'vertex_index', np.int32, 1).tobytes())
+    if mesh.uv_layers.active:
+        digest.update(foreach_array(mesh.uv_layers.active.data, 'uv', np.float32, 2).tobytes())
+    # tangents and signs follow the loop normals
+    digest.update(foreach_array(mesh.polygons, 'use_smooth', bool, 1).tobytes())
+    digest.update(foreach_array(mesh.edges, 'use_edge_sharp', bool, 1).tobytes())
+    digest.update(repr((getattr(mesh, 'use_auto_smooth', None), getattr(mesh, 'auto_smooth_angle', None),
+                        mesh.has_custom_normals)).encode('utf8'))
+    digest.update(vertex_normals(mesh).tobytes())
+    if hasattr(mesh, 'corner_normals'):
+        # Blender 4.1+, readable without computing them into the mesh
+        digest.update(foreach_array(mesh.corner_normals, 'vector', np.float32, 3).tobytes())
+    two_sided = mesh.attributes.get(TWO_SIDED_ATTRIBUTE)
+    if two_sided is not None and two_sided.domain == 'FACE' and two_sided.data_type == 'BOOLEAN':
+        digest.update(foreach_array(two_sided.data, 'value', bool, 1).tobytes())
+    colors = active_colors(mesh)
+    if colors is not None:
+        digest.update(colors[0].encode('utf8'))
+        digest.update(colors[1].tobytes())
+    if obj.vertex_groups:
+        # the weights as exported, through the same deform layer read
+        bm = bmesh.new()
+        try:
+            bm.from_mesh(mesh)
+            skin = extract_skin_weights(bm, group_bones)
+        finally:
+            bm.free()
+        for array in (skin.offsets, skin.bones, skin.weights):
+            digest.update(array.tobytes())
+    return digest.digest()
+
+
+def write_prepared_mesh(out, pool, mesh_index, data, prepared, key, boxes, bone_boxes):
+    if isinstance(prepared, EncodedMesh):
+        return write_encoded_mesh(out, mesh_index, prepared, boxes, bone_boxes)
+    parts, bone_bounds, messages = prepared.result()
+    for msg in messages:
+        log(msg)
+    # mesh indices are only known once the previous meshes are split
+    encoded = []
+    for part in parts:
+        bounds = part[3] if len(part[2]['positions']) > 0 else None
+        encoded.append((bounds, pool.submit(encode_mesh_part, part, mesh_index + len(encoded), data)))
+    written = []
+    for bounds, future in encoded:
+        chunks = future.result()
+        if key is not None:
+            chunks = [(name, b''.join(pieces)) for name, pieces in chunks]
+        written.append((bounds, chunks))
+    entry = EncodedMesh(written, bone_bounds, messages, len(data.faces))
+    if key is not None:
+        mesh_cache.put(key, entry, entry.nbytes())
+    return write_encoded_mesh(out, mesh_index, entry, boxes, bone_boxes)
+
+
+def write_encoded_mesh(out, mesh_index, entry, boxes, bone_boxes):
+    if entry.bone_bounds is not None:
+        bone_boxes.append(entry.bone_bounds)
+    with stage('write'):
+        for bounds, chunks in entry.parts:
+            if bounds is not None:
+                boxes.append(bounds)
+            for name, pieces in chunks:
+                if isinstance(pieces, bytes):
+                    # joined payload, every chunk starts with the mesh index
+                    out.write_chunk(name, struct.pack("<i", mesh_index), memoryview(pieces)[4:])
+                else:
+                    out.write_chunk(name, *pieces)
+            mesh_index += 1
+    return mesh_index, entry.messages
+
+
+def write_model_data(group_bones, inv_bind, out, mesh_index, objects, deps_graph, settings, report):
+    """Writes mesh chunks of all objects.
+
+    Objects whose mesh_fingerprint is in mesh_cache are written from the
+    cached chunks without being extracted or encoded again.
+
+    :return: number of written meshes and triangles, overall bounding box
+        and per bone influence bounds (or None)
+    """
+    num_tris = 0
+    reused = 0
+    boxes = []
+    bone_boxes = []
+    workers = settings.threads or os.cpu_count() or 1
+    # vertex cache optimization needs processes to run in parallel, spawned
+    # ones since forking a multithreaded Blender is not safe
+    if settings.optimize_cache and workers > 1 and len(objects) > 1:
+        processes = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'))
+    else:
+        processes = nullcontext()
+    with ThreadPoolExecutor(max_workers=workers) as pool, processes as cache_pool:
+        pending = deque()
+        for obj in objects:
+            # bpy data is only touched here, on the main thread
+            key = None
+            entry = None
+            if settings.use_cache:
+                with stage('fingerprint'):
+                    key = mesh_fingerprint(obj, deps_graph, settings, group_bones[obj.name], inv_bind)
+                entry = mesh_cache.get(key)
+            if entry is not None:
+                reused += 1
+                num_tris += entry.num_tris
+                pending.append((None, entry, None))
+            else:
+                with stage('geometry'):
+                    bm = triangulated_bmesh(obj, deps_graph)
+                    data = extract_mesh_arrays(obj, bm)
+                with stage('weights'):
+                    data.skin = extract_skin_weights(bm, group_bones[obj.name])
+                bm.free()
+                num_tris += len(data.faces)
+                pending.append((data, pool.submit(prepare_mesh, data, settings, inv_bind, cache_pool), key))
+            # only keep as many meshes in memory as there are workers
+            if len(pending) > workers:
+                mesh_index, messages = write_prepared_mesh(out, pool, mesh_index, *pending.popleft(), boxes,
+                                                           bone_boxes)
+                report += messages
+        while pending:
+            mesh_index, messages = write_prepared_mesh(out, pool, mesh_index, *pending.popleft(), boxes, bone_boxes)
+            report += messages
+    if settings.use_cache:
+        msg = '%d of %d meshes reused from the export cache (%.1f MiB cached)' % (
+            reused, len(objects), mesh_cache.nbytes / (1024.0 * 1024.0))
+        log(msg)
+        report.append(msg)
+
+    bounds = merge_bounding_boxes(boxes).tolist() if boxes else None
+    bone_bounds = None
+    if settings.bone_bounds:
+        bone_bounds = merge_bounding_boxes([empty_bounding_boxes(len(inv_bind))] + bone_boxes)
+    return mesh_index, num_tris, bounds, bone_bounds
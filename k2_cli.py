@@ -0,0 +1,427 @@
+"""Command line batch conversion and validation.
+
+Export every .blend below a directory, each file in its own headless Blender:
+
+    python k2_cli.py export assets/ --out build/ --jobs 8 --clips actions
+    blender -b --python k2_cli.py -- export assets/ --jobs 8
+
+Validate .model/.clip files, bpy-free (--reimport additionally imports every
+model into a headless Blender):
+
+    python k2_cli.py validate build/ --jobs 8 --json report.json
+
+Convert models to glTF binaries, bpy-free (--clips adds every .clip next to
+or below the model as an animation):
+
+    python k2_cli.py gltf heroes/ --out web/ --clips --jobs 8
+
+Index headers (bones, meshes, materials, animated bones) into SQLite and
+query it, re-runs only read changed files:
+
+    python k2_cli.py index assets/ --db assets.db --jobs 8
+    python k2_cli.py query --db assets.db --clips-animating Bip01_Head
+"""
+
+import argparse
+import importlib
+import importlib.util
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPT = os.path.abspath(__file__)
+
+
+def find_files(paths, extensions):
+    files = []
+    for path in paths:
+        if os.path.isfile(path):
+            files.append(path)
+            continue
+        for root, dirs, names in os.walk(path):
+            dirs.sort()
+            files.extend(os.path.join(root, name) for name in sorted(names)
+                         if name.lower().endswith(extensions))
+    return files
+
+
+def blender_binary(path=None):
+    if path:
+        return path
+    if 'BLENDER' in os.environ:
+        return os.environ['BLENDER']
+    try:
+        import bpy
+        return bpy.app.binary_path
+    except ImportError:
+        return 'blender'
+
+
+def run_blender(blender, args, filename, timeout):
+    """Runs one headless Blender worker and returns its result dict."""
+    fd, result_name = tempfile.mkstemp(prefix='k2_cli_', suffix='.json')
+    os.close(fd)
+    cmd = [blender, '-b', '--factory-startup'] + args[0] + \
+          ['--python-exit-code', '1', '--python', SCRIPT, '--'] + args[1] + ['--result', result_name]
+    start = time.perf_counter()
+    try:
+        proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True,
+                              timeout=timeout)
+        output = proc.stdout
+        returncode = proc.returncode
+    except subprocess.TimeoutExpired as e:
+        output = e.stdout or ''
+        returncode = 'timeout'
+    except OSError as e:
+        output = str(e)
+        returncode = 'failed to start'
+    try:
+        with open(result_name) as file:
+            result = json.load(file)
+    except ValueError:
+        # the worker died before writing its result
+        result = {'ok': False, 'messages': ['worker exited with %s' % returncode] + output.splitlines()[-10:]}
+    finally:
+        os.remove(result_name)
+    if returncode != 0 and result['ok']:
+        result['ok'] = False
+        result['messages'].append('worker exited with %s' % returncode)
+    result['file'] = filename
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+
+def summarize(command, results, seconds, json_name):
+    failed = [result for result in results if not result['ok']]
+    for result in results:
+        print('%s %s (%.2fs)' % ('ok    ' if result['ok'] else 'FAILED', result['file'], result['seconds']))
+        for msg in result['messages']:
+            print('    %s' % msg)
+    print('%s: %d files, %d ok, %d failed, %.2fs wall, %.2fs in workers' % (
+        command, len(results), len(results) - len(failed), len(failed), seconds,
+        sum(result['seconds'] for result in results)))
+    if json_name:
+        with open(json_name, 'w') as file:
+            json.dump({'command': command, 'seconds': seconds, 'failed': len(failed), 'results': results}, file,
+                      indent=1)
+    return 1 if failed else 0
+
+
+def write_result(args, ok, messages):
+    if args.result:
+        with open(args.result, 'w') as file:
+            json.dump({'ok': ok, 'messages': messages}, file)
+    return 0 if ok else 1
+
+
+##############################
+# export
+##############################
+
+def cmd_export(args):
+    blends = find_files(args.paths, ('.blend',))
+    blender = blender_binary(args.blender)
+    jobs = []
+    for blend in blends:
+        out_dir = os.path.dirname(os.path.abspath(blend))
+        if args.out:
+            roots = [os.path.abspath(path) for path in args.paths if os.path.isdir(path)]
+            root = next((root for root in roots if os.path.commonpath([root, out_dir]) == root), out_dir)
+            rel = os.path.relpath(out_dir, root)
+            out_dir = os.path.normpath(os.path.join(args.out, rel))
+        worker_args = ['export-blend', '--out', out_dir, '--clips', args.clips,
+                       '--max-influences', str(args.max_influences), '--lods', args.lods]
+        if args.no_modifiers:
+            worker_args.append('--no-modifiers')
+        jobs.append(([os.path.abspath(blend)], worker_args, blend))
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max(args.jobs, 1)) as pool:
+        results = list(pool.map(lambda job: run_blender(blender, job[:2], job[2], args.timeout), jobs))
+    return summarize('export', results, time.perf_counter() - start, args.json)
+
+
+def cmd_export_blend(args):
+    # runs inside Blender with the .blend file loaded
+    import bpy
+    from .export_k2_clip import export_k2_clips
+    from .export_k2_mesh import export_k2_mesh
+
+    messages = []
+    try:
+        os.makedirs(args.out, exist_ok=True)
+        stem = os.path.splitext(os.path.basename(bpy.data.filepath))[0]
+        objects = bpy.context.view_layer.objects
+        meshes = [obj for obj in objects if obj.type == 'MESH']
+        armatures = [obj for obj in objects if obj.type == 'ARMATURE']
+        if len(armatures) > 1:
+            messages.append('%d armatures, using %s' % (len(armatures), armatures[0].name))
+        rig = armatures[:1]
+        apply_mods = not args.no_modifiers
+
+        for obj in objects:
+            obj.select_set(obj in meshes or obj in rig)
+        if meshes:
+            filename = os.path.join(args.out, stem + '.model')
+            messages += export_k2_mesh(bpy.context, filename, apply_mods, max_influences=args.max_influences,
+                                       lods=args.lods)
+            messages.append('wrote %s' % filename)
+        if rig and args.clips != 'none':
+            for obj in objects:
+                obj.select_set(obj in rig)
+            messages += export_k2_clips(args.out, apply_mods, args.clips.upper())
+    except Exception as e:
+        return write_result(args, False, messages + ['%s: %s' % (type(e).__name__, e)])
+    return write_result(args, True, messages)
+
+
+##############################
+# validate
+##############################
+
+def validate_file(filename):
+    from .k2_reader import read_model, read_clip, validate_model, validate_clip
+
+    start = time.perf_counter()
+    try:
+        if filename.lower().endswith('.clip'):
+            clip = read_clip(filename)
+            problems = validate_clip(clip)
+            info = '%d bones, %d frames' % (clip.num_bones, clip.num_frames)
+        else:
+            model = read_model(filename)
+            problems = validate_model(model)
+            info = '%d meshes, %d vertices, %d triangles, %d bones' % (
+                len(model.meshes), sum(len(mesh.positions) for mesh in model.meshes if mesh.positions is not None),
+                sum(len(mesh.faces) for mesh in model.meshes if mesh.faces is not None), len(model.bone_names))
+    except Exception as e:
+        problems = ['%s: %s' % (type(e).__name__, e)]
+        info = None
+    return {'file': filename, 'ok': not problems, 'seconds': time.perf_counter() - start,
+            'messages': ([info] if info else []) + problems}
+
+
+def cmd_validate(args):
+    files = find_files(args.paths, ('.model', '.clip'))
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max(args.jobs, 1)) as pool:
+        results = list(pool.map(validate_file, files, chunksize=8))
+    if args.reimport:
+        blender = blender_binary(args.blender)
+        models = [result for result in results if result['file'].lower().endswith('.model')]
+        with ThreadPoolExecutor(max(args.jobs, 1)) as pool:
+            imports = pool.map(lambda result: run_blender(blender, ([], ['import-model', result['file']]),
+                                                          result['file'], args.timeout), models)
+            for result, imported in zip(models, imports):
+                result['ok'] = result['ok'] and imported['ok']
+                result['seconds'] += imported['seconds']
+                result['messages'] += ['reimport: %s' % msg for msg in imported['messages']]
+    return summarize('validate', results, time.perf_counter() - start, args.json)
+
+
+def imported_vertex_count(mesh):
+    # the importer merges two-sided faces and drops the vertices only their
+    # back copies used
+    from .two_sided import find_two_sided, drop_faces
+
+    if mesh.positions is None:
+        return 0
+    if mesh.faces is None or len(mesh.faces) == 0:
+        return len(mesh.positions)
+    normals = mesh.normals if mesh.normals is not None and len(mesh.normals) == len(mesh.positions) else None
+    keep, two_sided = find_two_sided(mesh.positions, mesh.faces, normals)
+    return len(drop_faces(mesh.faces, keep, len(mesh.positions))[1])
+
+
+def cmd_import_model(args):
+    # runs inside Blender, imports a model into the empty factory scene and
+    # compares it with the bpy-free decoding
+    import bpy
+    from .create_blender_mesh import create_blender_mesh
+    from .k2_reader import read_model
+
+    try:
+        # the factory startup file has a default cube
+        bpy.ops.wm.read_factory_settings(use_empty=True)
+        model = read_model(args.file)
+        create_blender_mesh(args.file, os.path.splitext(os.path.basename(args.file))[0], True)
+        messages = []
+        meshes = [obj for obj in bpy.data.objects if obj.type == 'MESH' and obj.users_collection]
+        imported_verts = sum(len(obj.data.vertices) for obj in meshes)
+        expected_verts = sum(imported_vertex_count(mesh) for mesh in model.meshes) + \
+            sum(len(surf.points) for surf in model.surfs)
+        if imported_verts != expected_verts:
+            messages.append('%d vertices imported, file has %d' % (imported_verts, expected_verts))
+        armatures = [arm for arm in bpy.data.armatures if arm.users]
+        imported_bones = sum(len(arm.bones) for arm in armatures)
+        if imported_bones != len(model.bone_names):
+            messages.append('%d bones imported, file has %d' % (imported_bones, len(model.bone_names)))
+    except Exception as e:
+        return write_result(args, False, ['%s: %s' % (type(e).__name__, e)])
+    return write_result(args, not messages, messages)
+
+
+##############################
+# gltf
+##############################
+
+def convert_file(job):
+    from .k2_gltf import convert_to_glb
+
+    filename, out, clips, fps = job
+    start = time.perf_counter()
+    try:
+        os.makedirs(os.path.dirname(out) or '.', exist_ok=True)
+        messages = convert_to_glb(filename, clips, out, fps)
+        ok = True
+    except Exception as e:
+        messages = ['%s: %s' % (type(e).__name__, e)]
+        ok = False
+    return {'file': filename, 'ok': ok, 'seconds': time.perf_counter() - start, 'messages': messages}
+
+
+def cmd_gltf(args):
+    jobs = []
+    for model in find_files(args.paths, ('.model',)):
+        directory = os.path.dirname(os.path.abspath(model))
+        clips = find_files([directory], ('.clip',)) if args.clips else []
+        out = os.path.splitext(model)[0] + '.glb'
+        if args.out:
+            roots = [os.path.abspath(path) for path in args.paths if os.path.isdir(path)]
+            root = next((root for root in roots if os.path.commonpath([root, directory]) == root), directory)
+            out = os.path.join(args.out, os.path.relpath(os.path.abspath(out), root))
+        jobs.append((model, out, clips, args.fps))
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max(args.jobs, 1)) as pool:
+        results = list(pool.map(convert_file, jobs))
+    return summarize('gltf', results, time.perf_counter() - start, args.json)
+
+
+##############################
+# index
+##############################
+
+def cmd_index(args):
+    from .k2_index import index_directory
+
+    stats = index_directory(args.db, args.paths, args.jobs)
+    print('index: %(files)d files, %(indexed)d indexed, %(skipped)d unchanged, %(removed)d removed, '
+          '%(failed)d failed, %(seconds).2fs' % stats)
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(stats, file, indent=1)
+    return 1 if stats['failed'] else 0
+
+
+def cmd_query(args):
+    from .k2_index import K2Index
+
+    with K2Index(args.db) as index:
+        if args.clips_animating:
+            paths = index.clips_animating(args.clips_animating)
+        elif args.material:
+            paths = index.models_using_material(args.material)
+        elif args.models_with_bone:
+            paths = index.models_with_bone(args.models_with_bone)
+        else:
+            paths = index.clips_for_skeleton(index.bone_names(args.clips_for_model))
+    for path in paths:
+        print(path)
+    return 0
+
+
+def main(argv=None):
+    if argv is None:
+        # Blender passes the script arguments after '--'
+        argv = sys.argv[sys.argv.index('--') + 1:] if '--' in sys.argv else sys.argv[1:]
+    parser = argparse.ArgumentParser(prog='k2_cli', description='K2 model/clip batch tools')
+    sub = parser.add_subparsers(dest='command')
+    sub.required = True
+
+    p = sub.add_parser('export', help='export every .blend below the given paths')
+    p.add_argument('paths', nargs='+')
+    p.add_argument('--out', help='output directory, mirrors the input tree (default: next to the .blend)')
+    p.add_argument('--clips', choices=('none', 'actions', 'nla'), default='actions')
+    p.add_argument('--max-influences', type=int, default=0, help='bones per vertex, 0 keeps all of them')
+    p.add_argument('--lods', default='', help='LOD levels, e.g. "0.5, 0.25"')
+    p.add_argument('--no-modifiers', action='store_true')
+    p.set_defaults(func=cmd_export)
+
+    p = sub.add_parser('validate', help='decode and check .model/.clip files')
+    p.add_argument('paths', nargs='+')
+    p.add_argument('--reimport', action='store_true', help='also import every model in headless Blender')
+    p.set_defaults(func=cmd_validate)
+
+    p = sub.add_parser('gltf', help='convert .model files (and their clips) to .glb')
+    p.add_argument('paths', nargs='+')
+    p.add_argument('--out', help='output directory, mirrors the input tree (default: next to the .model)')
+    p.add_argument('--clips', action='store_true', help='add the .clip files next to or below each model')
+    p.add_argument('--fps', type=float, default=30.0, help='clip frame rate')
+    p.set_defaults(func=cmd_gltf)
+
+    p = sub.add_parser('index', help='index .model/.clip headers into a SQLite database')
+    p.add_argument('paths', nargs='+')
+    p.add_argument('--db', required=True)
+    p.set_defaults(func=cmd_index)
+
+    for p in sub.choices.values():
+        p.add_argument('--jobs', '-j', type=int, default=os.cpu_count() or 1, help='worker processes')
+        p.add_argument('--blender', help='Blender executable (default: $BLENDER or blender)')
+        p.add_argument('--timeout', type=float, default=None, help='seconds per Blender worker')
+        p.add_argument('--json', help='write the summary report as JSON')
+
+    p = sub.add_parser('query',
+                       help='look up files in an index database, bone and material patterns use SQL LIKE wildcards')
+    p.add_argument('--db', required=True)
+    group = p.add_mutually_exclusive_group(required=True)
+    group.add_argument('--clips-animating', metavar='BONE')
+    group.add_argument('--material', help='models with a mesh using this material')
+    group.add_argument('--models-with-bone', metavar='BONE')
+    group.add_argument('--clips-for-model', metavar='MODEL',
+                       help='clips that only animate bones of this model, an exact indexed path (no wildcards)')
+    p.set_defaults(func=cmd_query)
+
+    # workers, run inside Blender
+    p = sub.add_parser('export-blend')
+    p.add_argument('--out', required=True)
+    p.add_argument('--clips', choices=('none', 'actions', 'nla'), default='actions')
+    p.add_argument('--max-influences', type=int, default=0)
+    p.add_argument('--lods', default='')
+    p.add_argument('--no-modifiers', action='store_true')
+    p.add_argument('--result')
+    p.set_defaults(func=cmd_export_blend)
+
+    p = sub.add_parser('import-model')
+    p.add_argument('file')
+    p.add_argument('--result')
+    p.set_defaults(func=cmd_import_model)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+def load_package():
+    # python k2_cli.py / blender --python k2_cli.py run this file as a plain
+    # script, import the add-on directory as a package so the relative
+    # imports work whatever the directory is called
+    sys.path.insert(0, os.path.dirname(PACKAGE_DIR))
+    name = os.path.basename(PACKAGE_DIR)
+    if not name.isidentifier():
+        name = 'k2_addon'
+        spec = importlib.util.spec_from_file_location(name, os.path.join(PACKAGE_DIR, '__init__.py'),
+                                                      submodule_search_locations=[PACKAGE_DIR])
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        spec.loader.exec_module(module)
+    return importlib.import_module(name + '.k2_cli')
+
+
+if __name__ == '__main__':
+    if __package__:
+        sys.exit(main())
+    sys.exit(load_package().main())
@@ -18,19 +18,6 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
 # IN THE SOFTWARE.
 
-# determines the verbosity of loggin.
-#   0 - no logging (fatal errors are still printed)
-#   1 - standard logging
-#   2 - verbose logging
-#   3 - debug level. really boring (stuff like vertex data and verbatim lines)
-
-from .export_k2_clip import IMPORT_LOG_LEVEL
-
-
-def dlog(msg):
-    if IMPORT_LOG_LEVEL >= 3:
-        print(msg)
-
 
 def face_to_vertices_dup(faces, fdata, verts):
     v_data = [None] * len(verts)
@@ -44,11 +31,3 @@ def face_to_vertices_dup(faces, fdata, verts):
                 faces[fi][vi] = new_ind
                 v_data.append(fdata[fi][vi])
     return v_data
-
-
-##############################
-# CLIPS
-##############################
-
-MKEY_X, MKEY_Y, MKEY_Z, MKEY_PITCH, MKEY_ROLL, MKEY_YAW, MKEY_VISIBILITY, MKEY_SCALE_X, MKEY_SCALE_Y, MKEY_SCALE_Z, MKEY_COUNT = range(11)
-
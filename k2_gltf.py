@@ -0,0 +1,300 @@
+# bpy-free conversion of K2 .model/.clip files to glTF 2.0 binary (.glb),
+# straight from the k2_reader arrays.
+#
+# K2 is Z up like Blender, the root node rotates the scene to glTF's Y up.
+# Clip keys are bone transforms relative to the parent bone,
+# translation @ YXZ euler @ scale, the same way the clip importer reads them.
+# Visibility keys have no glTF equivalent and are dropped, so are surfs and
+# sprites.
+
+import json
+import os
+import struct
+
+import numpy as np
+
+from .k2_reader import read_model, read_clip, MKEY_X, MKEY_Y, MKEY_Z, MKEY_PITCH, MKEY_ROLL, MKEY_YAW, \
+    MKEY_SCALE_X, MKEY_SCALE_Y, MKEY_SCALE_Z
+
+FLOAT, UNSIGNED_BYTE, UNSIGNED_SHORT, UNSIGNED_INT = 5126, 5121, 5123, 5125
+ARRAY_BUFFER, ELEMENT_ARRAY_BUFFER = 34962, 34963
+COMPONENTS = {'SCALAR': 1, 'VEC2': 2, 'VEC3': 3, 'VEC4': 4, 'MAT4': 16}
+DTYPES = {FLOAT: '<f4', UNSIGNED_BYTE: 'u1', UNSIGNED_SHORT: '<u2', UNSIGNED_INT: '<u4'}
+
+# -90 degrees around X, Z up -> Y up
+Z_UP_TO_Y_UP = [-0.5 ** 0.5, 0.0, 0.0, 0.5 ** 0.5]
+
+
+def quaternion_multiply(a, b):
+    # (..., 4) xyzw
+    ax, ay, az, aw = np.moveaxis(a, -1, 0)
+    bx, by, bz, bw = np.moveaxis(b, -1, 0)
+    return np.stack([aw * bx + ax * bw + ay * bz - az * by,
+                     aw * by - ax * bz + ay * bw + az * bx,
+                     aw * bz + ax * by - ay * bx + az * bw,
+                     aw * bw - ax * bx - ay * by - az * bz], axis=-1)
+
+
+def euler_yxz_to_quaternions(euler):
+    """(..., 3) radians around X, Y, Z -> (..., 4) xyzw quaternions.
+
+    Y is applied first, then X, then Z, like mathutils.Euler(euler, 'YXZ').
+    """
+    half = 0.5 * np.asarray(euler, dtype=np.float64)
+    c = np.cos(half)
+    s = np.sin(half)
+    zero = np.zeros_like(c[..., 0])
+    qx = np.stack([s[..., 0], zero, zero, c[..., 0]], axis=-1)
+    qy = np.stack([zero, s[..., 1], zero, c[..., 1]], axis=-1)
+    qz = np.stack([zero, zero, s[..., 2], c[..., 2]], axis=-1)
+    return quaternion_multiply(qz, quaternion_multiply(qx, qy))
+
+
+def matrices_to_quaternions(m):
+    """(..., 3, 3) rotation matrices -> (..., 4) xyzw quaternions."""
+    m = np.asarray(m, dtype=np.float64)
+    m00, m11, m22 = m[..., 0, 0], m[..., 1, 1], m[..., 2, 2]
+    trace = m00 + m11 + m22
+    # pick the numerically largest of w, x, y, z to divide by
+    candidates = np.stack([trace, m00, m11, m22], axis=-1)
+    case = np.argmax(candidates, axis=-1)
+    r = np.sqrt(np.maximum(1.0 + 2.0 * np.max(candidates, axis=-1) - trace, 1e-12))
+    q = np.empty(m.shape[:-2] + (4,))
+    for i, (x, y, z, w) in enumerate((
+            (m[..., 2, 1] - m[..., 1, 2], m[..., 0, 2] - m[..., 2, 0], m[..., 1, 0] - m[..., 0, 1], r * r),
+            (r * r, m[..., 0, 1] + m[..., 1, 0], m[..., 0, 2] + m[..., 2, 0], m[..., 2, 1] - m[..., 1, 2]),
+            (m[..., 0, 1] + m[..., 1, 0], r * r, m[..., 1, 2] + m[..., 2, 1], m[..., 0, 2] - m[..., 2, 0]),
+            (m[..., 0, 2] + m[..., 2, 0], m[..., 1, 2] + m[..., 2, 1], r * r, m[..., 1, 0] - m[..., 0, 1]))):
+        select = case == i
+        q[select] = (np.stack([x, y, z, w], axis=-1) / (2.0 * r[..., None]))[select]
+    return q / np.linalg.norm(q, axis=-1, keepdims=True)
+
+
+def continuous_quaternions(q):
+    # flips keys onto the hemisphere of the previous key so linear
+    # interpolation takes the short way
+    if len(q) < 2:
+        return q
+    signs = np.where(np.einsum('ij,ij->i', q[1:], q[:-1]) < 0.0, -1.0, 1.0)
+    return q * np.concatenate([[1.0], np.cumprod(signs)])[:, None]
+
+
+def decompose(matrices):
+    """(..., 4, 4) -> translation, xyzw rotation, scale."""
+    scale = np.linalg.norm(matrices[..., :3, :3], axis=-2)
+    rotation = matrices[..., :3, :3] / np.where(scale > 0.0, scale, 1.0)[..., None, :]
+    return matrices[..., :3, 3], matrices_to_quaternions(rotation), scale
+
+
+class GlbWriter:
+    """Collects glTF JSON and one binary buffer."""
+
+    def __init__(self):
+        self.gltf = {'asset': {'version': '2.0', 'generator': 'K2 glTF converter'}, 'scenes': [{'nodes': [0]}],
+                     'scene': 0, 'nodes': [], 'buffers': [], 'bufferViews': [], 'accessors': []}
+        self.blob = bytearray()
+
+    def add(self, key, item):
+        self.gltf.setdefault(key, []).append(item)
+        return len(self.gltf[key]) - 1
+
+    def accessor(self, array, component_type, kind, target=None, bounds=False, normalized=False):
+        data = np.ascontiguousarray(array, dtype=DTYPES[component_type])
+        self.blob.extend(b'\0' * (-len(self.blob) % 4))
+        view = {'buffer': 0, 'byteOffset': len(self.blob), 'byteLength': data.nbytes}
+        if target is not None:
+            view['target'] = target
+        self.blob.extend(data.tobytes())
+        item = {'bufferView': self.add('bufferViews', view), 'componentType': component_type,
+                'count': len(data), 'type': kind}
+        if normalized:
+            item['normalized'] = True
+        if bounds:
+            flat = data.reshape(len(data), COMPONENTS[kind])
+            item['min'] = flat.min(axis=0).tolist()
+            item['max'] = flat.max(axis=0).tolist()
+        return self.add('accessors', item)
+
+    def write(self, filename):
+        self.blob.extend(b'\0' * (-len(self.blob) % 4))
+        self.gltf['buffers'] = [{'byteLength': len(self.blob)}]
+        text = json.dumps(self.gltf, separators=(',', ':')).encode('utf8')
+        text += b' ' * (-len(text) % 4)
+        with open(filename, 'wb') as file:
+            file.write(struct.pack('<4sII', b'glTF', 2, 12 + 8 + len(text) + 8 + len(self.blob)))
+            file.write(struct.pack('<I4s', len(text), b'JSON'))
+            file.write(text)
+            file.write(struct.pack('<I4s', len(self.blob), b'BIN\0'))
+            file.write(self.blob)
+
+
+def skin_attributes(mesh, num_verts):
+    """JOINTS_n/WEIGHTS_n arrays, four influences per set.
+
+    Meshes without links but a bone link are bound rigidly to that bone.
+    """
+    if mesh.skin is not None and len(mesh.skin.bones):
+        skin = mesh.skin
+        counts = skin.counts()
+        rows = skin.rows()
+        slot = np.arange(len(rows)) - np.repeat(skin.offsets[:-1], counts)
+        width = -(-int(counts.max()) // 4) * 4
+        joints = np.zeros((num_verts, width), dtype=np.int64)
+        weights = np.zeros((num_verts, width))
+        joints[rows, slot] = skin.bones
+        weights[rows, slot] = skin.weights
+    elif mesh.bone_link >= 0:
+        joints = np.zeros((num_verts, 4), dtype=np.int64)
+        joints[:, 0] = mesh.bone_link
+        weights = np.zeros((num_verts, 4))
+        weights[:, 0] = 1.0
+    else:
+        return None
+    total = weights.sum(axis=1, keepdims=True)
+    weights = np.where(total > 0.0, weights / np.where(total > 0.0, total, 1.0), weights)
+    return joints, weights
+
+
+def add_mesh(writer, mesh, materials):
+    num_verts = len(mesh.positions)
+    attributes = {'POSITION': writer.accessor(mesh.positions, FLOAT, 'VEC3', ARRAY_BUFFER, bounds=True)}
+    if mesh.normals is not None:
+        normals = mesh.normals / np.maximum(np.linalg.norm(mesh.normals, axis=1, keepdims=True), 1e-12)
+        attributes['NORMAL'] = writer.accessor(normals, FLOAT, 'VEC3', ARRAY_BUFFER)
+    if mesh.texc is not None:
+        # K2 and glTF both put the UV origin at the top left
+        attributes['TEXCOORD_0'] = writer.accessor(mesh.texc, FLOAT, 'VEC2', ARRAY_BUFFER)
+    if mesh.colr is not None:
+        attributes['COLOR_0'] = writer.accessor(mesh.colr, UNSIGNED_BYTE, 'VEC4', ARRAY_BUFFER, normalized=True)
+    skin = skin_attributes(mesh, num_verts)
+    if skin is not None:
+        joints, weights = skin
+        joint_type = UNSIGNED_BYTE if joints.max(initial=0) < 256 else UNSIGNED_SHORT
+        for i in range(joints.shape[1] // 4):
+            attributes['JOINTS_%d' % i] = writer.accessor(joints[:, 4 * i:4 * i + 4], joint_type, 'VEC4',
+                                                          ARRAY_BUFFER)
+            attributes['WEIGHTS_%d' % i] = writer.accessor(weights[:, 4 * i:4 * i + 4], FLOAT, 'VEC4',
+                                                           ARRAY_BUFFER)
+    index_type = UNSIGNED_SHORT if num_verts <= 0xffff else UNSIGNED_INT
+    primitive = {'attributes': attributes, 'mode': 4,
+                 'indices': writer.accessor(mesh.faces.ravel(), index_type, 'SCALAR', ELEMENT_ARRAY_BUFFER)}
+    if mesh.material:
+        if mesh.material not in materials:
+            materials[mesh.material] = writer.add('materials', {'name': mesh.material})
+        primitive['material'] = materials[mesh.material]
+    return writer.add('meshes', {'name': mesh.name, 'primitives': [primitive]}), skin is not None
+
+
+def local_rest_matrices(model):
+    local = model.matrices.copy()
+    has_parent = model.bone_parents >= 0
+    local[has_parent] = np.linalg.inv(model.matrices[model.bone_parents[has_parent]]) @ model.matrices[has_parent]
+    return local
+
+
+def motion_channel(motion, key_type, default, num_frames):
+    # (frames,) keys, a single key holds for the whole clip
+    keys = motion.get(key_type)
+    if keys is None or len(keys) == 0:
+        return np.full(num_frames, default)
+    keys = np.asarray(keys, dtype=np.float64)
+    if len(keys) < num_frames:
+        keys = np.concatenate([keys, np.full(num_frames - len(keys), keys[-1])])
+    return keys[:num_frames]
+
+
+def clip_tracks(clip, motion, version):
+    """Translation, xyzw rotation and scale keys of one bone.
+
+    Each track has one row when all of its channels are constant.
+    """
+    frames = clip.num_frames
+    key_types = [(MKEY_X, MKEY_Y, MKEY_Z), (MKEY_PITCH, MKEY_ROLL, MKEY_YAW),
+                 (MKEY_SCALE_X,) * 3 if version == 1 else (MKEY_SCALE_X, MKEY_SCALE_Y, MKEY_SCALE_Z)]
+    tracks = []
+    for path, types, default in zip(('translation', 'rotation', 'scale'), key_types, (0.0, 0.0, 1.0)):
+        constant = all(len(motion.get(key_type, ())) <= 1 for key_type in types)
+        count = 1 if constant else frames
+        values = np.stack([motion_channel(motion, key_type, default, count) for key_type in types], axis=-1)
+        if path == 'rotation':
+            values = continuous_quaternions(euler_yxz_to_quaternions(np.radians(values)))
+        tracks.append((path, values))
+    return tracks
+
+
+def add_animation(writer, clip, name, joint_nodes, fps):
+    times = {}
+    samplers = []
+    channels = []
+    for bone_name, motion in clip.motions.items():
+        node = joint_nodes.get(bone_name)
+        if node is None:
+            continue
+        for path, values in clip_tracks(clip, motion, clip.version):
+            count = len(values)
+            if count not in times:
+                times[count] = writer.accessor(np.arange(count) / float(fps), FLOAT, 'SCALAR', bounds=True)
+            output = writer.accessor(values, FLOAT, 'VEC4' if path == 'rotation' else 'VEC3')
+            samplers.append({'input': times[count], 'output': output, 'interpolation': 'LINEAR'})
+            channels.append({'sampler': len(samplers) - 1, 'target': {'node': node, 'path': path}})
+    if channels:
+        writer.add('animations', {'name': name, 'samplers': samplers, 'channels': channels})
+    return len(channels)
+
+
+def convert_to_glb(model_filename, clip_filenames, filename, fps=30.0, name=None):
+    """Writes a .glb holding the model and one animation per clip.
+
+    :return: list of messages
+    """
+    model = read_model(model_filename)
+    clips = [(os.path.splitext(os.path.basename(clip_filename))[0], read_clip(clip_filename))
+             for clip_filename in clip_filenames]
+    return write_glb(filename, model, clips, fps, name or os.path.splitext(os.path.basename(model_filename))[0])
+
+
+def write_glb(filename, model, clips=(), fps=30.0, name='model'):
+    """:param clips: (animation name, K2Clip) pairs"""
+    writer = GlbWriter()
+    messages = []
+    root = {'name': name, 'rotation': Z_UP_TO_Y_UP, 'children': []}
+    writer.add('nodes', root)
+
+    joint_nodes = {}
+    num_bones = len(model.bone_names)
+    if num_bones:
+        translation, rotation, scale = decompose(local_rest_matrices(model))
+        first = len(writer.gltf['nodes'])
+        for i, bone_name in enumerate(model.bone_names):
+            joint_nodes[bone_name] = writer.add('nodes', {
+                'name': bone_name, 'translation': translation[i].tolist(), 'rotation': rotation[i].tolist(),
+                'scale': scale[i].tolist()})
+        for i, parent in enumerate(model.bone_parents):
+            children = writer.gltf['nodes'][first + parent].setdefault('children', []) if parent >= 0 \
+                else root['children']
+            children.append(first + i)
+        # glTF matrices are column major
+        inverse_bind = writer.accessor(model.inv_matrices.transpose(0, 2, 1).reshape(-1, 16), FLOAT, 'MAT4')
+        skin = writer.add('skins', {'joints': list(range(first, first + num_bones)),
+                                    'inverseBindMatrices': inverse_bind})
+
+    materials = {}
+    for mesh in model.meshes:
+        if mesh.positions is None or mesh.faces is None or not len(mesh.faces):
+            messages.append('skipped mesh %s without geometry' % mesh.name)
+            continue
+        mesh_index, skinned = add_mesh(writer, mesh, materials)
+        node = {'name': mesh.name, 'mesh': mesh_index}
+        if skinned and num_bones:
+            node['skin'] = skin
+        root['children'].append(writer.add('nodes', node))
+
+    for clip_name, clip in clips:
+        channels = add_animation(writer, clip, clip_name, joint_nodes, fps)
+        missing = len(set(clip.motions) - set(joint_nodes))
+        messages.append('animation %s: %d channels, %d frames%s' % (
+            clip_name, channels, clip.num_frames, ', %d bones not in the model' % missing if missing else ''))
+
+    writer.write(filename)
+    messages.append('wrote %s' % filename)
+    return messages
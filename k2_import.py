@@ -23,23 +23,27 @@ import bpy
 #   1 - standard logging
 #   2 - verbose logging
 #   3 - debug level. really boring (stuff like vertex data and verbatim lines)
-from .create_blender_clip import create_blender_clip
-from .create_blender_mesh import create_blender_mesh
+from .create_blender_clip import create_blender_clip, import_clip_steps
+from .create_blender_mesh import create_blender_mesh, import_mesh_steps
 
 
-def bone_depth(bone):
-    if not bone.parent:
-        return 0
-    else:
-        return 1 + bone_depth(bone.parent)
-
-
-def read_clip(filepath):
+def read_clip(filepath, arm_obj=None):
     obj_name = bpy.path.display_name_from_filepath(filepath)
-    create_blender_clip(filepath, obj_name)
+    return create_blender_clip(filepath, obj_name, arm_obj)
 
 
 def read(filepath, flipuv):
     obj_name = bpy.path.display_name_from_filepath(filepath)
     create_blender_mesh(filepath, obj_name, flipuv)
 
+
+def read_clip_steps(filepath, created):
+    # generator form of read_clip for modal_import
+    obj_name = bpy.path.display_name_from_filepath(filepath)
+    return import_clip_steps(filepath, obj_name, created)
+
+
+def read_steps(filepath, flipuv, created):
+    # generator form of read for modal_import
+    obj_name = bpy.path.display_name_from_filepath(filepath)
+    return import_mesh_steps(filepath, obj_name, flipuv, created)
@@ -0,0 +1,276 @@
+# bpy-free SQLite index of .model/.clip headers: bone names, mesh and
+# material names, animated bones and frame counts. Only the small chunks
+# are read, vertex data and keys are skipped with seeks. Files whose mtime
+# and size did not change since the last run are not read again.
+
+import os
+import sqlite3
+import struct
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from .k2_reader import K2FormatError, c_string, parse_model_head, parse_clip_head, parse_bones, parse_mesh
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    kind TEXT NOT NULL,
+    mtime REAL NOT NULL,
+    size INTEGER NOT NULL,
+    version INTEGER,
+    num_meshes INTEGER,
+    num_surfs INTEGER,
+    num_bones INTEGER,
+    num_frames INTEGER,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS bones (
+    file_id INTEGER NOT NULL REFERENCES files(id) ON DELETE CASCADE,
+    idx INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    parent INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meshes (
+    file_id INTEGER NOT NULL REFERENCES files(id) ON DELETE CASCADE,
+    idx INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    material TEXT NOT NULL,
+    num_verts INTEGER
+);
+CREATE TABLE IF NOT EXISTS clip_bones (
+    file_id INTEGER NOT NULL REFERENCES files(id) ON DELETE CASCADE,
+    idx INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    max_keys INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS bones_name ON bones(name);
+CREATE INDEX IF NOT EXISTS bones_file ON bones(file_id);
+CREATE INDEX IF NOT EXISTS meshes_material ON meshes(material);
+CREATE INDEX IF NOT EXISTS meshes_file ON meshes(file_id);
+CREATE INDEX IF NOT EXISTS clip_bones_name ON clip_bones(name);
+CREATE INDEX IF NOT EXISTS clip_bones_file ON clip_bones(file_id);
+'''
+
+
+def scan_chunks(file):
+    """Yields (name, payload size) with the file positioned at the payload.
+
+    The next chunk is found by seeking, whatever the caller read.
+    """
+    offset = 4
+    while True:
+        file.seek(offset)
+        header = file.read(8)
+        if len(header) < 8:
+            return
+        name, size = struct.unpack('<4si', header)
+        if size < 0:
+            raise K2FormatError('chunk %r at %d has a negative size' % (name, offset))
+        yield name, size
+        offset += 8 + size
+
+
+def read_model_header(file):
+    chunks = scan_chunks(file)
+    name, size = next(chunks, (None, 0))
+    if name != b'head':
+        raise K2FormatError('file does not start with head chunk')
+    model = parse_model_head(file.read(size))
+    for name, size in chunks:
+        if name == b'bone':
+            parse_bones(file.read(size), model)
+        elif name == b'mesh':
+            model.meshes.append(parse_mesh(file.read(size), model.version))
+    return model
+
+
+def read_clip_header(file):
+    """:return: K2Clip and {bone name: (bone index, most keys of a channel)}"""
+    chunks = scan_chunks(file)
+    name, size = next(chunks, (None, 0))
+    if name != b'head':
+        raise K2FormatError('file does not start with head chunk')
+    clip = parse_clip_head(file.read(size))
+    bones = {}
+    for name, size in chunks:
+        if name != b'bmtn':
+            continue
+        if clip.version == 1:
+            data = file.read(44)
+            bone_name = c_string(data[:32])
+            bone_index, key_type, num_keys = struct.unpack_from('<3i', data, 32)
+        else:
+            bone_index, key_type, num_keys, name_length = struct.unpack('<3iB', file.read(13))
+            bone_name = file.read(name_length).decode('utf8', 'replace')
+        index, keys = bones.get(bone_name, (bone_index, 0))
+        bones[bone_name] = (index, max(keys, num_keys))
+    return clip, bones
+
+
+def index_file(job):
+    """Reads the header chunks of one file, runs in the worker processes.
+
+    :return: dict with the files row and the bones/meshes/clip_bones rows
+    """
+    path, mtime, size = job
+    entry = {'path': path, 'mtime': mtime, 'size': size, 'kind': os.path.splitext(path)[1].lower()[1:],
+             'version': None, 'num_meshes': None, 'num_surfs': None, 'num_bones': None, 'num_frames': None,
+             'error': None, 'bones': [], 'meshes': [], 'clip_bones': []}
+    try:
+        with open(path, 'rb') as file:
+            sig = file.read(4)
+            if sig == b'SMDL':
+                model = read_model_header(file)
+                entry.update(kind='model', version=model.version, num_meshes=model.num_meshes,
+                             num_surfs=model.num_surfs, num_bones=model.num_bones)
+                entry['bones'] = [(i, name, int(parent)) for i, (name, parent) in
+                                  enumerate(zip(model.bone_names, model.bone_parents))]
+                entry['meshes'] = [(mesh.index, mesh.name, mesh.material, mesh.num_verts) for mesh in model.meshes]
+            elif sig == b'CLIP':
+                clip, bones = read_clip_header(file)
+                entry.update(kind='clip', version=clip.version, num_bones=clip.num_bones,
+                             num_frames=clip.num_frames)
+                entry['clip_bones'] = [(index, name, keys) for name, (index, keys) in bones.items()]
+            else:
+                raise K2FormatError('unknown file signature %r' % sig)
+    except Exception as e:
+        # a broken file must not abort the whole run, see k2_cli.validate_file
+        entry['error'] = '%s: %s' % (type(e).__name__, e)
+    return entry
+
+
+def find_assets(roots):
+    # (path, mtime, size) of every .model/.clip below the roots
+    found = []
+    stack = [os.path.abspath(root) for root in roots]
+    while stack:
+        path = stack.pop()
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            found.append((path, stat.st_mtime, stat.st_size))
+            continue
+        try:
+            entries = list(os.scandir(path))
+        except OSError:
+            continue
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                stack.append(entry.path)
+            elif entry.name.lower().endswith(('.model', '.clip')):
+                stat = entry.stat()
+                found.append((entry.path, stat.st_mtime, stat.st_size))
+    return found
+
+
+class K2Index:
+    """SQLite database of file headers, see index_directory."""
+
+    def __init__(self, filename):
+        self.db = sqlite3.connect(filename)
+        self.db.execute('PRAGMA foreign_keys = ON')
+        self.db.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    def stored(self):
+        return {path: (mtime, size) for path, mtime, size in self.db.execute('SELECT path, mtime, size FROM files')}
+
+    def store(self, entry):
+        self.db.execute('DELETE FROM files WHERE path = ?', (entry['path'],))
+        cursor = self.db.execute(
+            'INSERT INTO files (path, kind, mtime, size, version, num_meshes, num_surfs, num_bones, num_frames, '
+            'error) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (entry['path'], entry['kind'], entry['mtime'], entry['size'], entry['version'], entry['num_meshes'],
+             entry['num_surfs'], entry['num_bones'], entry['num_frames'], entry['error']))
+        file_id = cursor.lastrowid
+        self.db.executemany('INSERT INTO bones VALUES (?, ?, ?, ?)',
+                            [(file_id,) + row for row in entry['bones']])
+        self.db.executemany('INSERT INTO meshes VALUES (?, ?, ?, ?, ?)',
+                            [(file_id,) + row for row in entry['meshes']])
+        self.db.executemany('INSERT INTO clip_bones VALUES (?, ?, ?, ?)',
+                            [(file_id,) + row for row in entry['clip_bones']])
+
+    def remove(self, paths):
+        self.db.executemany('DELETE FROM files WHERE path = ?', [(path,) for path in paths])
+
+    def commit(self):
+        self.db.commit()
+
+    def lookup(self, path):
+        """:return: dict of the files row of path or None"""
+        cursor = self.db.execute('SELECT * FROM files WHERE path = ?', (os.path.abspath(path),))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return dict(zip([column[0] for column in cursor.description], row))
+
+    def bone_names(self, path):
+        return [name for name, in self.db.execute(
+            'SELECT b.name FROM bones b JOIN files f ON f.id = b.file_id WHERE f.path = ? ORDER BY b.idx',
+            (os.path.abspath(path),))]
+
+    def clips_animating(self, bone, animated_only=True):
+        # animated_only leaves out clips holding the bone still (one key per channel)
+        return [path for path, in self.db.execute(
+            'SELECT DISTINCT f.path FROM clip_bones c JOIN files f ON f.id = c.file_id '
+            'WHERE c.name LIKE ? AND c.max_keys > ? ORDER BY f.path', (bone, 1 if animated_only else 0))]
+
+    def models_using_material(self, material):
+        return [path for path, in self.db.execute(
+            'SELECT DISTINCT f.path FROM meshes m JOIN files f ON f.id = m.file_id '
+            'WHERE m.material LIKE ? ORDER BY f.path', (material,))]
+
+    def models_with_bone(self, bone):
+        return [path for path, in self.db.execute(
+            'SELECT DISTINCT f.path FROM bones b JOIN files f ON f.id = b.file_id '
+            'WHERE b.name LIKE ? ORDER BY f.path', (bone,))]
+
+    def clips_for_skeleton(self, bone_names):
+        """Clips that only animate bones of the given skeleton."""
+        self.db.execute('CREATE TEMP TABLE IF NOT EXISTS skeleton (name TEXT PRIMARY KEY)')
+        self.db.execute('DELETE FROM skeleton')
+        self.db.executemany('INSERT OR IGNORE INTO skeleton VALUES (?)', [(name,) for name in bone_names])
+        return [path for path, in self.db.execute(
+            "SELECT f.path FROM files f WHERE f.kind = 'clip' AND f.error IS NULL "
+            'AND EXISTS (SELECT 1 FROM clip_bones c WHERE c.file_id = f.id) '
+            'AND NOT EXISTS (SELECT 1 FROM clip_bones c WHERE c.file_id = f.id '
+            'AND c.name NOT IN (SELECT name FROM skeleton)) ORDER BY f.path')]
+
+
+def index_directory(filename, roots, jobs=0, batch=500):
+    """Indexes every .model/.clip below roots into the database filename.
+
+    Files with an unchanged mtime and size are skipped, files that are gone
+    from below the roots are removed.
+
+    :return: dict of counts and seconds
+    """
+    start = time.perf_counter()
+    found = find_assets(roots)
+    with K2Index(filename) as index:
+        stored = index.stored()
+        changed = [job for job in found if stored.get(job[0]) != (job[1], job[2])]
+        present = set(path for path, mtime, size in found)
+        roots = [os.path.abspath(root) for root in roots]
+        prefixes = tuple(os.path.join(root, '') for root in roots)
+        gone = [path for path in stored if path not in present and (path.startswith(prefixes) or path in roots)]
+        index.remove(gone)
+
+        failed = 0
+        with ProcessPoolExecutor(max(jobs or os.cpu_count() or 1, 1)) as pool:
+            for count, entry in enumerate(pool.map(index_file, changed, chunksize=16), 1):
+                index.store(entry)
+                failed += entry['error'] is not None
+                if count % batch == 0:
+                    index.commit()
+        index.commit()
+    return {'files': len(found), 'indexed': len(changed), 'skipped': len(found) - len(changed),
+            'removed': len(gone), 'failed': failed, 'seconds': time.perf_counter() - start}
@@ -0,0 +1,101 @@
+# determines the verbosity of logging, set from the add-on preferences.
+#   0 - no logging (fatal errors are still printed)
+#   1 - standard logging
+#   2 - verbose logging
+#   3 - debug level. really boring (stuff like vertex data and verbatim lines)
+#
+# Messages are %-formatted only when they are actually printed, so pass the
+# arguments instead of formatting them at the call site:
+#   vlog('%d vertices', num_verts)
+
+import json
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+LOG_LEVEL = 1
+
+
+def set_level(level):
+    global LOG_LEVEL
+    LOG_LEVEL = level
+
+
+def log(msg, *args):
+    if LOG_LEVEL >= 1:
+        print(msg % args if args else msg)
+
+
+def vlog(msg, *args):
+    if LOG_LEVEL >= 2:
+        print(msg % args if args else msg)
+
+
+def dlog(msg, *args):
+    if LOG_LEVEL >= 3:
+        print(msg % args if args else msg)
+
+
+def err(msg, *args):
+    print(msg % args if args else msg)
+
+
+class StageTimer:
+    """Accumulates wall time per named stage (parse, geometry, weights, ...).
+
+    Stages running on worker threads are summed, so they can add up to more
+    than the total run time.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, seconds):
+        with self.lock:
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def total(self):
+        return time.perf_counter() - self.start
+
+    def summary(self):
+        stages = ', '.join('%s %.3fs' % item for item in self.stages.items())
+        return 'total %.3fs (%s)' % (self.total(), stages)
+
+    def write_json(self, filename, **info):
+        data = dict(info)
+        data['total'] = self.total()
+        data['stages'] = self.stages
+        with open(filename, 'w') as file:
+            json.dump(data, file, indent=1)
+
+
+_timer = None
+_no_stage = nullcontext()
+
+
+def start_timer():
+    global _timer
+    _timer = StageTimer()
+    return _timer
+
+
+def stop_timer():
+    global _timer
+    _timer = None
+
+
+def stage(name):
+    # free when no timer is running
+    if _timer is None:
+        return _no_stage
+    return _timer.stage(name)
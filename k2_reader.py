@@ -0,0 +1,366 @@
+# bpy-free NumPy decoding of K2 .model (SMDL) and .clip (CLIP) files, used by
+# the command line tools. Chunks are read the same way as the importers do,
+# only into arrays instead of Blender data.
+
+import struct
+
+import numpy as np
+
+from .skin_weights import SkinWeights
+
+# clip key types, shared by the readers, writers and importers
+MKEY_X, MKEY_Y, MKEY_Z, MKEY_PITCH, MKEY_ROLL, MKEY_YAW, MKEY_VISIBILITY, MKEY_SCALE_X, MKEY_SCALE_Y, MKEY_SCALE_Z, MKEY_COUNT = range(11)
+
+
+class K2FormatError(ValueError):
+    pass
+
+
+def iter_chunks(data, offset=4):
+    """Yields (name, payload) of every chunk, payloads are memoryviews."""
+    data = memoryview(data)
+    while offset < len(data):
+        if offset + 8 > len(data):
+            raise K2FormatError('truncated chunk header at %d' % offset)
+        name = bytes(data[offset:offset + 4])
+        size = struct.unpack_from('<i', data, offset + 4)[0]
+        start = offset + 8
+        if size < 0 or start + size > len(data):
+            raise K2FormatError('chunk %r at %d runs past the end of the file' % (name, offset))
+        yield name, data[start:start + size]
+        offset = start + size
+
+
+def read_file(filename):
+    with open(filename, 'rb') as file:
+        return file.read()
+
+
+def c_string(data):
+    # fixed size name fields of version 1 files
+    return bytes(data).split(b'\0', 1)[0].decode('utf8', 'replace')
+
+
+class K2Mesh:
+    def __init__(self, index, name, material, mode=1, bounds=None, bone_link=-1):
+        self.index = index
+        self.name = name
+        self.material = material
+        self.mode = mode
+        self.bounds = bounds
+        self.bone_link = bone_link
+        self.num_verts = None
+        self.positions = None
+        self.normals = None
+        self.faces = None
+        self.texc = None
+        self.tang = None
+        self.sign = None
+        self.colr = None
+        self.skin = None
+
+
+class K2Surf:
+    def __init__(self, index, bounds, flags, planes, points, edges, tris):
+        self.index = index
+        self.bounds = bounds
+        self.flags = flags
+        self.planes = planes
+        self.points = points
+        self.edges = edges
+        self.tris = tris
+
+
+class K2Model:
+    """Decoded .model file.
+
+    Bone matrices are (bones, 4, 4) in the Blender convention, translation
+    in the last column.
+    """
+
+    def __init__(self, version, num_meshes, num_sprites, num_surfs, num_bones, bounds):
+        self.version = version
+        self.num_meshes = num_meshes
+        self.num_sprites = num_sprites
+        self.num_surfs = num_surfs
+        self.num_bones = num_bones
+        self.bounds = bounds
+        self.bone_names = []
+        self.bone_parents = np.zeros(0, dtype=np.int32)
+        self.inv_matrices = np.zeros((0, 4, 4))
+        self.matrices = np.zeros((0, 4, 4))
+        self.meshes = []
+        self.surfs = []
+
+
+class K2Clip:
+    """Decoded .clip file, motions maps bone name -> {key type: keys}."""
+
+    def __init__(self, version, num_bones, num_frames):
+        self.version = version
+        self.num_bones = num_bones
+        self.num_frames = num_frames
+        self.bone_indices = {}
+        self.motions = {}
+
+
+def parse_model_head(payload):
+    version, num_meshes, num_sprites, num_surfs, num_bones = struct.unpack_from('<5i', payload)
+    bounds = np.frombuffer(payload, '<f4', 6, 20).astype(np.float64) if len(payload) >= 44 else None
+    return K2Model(version, num_meshes, num_sprites, num_surfs, num_bones, bounds)
+
+
+def parse_clip_head(payload):
+    return K2Clip(*struct.unpack_from('<3i', payload))
+
+
+def read_header(filename):
+    """Reads only the signature and head chunk of a .model or .clip file.
+
+    :return: K2Model without bones and meshes or K2Clip without motions
+    """
+    with open(filename, 'rb') as file:
+        sig = file.read(4)
+        name, size = struct.unpack('<4si', file.read(8))
+        if name != b'head':
+            raise K2FormatError('file does not start with head chunk')
+        payload = file.read(size)
+    if sig == b'SMDL':
+        return parse_model_head(payload)
+    if sig == b'CLIP':
+        return parse_clip_head(payload)
+    raise K2FormatError('unknown file signature %r' % sig)
+
+
+def parse_bones(payload, model):
+    num_bones = model.num_bones
+    names = []
+    parents = np.empty(num_bones, dtype=np.int32)
+    inv_matrices = np.zeros((num_bones, 4, 4))
+    matrices = np.zeros((num_bones, 4, 4))
+    pos = 0
+    for i in range(num_bones):
+        parents[i] = struct.unpack_from('<i', payload, pos)[0]
+        if model.version == 1:
+            names.append(c_string(payload[pos + 4:pos + 36]))
+            # two 4x4 matrices, stored transposed
+            both = np.frombuffer(payload, '<f4', 32, pos + 36).reshape(2, 4, 4)
+            inv_matrices[i] = both[0].T
+            matrices[i] = both[1].T
+            pos += 36 + 128
+        else:
+            # two 4x3 matrices (the first three rows, column by column)
+            both = np.frombuffer(payload, '<f4', 24, pos + 4).reshape(2, 4, 3)
+            inv_matrices[i, :3] = both[0].T
+            matrices[i, :3] = both[1].T
+            pos += 100
+            name_length = payload[pos]
+            names.append(bytes(payload[pos + 1:pos + 1 + name_length]).decode('utf8', 'replace'))
+            pos += name_length + 2
+    inv_matrices[:, 3, 3] = 1.0
+    matrices[:, 3, 3] = 1.0
+    model.bone_names = names
+    model.bone_parents = parents
+    model.inv_matrices = inv_matrices
+    model.matrices = matrices
+
+
+def parse_mesh(payload, version):
+    index = struct.unpack_from('<i', payload)[0]
+    if version == 1:
+        return K2Mesh(index, c_string(payload[4:36]), c_string(payload[36:68]))
+    mode, num_verts = struct.unpack_from('<ii', payload, 4)
+    bounds = np.frombuffer(payload, '<f4', 6, 12).astype(np.float64)
+    bone_link, size_name, size_mat = struct.unpack_from('<iBB', payload, 36)
+    name = bytes(payload[42:42 + size_name]).decode('utf8', 'replace')
+    material = bytes(payload[43 + size_name:43 + size_name + size_mat]).decode('utf8', 'replace')
+    mesh = K2Mesh(index, name, material, mode, bounds, bone_link)
+    mesh.num_verts = num_verts
+    return mesh
+
+
+def parse_lnk1(payload):
+    num_verts = struct.unpack_from('<i', payload, 4)[0]
+    words = np.frombuffer(payload, '<u4', offset=8)
+    # per vertex: count, count float weights, count bone indices
+    starts = np.empty(num_verts, dtype=np.int64)
+    counts = np.empty(num_verts, dtype=np.int64)
+    pos = 0
+    for i in range(num_verts):
+        count = int(words[pos])
+        starts[i] = pos
+        counts[i] = count
+        pos += 1 + 2 * count
+    offsets = np.zeros(num_verts + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    rows = np.repeat(np.arange(num_verts), counts)
+    rank = np.arange(offsets[-1]) - offsets[rows]
+    weights = words[starts[rows] + 1 + rank].view('<f4').astype(np.float32)
+    bones = words[starts[rows] + 1 + counts[rows] + rank].astype(np.uint32)
+    return SkinWeights(offsets, bones, weights)
+
+
+def parse_surf(payload):
+    index, num_planes, num_points, num_edges, num_tris = struct.unpack_from('<5i', payload)
+    bounds = np.frombuffer(payload, '<f4', 6, 20).astype(np.float64)
+    flags = struct.unpack_from('<i', payload, 44)[0]
+    pos = 48
+    planes = np.frombuffer(payload, '<f4', num_planes * 4, pos).reshape(-1, 4)
+    pos += planes.nbytes
+    points = np.frombuffer(payload, '<f4', num_points * 3, pos).reshape(-1, 3)
+    pos += points.nbytes
+    edges = np.frombuffer(payload, '<f4', num_edges * 6, pos).reshape(-1, 6)
+    pos += edges.nbytes
+    tris = np.frombuffer(payload, '<u4', num_tris * 3, pos).reshape(-1, 3)
+    return K2Surf(index, bounds, flags, planes, points, edges, tris)
+
+
+def read_model(filename, data=None):
+    if data is None:
+        data = read_file(filename)
+    if data[:4] != b'SMDL':
+        raise K2FormatError('unknown file signature %r' % bytes(data[:4]))
+    chunks = iter_chunks(data)
+    name, payload = next(chunks, (None, None))
+    if name != b'head':
+        raise K2FormatError('file does not start with head chunk')
+    model = parse_model_head(payload)
+    mesh = None
+    for name, payload in chunks:
+        if name == b'bone':
+            parse_bones(payload, model)
+        elif name == b'mesh':
+            mesh = parse_mesh(payload, model.version)
+            model.meshes.append(mesh)
+        elif name == b'surf':
+            model.surfs.append(parse_surf(payload))
+            mesh = None
+        elif mesh is None:
+            continue
+        elif name == b'vrts':
+            mesh.positions = np.frombuffer(payload, '<f4', offset=4).reshape(-1, 3)
+        elif name == b'nrml':
+            mesh.normals = np.frombuffer(payload, '<f4', offset=4).reshape(-1, 3)
+        elif name == b'face':
+            if model.version == 1:
+                count = struct.unpack_from('<i', payload, 4)[0]
+                mesh.faces = np.frombuffer(payload, '<u4', count * 3, 8).reshape(-1, 3)
+            else:
+                count, width = struct.unpack_from('<iB', payload, 4)
+                mesh.faces = np.frombuffer(payload, '<u%d' % width, count * 3, 9).reshape(-1, 3)
+        elif name == b'texc':
+            if mesh.texc is None:
+                mesh.texc = np.frombuffer(payload, '<f4', offset=8 if model.version == 3 else 4).reshape(-1, 2)
+        elif name == b'tang':
+            mesh.tang = np.frombuffer(payload, '<f4', offset=8).reshape(-1, 3)
+        elif name == b'sign':
+            mesh.sign = np.frombuffer(payload, np.int8, offset=8)
+        elif name == b'colr':
+            mesh.colr = np.frombuffer(payload, np.uint8, offset=4).reshape(-1, 4)
+        elif name in (b'lnk1', b'lnk3'):
+            mesh.skin = parse_lnk1(payload)
+    return model
+
+
+def read_clip(filename, data=None):
+    if data is None:
+        data = read_file(filename)
+    if data[:4] != b'CLIP':
+        raise K2FormatError('unknown file signature %r' % bytes(data[:4]))
+    chunks = iter_chunks(data)
+    name, payload = next(chunks, (None, None))
+    if name != b'head':
+        raise K2FormatError('file does not start with head chunk')
+    clip = parse_clip_head(payload)
+    for name, payload in chunks:
+        if name != b'bmtn':
+            continue
+        if clip.version == 1:
+            bone_name = c_string(payload[:32])
+            bone_index, key_type, num_keys = struct.unpack_from('<3i', payload, 32)
+            pos = 44
+        else:
+            bone_index, key_type, num_keys, name_length = struct.unpack_from('<3iB', payload)
+            bone_name = bytes(payload[13:13 + name_length]).decode('utf8', 'replace')
+            pos = 14 + name_length
+        if key_type == MKEY_VISIBILITY:
+            keys = np.frombuffer(payload, np.uint8, num_keys, pos)
+        else:
+            keys = np.frombuffer(payload, '<f4', num_keys, pos)
+        clip.bone_indices[bone_name] = bone_index
+        clip.motions.setdefault(bone_name, {})[key_type] = keys
+    return clip
+
+
+def validate_model(model):
+    """Checks the internal consistency of a decoded model.
+
+    :return: list of problems, empty for a valid file
+    """
+    problems = []
+    if model.version not in (1, 3):
+        problems.append('unknown version %d' % model.version)
+    if len(model.meshes) != model.num_meshes:
+        problems.append('head lists %d meshes, file has %d' % (model.num_meshes, len(model.meshes)))
+    if len(model.surfs) != model.num_surfs:
+        problems.append('head lists %d surfs, file has %d' % (model.num_surfs, len(model.surfs)))
+    if len(model.bone_names) != model.num_bones:
+        problems.append('head lists %d bones, file has %d' % (model.num_bones, len(model.bone_names)))
+    bad_parents = np.flatnonzero((model.bone_parents < -1) | (model.bone_parents >= len(model.bone_names)))
+    if len(bad_parents):
+        problems.append('%d bones have an invalid parent' % len(bad_parents))
+    for mesh in model.meshes:
+        prefix = 'mesh %s: ' % mesh.name
+        if mesh.positions is None:
+            problems.append(prefix + 'no vrts chunk')
+            continue
+        num_verts = len(mesh.positions)
+        if mesh.num_verts is not None and mesh.num_verts != num_verts:
+            problems.append(prefix + 'mesh chunk lists %d vertices, vrts has %d' % (mesh.num_verts, num_verts))
+        if not np.isfinite(mesh.positions).all():
+            problems.append(prefix + 'non finite positions')
+        if mesh.faces is None:
+            problems.append(prefix + 'no face chunk')
+        elif len(mesh.faces) and mesh.faces.max() >= num_verts:
+            problems.append(prefix + 'face index %d out of %d vertices' % (mesh.faces.max(), num_verts))
+        for attr in ('normals', 'texc', 'tang', 'sign', 'colr'):
+            value = getattr(mesh, attr)
+            if value is not None and len(value) != num_verts:
+                problems.append(prefix + '%d %s for %d vertices' % (len(value), attr, num_verts))
+        if mesh.skin is not None:
+            if len(mesh.skin) != num_verts:
+                problems.append(prefix + 'links for %d of %d vertices' % (len(mesh.skin), num_verts))
+            if len(mesh.skin.bones) and mesh.skin.bones.max() >= model.num_bones:
+                problems.append(prefix + 'link to bone %d of %d' % (mesh.skin.bones.max(), model.num_bones))
+            if not np.isfinite(mesh.skin.weights).all():
+                problems.append(prefix + 'non finite weights')
+        if mesh.bounds is not None and num_verts:
+            slack = 1e-3 * (1.0 + np.abs(mesh.bounds).max())
+            if (mesh.positions.min(axis=0) < mesh.bounds[:3] - slack).any() or \
+                    (mesh.positions.max(axis=0) > mesh.bounds[3:] + slack).any():
+                problems.append(prefix + 'vertices outside of the bounding box')
+    for surf in model.surfs:
+        if len(surf.tris) and surf.tris.max() >= len(surf.points):
+            problems.append('surf %d: triangle index out of %d points' % (surf.index, len(surf.points)))
+    return problems
+
+
+def validate_clip(clip):
+    problems = []
+    if clip.version not in (1, 2):
+        problems.append('unknown version %d' % clip.version)
+    if len(clip.motions) != clip.num_bones:
+        problems.append('head lists %d bones, file has %d' % (clip.num_bones, len(clip.motions)))
+    for bone_name, motion in clip.motions.items():
+        index = clip.bone_indices[bone_name]
+        if not 0 <= index < clip.num_bones:
+            problems.append('bone %s: index %d out of %d bones' % (bone_name, index, clip.num_bones))
+        for key_type, keys in motion.items():
+            if not 0 <= key_type < MKEY_COUNT:
+                problems.append('bone %s: unknown key type %d' % (bone_name, key_type))
+            elif len(keys) not in (1, clip.num_frames):
+                problems.append('bone %s: %d keys of type %d for %d frames' % (bone_name, len(keys), key_type,
+                                                                                clip.num_frames))
+            elif not np.isfinite(keys).all():
+                problems.append('bone %s: non finite keys of type %d' % (bone_name, key_type))
+    return problems
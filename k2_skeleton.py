@@ -0,0 +1,46 @@
+import numpy as np
+
+
+class K2Skeleton:
+    """Bones of an armature in the order K2 files store them.
+
+    Bones are sorted by depth so parents always come before their children,
+    keeping the armature order between bones of the same depth.
+
+    :ivar names: bone names in file order
+    :ivar index: bone name -> file index
+    :ivar parents: (bones,) parent file index, -1 for root bones
+    :ivar depths: (bones,) number of ancestors, ascending
+    :ivar rest: (bones, 4, 4) armature space rest matrices (matrix_local)
+    :ivar local_rest: (bones, 4, 4) rest matrices relative to the parent bone
+    """
+
+    def __init__(self, armature):
+        depths = {}
+        for bone in armature.bones:
+            chain = []
+            while bone is not None and bone.name not in depths:
+                chain.append(bone)
+                bone = bone.parent
+            depth = depths[bone.name] if bone is not None else -1
+            for bone in reversed(chain):
+                depth += 1
+                depths[bone.name] = depth
+        bones = sorted(armature.bones, key=lambda b: depths[b.name])
+
+        self.names = [bone.name for bone in bones]
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self.depths = np.array([depths[name] for name in self.names], dtype=np.int32)
+        self.parents = np.array([self.index[bone.parent.name] if bone.parent else -1 for bone in bones],
+                                dtype=np.int32)
+        self.rest = np.array([bone.matrix_local for bone in bones], dtype=np.float64).reshape(-1, 4, 4)
+        self.local_rest = self.rest.copy()
+        has_parent = self.parents >= 0
+        self.local_rest[has_parent] = np.linalg.inv(self.rest[self.parents[has_parent]]) @ self.rest[has_parent]
+
+    def __len__(self):
+        return len(self.names)
+
+    def group_bones(self, vertex_groups):
+        # vertex group index -> bone index, groups without a bone are left out
+        return {group.index: self.index[group.name] for group in vertex_groups if group.name in self.index}
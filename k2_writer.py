@@ -0,0 +1,226 @@
+# bpy-free NumPy encoding of K2 .model (SMDL) and .clip (CLIP) files, the
+# counterpart of k2_reader. The exporters extract arrays from Blender and
+# encode them with these functions; they work the same on arrays built in
+# plain Python, e.g. by read_model/read_clip, patched and written back.
+#
+# UVs are taken as stored in the file (origin at the top left) and colors as
+# uint8 RGBA or 0..1 floats.
+
+import struct
+
+import numpy as np
+
+from .chunk_writer import ChunkWriter
+from .create_bone_data import bone_chunk_data
+from .create_mesh_data import positions_bounding_box, merge_bounding_boxes, create_mesh_data
+from .k2_reader import MKEY_X, MKEY_Y, MKEY_Z, MKEY_PITCH, MKEY_ROLL, MKEY_YAW, MKEY_VISIBILITY, MKEY_SCALE_X, \
+    MKEY_SCALE_Y, MKEY_SCALE_Z, MKEY_COUNT
+from .skin_weights import SkinWeights
+
+
+##############################
+# MODELS
+##############################
+
+
+def create_vrts_data(positions, mesh_index):
+    return [struct.pack("<i", mesh_index), np.ascontiguousarray(positions, dtype='<f4')]
+
+
+def create_face_data(verts, faces, mesh_index):
+    if len(verts) < 255:
+        width = 1
+    elif len(verts) <= 65536:
+        width = 2
+    else:
+        width = 4
+    return [struct.pack("<iiB", mesh_index, len(faces), width),
+            np.ascontiguousarray(faces, dtype='<u%d' % width)]
+
+
+def create_tang_data(tang, mesh_index):
+    # second int: huh?
+    return [struct.pack("<ii", mesh_index, 0), np.ascontiguousarray(tang, dtype='<f4')]
+
+
+def create_texc_data(texc, mesh_index):
+    # second int: huh?
+    return [struct.pack("<ii", mesh_index, 0), np.ascontiguousarray(texc, dtype='<f4')]
+
+
+def create_colr_data(colr, mesh_index):
+    if colr.dtype != np.uint8:
+        colr = np.clip(np.rint(colr * 255.0), 0, 255).astype(np.uint8)
+    return [struct.pack("<i", mesh_index), np.ascontiguousarray(colr)]
+
+
+def create_nrml_data(normals, mesh_index):
+    return [struct.pack("<i", mesh_index), np.ascontiguousarray(normals, dtype='<f4')]
+
+
+def create_lnk1_data(skin, mesh_index):
+    return [struct.pack("<ii", mesh_index, len(skin)), skin.lnk1_payload()]
+
+
+def create_sign_data(mesh_index, sign):
+    return [struct.pack("<ii", mesh_index, 0), np.ascontiguousarray(sign, dtype='<i1')]
+
+
+def create_surf_data(surf, surf_index):
+    planes = np.ascontiguousarray(surf.planes, dtype='<f4').reshape(-1, 4)
+    points = np.ascontiguousarray(surf.points, dtype='<f4').reshape(-1, 3)
+    edges = np.ascontiguousarray(surf.edges, dtype='<f4').reshape(-1, 6)
+    tris = np.ascontiguousarray(surf.tris, dtype='<u4').reshape(-1, 3)
+    bounds = surf.bounds if surf.bounds is not None else positions_bounding_box(points)
+    return [struct.pack("<5i", surf_index, len(planes), len(points), len(edges), len(tris)),
+            struct.pack("<6f", *bounds), struct.pack("<i", surf.flags), planes, points, edges, tris]
+
+
+def mesh_chunks(mesh, mesh_index, bounds=None):
+    """(name, pieces) of every chunk of a K2Mesh-like object.
+
+    Attributes left at None are not written, a missing skin is written as a
+    lnk1 chunk without influences like the exporter does for unskinned meshes.
+    """
+    positions = mesh.positions
+    if bounds is None:
+        bounds = positions_bounding_box(positions)
+    skin = mesh.skin
+    if skin is None:
+        skin = SkinWeights(np.zeros(len(positions) + 1, dtype=np.int64), np.zeros(0, dtype=np.uint32),
+                           np.zeros(0, dtype=np.float32))
+    chunks = [
+        ('mesh', [create_mesh_data(bounds, len(positions), mesh_index, mesh.name.encode('utf8'),
+                                   mesh.material.encode('utf8'), mesh.mode, mesh.bone_link)]),
+        ('vrts', create_vrts_data(positions, mesh_index)),
+        ('lnk1', create_lnk1_data(skin, mesh_index)),
+    ]
+    if mesh.faces is not None and len(mesh.faces) > 0:
+        chunks.append(('face', create_face_data(positions, mesh.faces, mesh_index)))
+    if mesh.texc is not None:
+        chunks.append(('texc', create_texc_data(mesh.texc, mesh_index)))
+    if mesh.tang is not None:
+        chunks.append(('tang', create_tang_data(mesh.tang, mesh_index)))
+    if mesh.sign is not None:
+        chunks.append(('sign', create_sign_data(mesh_index, mesh.sign)))
+    if mesh.normals is not None:
+        chunks.append(('nrml', create_nrml_data(mesh.normals, mesh_index)))
+    if mesh.colr is not None:
+        chunks.append(('colr', create_colr_data(mesh.colr, mesh_index)))
+    return chunks
+
+
+def write_model(filename, model):
+    """Writes a version 3 .model from a K2Model-like object.
+
+    Uses bone_names, bone_parents, matrices ((bones, 4, 4) Blender
+    convention), inv_matrices (computed from matrices when empty), meshes and
+    surfs; the head counts and bounding boxes are derived from those.
+    """
+    num_bones = len(model.bone_names)
+    matrices = np.asarray(model.matrices, dtype=np.float64).reshape(-1, 4, 4)
+    inv_matrices = np.asarray(model.inv_matrices, dtype=np.float64).reshape(-1, 4, 4)
+    if len(inv_matrices) != num_bones:
+        inv_matrices = np.linalg.inv(matrices)
+    boxes = [mesh.bounds if mesh.bounds is not None else positions_bounding_box(mesh.positions)
+             for mesh in model.meshes]
+    bounds = merge_bounding_boxes([box for box, mesh in zip(boxes, model.meshes) if len(mesh.positions)]) \
+        if any(len(mesh.positions) for mesh in model.meshes) else [0.0] * 6
+
+    with ChunkWriter(filename, b'SMDL') as out:
+        out.write_chunk('head', struct.pack("<5i", 3, len(model.meshes), 0, len(model.surfs), num_bones),
+                        struct.pack("<6f", *bounds))
+        out.write_chunk('bone', bone_chunk_data(model.bone_names, model.bone_parents, inv_matrices, matrices))
+        for mesh_index, (mesh, box) in enumerate(zip(model.meshes, boxes)):
+            for name, pieces in mesh_chunks(mesh, mesh_index, box):
+                out.write_chunk(name, *pieces)
+        for surf_index, surf in enumerate(model.surfs):
+            out.write_chunk('surf', *create_surf_data(surf, surf_index))
+
+
+##############################
+# CLIPS
+##############################
+
+
+def channel_tolerances(translation=0.0, rotation=0.0, scale=0.0):
+    # per key type, rotation in degrees, visibility always has to match
+    tolerances = [0.0] * MKEY_COUNT
+    for key_type in (MKEY_X, MKEY_Y, MKEY_Z):
+        tolerances[key_type] = translation
+    for key_type in (MKEY_PITCH, MKEY_ROLL, MKEY_YAW):
+        tolerances[key_type] = rotation
+    for key_type in (MKEY_SCALE_X, MKEY_SCALE_Y, MKEY_SCALE_Z):
+        tolerances[key_type] = scale
+    return tolerances
+
+
+def clip_bone(out, bone_name, motion, index, tolerances):
+    """Writes the bmtn chunks of one bone.
+
+    Channels that stay within their tolerance are written as a single key,
+    the midpoint of their range.
+
+    :param motion: (MKEY_COUNT, frames) channel values
+    :return: number of collapsed channels and key bytes saved by them
+    """
+    collapsed = 0
+    saved = 0
+    for key_type in range(MKEY_COUNT):
+        key = motion[key_type]
+        low = key.min()
+        high = key.max()
+        if len(key) > 1 and high - low <= tolerances[key_type]:
+            collapsed += 1
+            saved += (len(key) - 1) * (1 if key_type == MKEY_VISIBILITY else 4)
+            key = key[:1] if low == high else np.array([(low + high) / 2.0])
+        header = struct.pack("<iiiB", index, key_type, len(key), len(bone_name)) + bone_name + b'\0'
+        if key_type == MKEY_VISIBILITY:
+            out.write_chunk('bmtn', header, key.astype(np.uint8))
+        else:
+            out.write_chunk('bmtn', header, key.astype('<f4'))
+    return collapsed, saved
+
+
+def dense_motions(clip, bone_names):
+    """(bones, MKEY_COUNT, frames) channel values of a K2Clip.
+
+    Single keys are repeated over the clip, missing channels are filled with
+    the rest values (zero translation and rotation, unit scale, visible).
+    """
+    frames = clip.num_frames
+    motions = np.zeros((len(bone_names), MKEY_COUNT, frames))
+    motions[:, MKEY_VISIBILITY] = 255
+    motions[:, MKEY_SCALE_X:MKEY_SCALE_Z + 1] = 1.0
+    for index, name in enumerate(bone_names):
+        for key_type, keys in clip.motions.get(name, {}).items():
+            if len(keys) and 0 <= key_type < MKEY_COUNT:
+                motions[index, key_type] = keys[-1]
+                motions[index, key_type, :min(len(keys), frames)] = keys[:frames]
+        if clip.version == 1:
+            # version 1 only has a uniform scale
+            motions[index, MKEY_SCALE_Y] = motions[index, MKEY_SCALE_Z] = motions[index, MKEY_SCALE_X]
+    return motions
+
+
+def write_clip(filename, bone_names, motions, tolerances=None):
+    """Writes a version 2 .clip.
+
+    :param motions: (bones, MKEY_COUNT, frames) channel values
+    :param tolerances: per key type, see channel_tolerances; constant channels
+        are always written as one key
+    :return: (collapsed channels, saved bytes, file size)
+    """
+    if tolerances is None:
+        tolerances = channel_tolerances()
+    with ChunkWriter(filename, b'CLIP') as out:
+        out.write_chunk('head', struct.pack("<3i", 2, len(bone_names), motions.shape[2]))
+        collapsed = 0
+        saved = 0
+        for index, bone_name in enumerate(bone_names):
+            bone_collapsed, bone_saved = clip_bone(out, bone_name.encode('utf8'), motions[index], index,
+                                                   tolerances)
+            collapsed += bone_collapsed
+            saved += bone_saved
+        size = out.tell()
+    return collapsed, saved, size
@@ -0,0 +1,31 @@
+# Splitting of big triangle lists into several meshes under a vertex budget.
+
+
+def split_faces(faces, max_verts):
+    """Greedily splits faces into parts referencing at most max_verts vertices.
+
+    Faces keep their order, so a cache optimized index buffer stays cache
+    friendly inside every part.
+
+    :return: list of (part faces, order) where order maps part vertex
+        indices back to the original ones
+    """
+    parts = []
+    remap = {}
+    order = []
+    part_faces = []
+    for f in faces:
+        new_verts = len(set(v for v in f if v not in remap))
+        if part_faces and len(order) + new_verts > max_verts:
+            parts.append((part_faces, order))
+            remap = {}
+            order = []
+            part_faces = []
+        for v in f:
+            if v not in remap:
+                remap[v] = len(order)
+                order.append(v)
+        part_faces.append([remap[v] for v in f])
+    if part_faces:
+        parts.append((part_faces, order))
+    return parts
@@ -0,0 +1,100 @@
+# Time sliced imports. The importers are generators that yield their
+# progress (0..1) between bounded pieces of work and record what they create
+# in a list, so they can run to completion in one go or from a modal timer
+# that keeps the UI responsive and rolls everything back on Esc.
+
+import time
+
+import bpy
+
+
+def run_steps(steps):
+    # runs an import generator to completion and returns its return value
+    while True:
+        try:
+            next(steps)
+        except StopIteration as e:
+            return e.value
+
+
+def rollback(created):
+    """Undoes an import from its list of created items, newest first.
+
+    Items are (bpy.data collection name, datablock) pairs or callables
+    restoring modified state.
+    """
+    for item in reversed(created):
+        if callable(item):
+            item()
+            continue
+        collection, block = item
+        try:
+            getattr(bpy.data, collection).remove(block)
+        except ReferenceError:
+            # already removed together with its user
+            pass
+    created.clear()
+
+
+class TimeSlicedImport:
+    """Mixin running self.steps from a modal timer.
+
+    Operators pass their step generator to run_modal from execute and get a
+    progress bar and Esc to cancel, other input is blocked meanwhile.
+    Without a window, e.g. in background mode, the import runs
+    synchronously. finish_steps is called once the import ended either way.
+    """
+    time_slice = 0.05
+
+    def run_modal(self, context, steps, created):
+        self.steps = steps
+        self.created = created
+        wm = context.window_manager
+        if context.window is None or bpy.app.background:
+            try:
+                run_steps(steps)
+            except Exception:
+                rollback(created)
+                raise
+            finally:
+                self.finish_steps(context)
+            return {'FINISHED'}
+        self.event_timer = wm.event_timer_add(0.001, window=context.window)
+        wm.progress_begin(0, 1000)
+        wm.modal_handler_add(self)
+        return {'RUNNING_MODAL'}
+
+    def modal(self, context, event):
+        if event.type == 'ESC' and event.value == 'PRESS':
+            self.steps.close()
+            rollback(self.created)
+            self.end_modal(context)
+            self.report({'WARNING'}, "Import cancelled")
+            return {'CANCELLED'}
+        if event.type != 'TIMER' or event.timer is not self.event_timer:
+            # swallow input while importing, undo, deleting the rig or a mode
+            # change would pull the data from under the next slice
+            return {'PASS_THROUGH'} if event.type.startswith('TIMER') else {'RUNNING_MODAL'}
+        deadline = time.perf_counter() + self.time_slice
+        try:
+            while time.perf_counter() < deadline:
+                progress = next(self.steps)
+                if progress is not None:
+                    context.window_manager.progress_update(int(min(max(progress, 0.0), 1.0) * 1000))
+        except StopIteration:
+            self.end_modal(context)
+            return {'FINISHED'}
+        except Exception:
+            rollback(self.created)
+            self.end_modal(context)
+            raise
+        return {'RUNNING_MODAL'}
+
+    def end_modal(self, context):
+        wm = context.window_manager
+        wm.event_timer_remove(self.event_timer)
+        wm.progress_end()
+        self.finish_steps(context)
+
+    def finish_steps(self, context):
+        pass
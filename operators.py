@@ -1,22 +1,97 @@
+import os
+
 import bpy
-from bpy.props import StringProperty, BoolProperty, IntProperty
+from bpy.props import StringProperty, BoolProperty, IntProperty, FloatProperty, EnumProperty
+
+from . import k2_log
+from .clip_bake import BAKE_MODES
+from .export_k2_clip import export_k2_clip, export_k2_clips, channel_tolerances
+from .export_k2_mesh import export_k2_mesh, mesh_cache
+from .modal_import import TimeSlicedImport
+
+
+def update_log_level(self, context):
+    k2_log.set_level(int(self.log_level))
+
+
+class K2_AddonPreferences(bpy.types.AddonPreferences):
+    bl_idname = __package__
+
+    log_level: EnumProperty(
+        name="Log Level",
+        description="Verbosity of the console output",
+        items=(
+            ('0', "Quiet", "Only fatal errors"),
+            ('1', "Standard", "Standard logging"),
+            ('2', "Verbose", "Verbose logging"),
+            ('3', "Debug", "Really boring, stuff like vertex data and verbatim lines"),
+        ),
+        default='1',
+        update=update_log_level,
+    )
+    index_path: StringProperty(
+        name="Asset Index",
+        description="SQLite database written by 'k2_cli.py index', used to find clips for an armature",
+        subtype='FILE_PATH',
+        default="",
+    )
+    cache_size: IntProperty(
+        name="Export Cache (MiB)",
+        description="Memory for encoded meshes reused by later exports of unchanged objects",
+        default=256,
+        min=0,
+    )
+
+    def draw(self, context):
+        self.layout.prop(self, "log_level")
+        self.layout.prop(self, "index_path")
+        self.layout.prop(self, "cache_size")
+
 
-from .export_k2_clip import export_k2_clip
-from .export_k2_mesh import export_k2_mesh
+def addon_preferences(context):
+    addon = context.preferences.addons.get(__package__)
+    return addon.preferences if addon else None
 
 
-class K2_OT_clip_importer(bpy.types.Operator):
+def start_timing(context):
+    prefs = addon_preferences(context)
+    if prefs:
+        k2_log.set_level(int(prefs.log_level))
+    return k2_log.start_timer()
+
+
+def finish_timing(operator, timer):
+    k2_log.stop_timer()
+    operator.report({'INFO'}, timer.summary())
+    if operator.write_timings:
+        timer.write_json(operator.filepath + '.timings.json', operator=operator.bl_idname,
+                         filepath=operator.filepath)
+
+
+write_timings_property = BoolProperty(
+    name="Write Timings",
+    description="Write per stage timings next to the file (.timings.json)",
+    default=False,
+)
+
+
+class K2_OT_clip_importer(TimeSlicedImport, bpy.types.Operator):
     '''Load K2/Silverlight clip data'''
     bl_idname = "k2.clip_importer"
     bl_label = "Import K2 Clip"
 
     filepath: StringProperty(subtype='FILE_PATH', )
     filter_glob: StringProperty(default="*.clip", options={'HIDDEN'})
+    write_timings: write_timings_property
 
     def execute(self, context):
         from . import k2_import
-        k2_import.read_clip(self.filepath)
-        return {'FINISHED'}
+        self.timer = start_timing(context)
+        created = []
+        return self.run_modal(context, k2_import.read_clip_steps(self.filepath, created), created)
+
+    def finish_steps(self, context):
+        finish_timing(self, self.timer)
 
     def invoke(self, context, event):
         wm = context.window_manager
@@ -24,7 +99,47 @@ class K2_OT_clip_importer(bpy.types.Operator):
         return {'RUNNING_MODAL'}
 
 
-class K2_OT_mesh_importer(bpy.types.Operator):
+class K2_OT_indexed_clip_importer(bpy.types.Operator):
+    '''Import every indexed clip that only animates bones of the active armature'''
+    bl_idname = "k2.indexed_clip_importer"
+    bl_label = "Import K2 Clips from Index"
+
+    name_filter: StringProperty(
+        name="Name Filter",
+        description="Only import clips whose file name contains this text",
+        default="",
+    )
+
+    @classmethod
+    def poll(cls, context):
+        return context.active_object is not None and context.active_object.type == 'ARMATURE'
+
+    def execute(self, context):
+        from . import k2_import
+        from .k2_index import K2Index
+        prefs = addon_preferences(context)
+        index_path = bpy.path.abspath(prefs.index_path) if prefs else ''
+        if not os.path.isfile(index_path):
+            self.report({'ERROR'}, "Set the asset index database in the add-on preferences")
+            return {'CANCELLED'}
+        arm_ob = context.active_object
+        with K2Index(index_path) as index:
+            clips = index.clips_for_skeleton([bone.name for bone in arm_ob.data.bones])
+        clips = [path for path in clips if self.name_filter.lower() in os.path.basename(path).lower() and
+                 os.path.isfile(path)]
+        for path in clips:
+            action = k2_import.read_clip(path, arm_ob)
+            # every clip replaces the active action, keep the earlier ones
+            if action is not None:
+                action.use_fake_user = True
+        self.report({'INFO'}, "%d clips imported" % len(clips))
+        return {'FINISHED'}
+
+    def invoke(self, context, event):
+        return context.window_manager.invoke_props_dialog(self)
+
+
+class K2_OT_mesh_importer(TimeSlicedImport, bpy.types.Operator):
     '''Load K2/Silverlight mesh data'''
     bl_idname = "k2.mesh_importer"
     bl_label = "Import K2 Mesh"
@@ -37,11 +152,16 @@ class K2_OT_mesh_importer(bpy.types.Operator):
         description="Flip UV",
         default=True,
     )
+    write_timings: write_timings_property
 
     def execute(self, context):
         from . import k2_import
-        k2_import.read(self.filepath, self.flipuv)
-        return {'FINISHED'}
+        self.timer = start_timing(context)
+        created = []
+        return self.run_modal(context, k2_import.read_steps(self.filepath, self.flipuv, created), created)
+
+    def finish_steps(self, context):
+        finish_timing(self, self.timer)
 
     def invoke(self, context, event):
         wm = context.window_manager
@@ -70,11 +190,63 @@ class K2_OT_clip_exporter(bpy.types.Operator):
         default=True,
     )
     frame_start: IntProperty(name="Start Frame", description="Starting frame for the animation", default=0)
-    frame_end: IntProperty(name="Ending Frame", description="Ending frame for the animation", default=1)
+    frame_end: IntProperty(name="Ending Frame", description="Ending frame for the animation, not included", default=1)
+    batch: EnumProperty(
+        name="Clips",
+        description="Which animation to export",
+        items=(
+            ('NONE', "Active Action", "Export the frame range above of the active action"),
+            ('ACTIONS', "All Actions", "Export every action animating only bones of the armature as "
+                                       "<action>.clip next to the file, each over its own frame range"),
+            ('NLA', "NLA Strips", "Export the selected NLA strips (all strips when none is selected) as "
+                                  "<strip>.clip next to the file"),
+        ),
+        default='NONE',
+    )
+    bake_mode: EnumProperty(
+        name="Bake",
+        description="How bone transforms are sampled",
+        items=BAKE_MODES,
+        default='AUTO',
+    )
+    translation_tolerance: FloatProperty(
+        name="Translation Tolerance",
+        description="Translation channels varying less than this are written as one key",
+        default=0.0001,
+        min=0.0,
+        precision=5,
+    )
+    rotation_tolerance: FloatProperty(
+        name="Rotation Tolerance",
+        description="Rotation channels varying less than this many degrees are written as one key",
+        default=0.001,
+        min=0.0,
+        precision=4,
+    )
+    scale_tolerance: FloatProperty(
+        name="Scale Tolerance",
+        description="Scale channels varying less than this are written as one key",
+        default=0.0001,
+        min=0.0,
+        precision=5,
+    )
+    write_timings: write_timings_property
 
     def execute(self, context):
         from . import k2_export
-        export_k2_clip(self.filepath, self.apply_modifiers, self.frame_start, self.frame_end)
+        tolerances = channel_tolerances(self.translation_tolerance, self.rotation_tolerance, self.scale_tolerance)
+        timer = start_timing(context)
+        try:
+            if self.batch == 'NONE':
+                report = export_k2_clip(self.filepath, self.apply_modifiers, self.frame_start, self.frame_end,
+                                        self.bake_mode, tolerances)
+            else:
+                report = export_k2_clips(os.path.dirname(self.filepath), self.apply_modifiers, self.batch,
+                                         self.bake_mode, tolerances)
+        finally:
+            finish_timing(self, timer)
+        for msg in report:
+            self.report({'INFO'}, msg)
         return {'FINISHED'}
 
     def invoke(self, context, event):
@@ -105,10 +277,69 @@ class K2_OT_mesh_exporter(bpy.types.Operator):
         description="Use transformed mesh data from each object",
         default=True,
     )
+    optimize_vertex_cache: BoolProperty(
+        name="Optimize Vertex Cache",
+        description="Reorder triangles and vertices for GPU vertex cache locality",
+        default=True,
+    )
+    max_vertices: IntProperty(
+        name="Max Vertices per Mesh",
+        description="Split objects into several meshes above this vertex count, 0 writes 32-bit indices instead",
+        default=0,
+        min=0,
+    )
+    threads: IntProperty(
+        name="Threads",
+        description="Number of threads (and vertex cache optimization processes) encoding meshes, "
+                    "0 uses all cores",
+        default=0,
+        min=0,
+    )
+    max_influences: IntProperty(
+        name="Max Influences",
+        description="Maximum number of bones influencing a vertex, 0 keeps all of them",
+        default=0,
+        min=0,
+    )
+    min_weight: FloatProperty(
+        name="Min Weight",
+        description="Drop bone influences with a smaller weight",
+        default=0.0,
+        min=0.0,
+        max=1.0,
+    )
+    bone_bounds: BoolProperty(
+        name="Bone Bounds",
+        description="Write per bone influence bounds next to the model (.bounds.json)",
+        default=False,
+    )
+    lods: StringProperty(
+        name="LODs",
+        description="Comma separated LOD ratios (up to 1.0) or triangle counts, written as name_lod1.model, "
+                    "name_lod2.model, ...",
+        default="",
+    )
+    use_cache: BoolProperty(
+        name="Reuse Unchanged Meshes",
+        description="Write objects that did not change since an earlier export from cached chunks",
+        default=True,
+    )
+    write_timings: write_timings_property
 
     def execute(self, context):
         from . import k2_export
-        export_k2_mesh(context, self.filepath, self.apply_modifiers)
+        prefs = addon_preferences(context)
+        if prefs:
+            mesh_cache.resize(prefs.cache_size * 1024 * 1024)
+        timer = start_timing(context)
+        try:
+            report = export_k2_mesh(context, self.filepath, self.apply_modifiers, self.optimize_vertex_cache,
+                                    self.max_vertices, self.threads, self.max_influences, self.min_weight,
+                                    self.bone_bounds, self.lods, self.use_cache)
+        finally:
+            finish_timing(self, timer)
+        for msg in report:
+            self.report({'INFO'}, msg)
 
         return {'FINISHED'}
 
@@ -1,14 +1,9 @@
+import chunk
 import struct
 
-IMPORT_LOG_LEVEL = 3
-
-
-def log(msg):
-    if IMPORT_LOG_LEVEL >= 1: print(msg)
-
-
-def vlog(msg):
-    if IMPORT_LOG_LEVEL >= 2: print(msg)
+from . import k2_reader
+from .k2_reader import MKEY_VISIBILITY
+from .k2_log import log, vlog, dlog
 
 
 def read_int(hon_chunk):
@@ -23,8 +18,8 @@ def parse_links(hon_chunk, bone_names):
     mesh_index = read_int(hon_chunk)  # wireframe index
     num_verts = read_int(hon_chunk)  # number of vertices
     log("links")
-    vlog("mesh index: %d" % mesh_index)
-    vlog("vertices number: %d" % num_verts)
+    vlog("mesh index: %d", mesh_index)
+    vlog("vertices number: %d", num_verts)
     v_groups = {}
     for i in range(num_verts):
         num_weights = read_int(hon_chunk)  # number of scales
@@ -46,7 +41,7 @@ def parse_vertices(hon_chunk):
     vlog('parsing vertices chunk')
     num_verts = (hon_chunk.chunksize - 4) / 12
     num_verts = int(num_verts)
-    vlog('%d vertices' % num_verts)
+    vlog('%d vertices', num_verts)
     mesh_index = read_int(hon_chunk)  # wireframe index
     return [struct.unpack("<3f", hon_chunk.read(12)) for i in range(int(num_verts))]
 
@@ -63,7 +58,7 @@ def parse_faces(hon_chunk, version):
     vlog('parsing faces chunk')
     mesh_index = read_int(hon_chunk)  # wireframe index
     numfaces = read_int(hon_chunk)  # number of faces
-    vlog('%d faces' % numfaces)
+    vlog('%d faces', numfaces)
     if version == 3:
         size = struct.unpack('B', hon_chunk.read(1))[0]
     elif version == 1:
@@ -75,7 +70,7 @@ def parse_faces(hon_chunk, version):
     elif size == 4:
         return [struct.unpack("<3I", hon_chunk.read(12)) for i in range(numfaces)]
     else:
-        log("unknown size for faces:%d" % size)
+        log("unknown size for faces:%d", size)
         return []
 
 
@@ -83,7 +78,7 @@ def parse_normals(hon_chunk):
     vlog('parsing normals chunk')
     num_verts = (hon_chunk.chunksize - 4) / 12
     num_verts = int(num_verts)
-    vlog('%d normals' % num_verts)
+    vlog('%d normals', num_verts)
     mesh_index = read_int(hon_chunk)  # wireframe index
     return [struct.unpack("<3f", hon_chunk.read(12)) for i in range(num_verts)]
 
@@ -92,7 +87,7 @@ def parse_texc(hon_chunk, version):
     vlog('parsing uv texc chunk')
     num_verts = int((hon_chunk.chunksize - 4) / 8)
     num_verts = int(num_verts)
-    vlog('%d texc' % num_verts)
+    vlog('%d texc', num_verts)
     mesh_index = read_int(hon_chunk)  # wireframe index
     if version == 3:
         vlog(read_int(hon_chunk))  # huh?
@@ -109,15 +104,35 @@ def parse_colr(hon_chunk):
 
 def parse_surf(hon_chunk):
     vlog('parsing surf chunk')
-    surf_index = read_int(hon_chunk)  # surface index
-    num_planes = read_int(hon_chunk)  # number of planes
-    num_points = read_int(hon_chunk)  # amount of points
-    num_edges = read_int(hon_chunk)  # number of ribs
-    num_tris = read_int(hon_chunk)  # the number of triangles?
-    # BMINf,BMAXf,FLAGSi
-    hon_chunk.read(4 * 3 + 4 * 3 + 4)
-    return \
-        [struct.unpack("<4f", hon_chunk.read(4 * 4)) for i in range(num_planes)], \
-        [struct.unpack("<3f", hon_chunk.read(4 * 3)) for i in range(num_points)], \
-        [struct.unpack("<6f", hon_chunk.read(4 * 6)) for i in range(num_edges)], \
-        [struct.unpack("<3I", hon_chunk.read(4 * 3)) for i in range(num_tris)]
\ No newline at end of file
+    # planes, points, edges and triangles as arrays, see k2_reader.K2Surf
+    return k2_reader.parse_surf(hon_chunk.read())
+
+
+def read_clip_motions(file, version):
+    motions = {}  # creating a dictionary motions
+
+    while 1:  # execute the loop body as long as the loop condition is true
+        try:  # run the try statement
+            clip_chunk = chunk.Chunk(file, bigendian=0, align=0)  # read the block name
+        except EOFError:  # if during the execution of the try statement we stumbled upon the end of the file, then
+            break  # terminate the cycle ahead of schedule
+        if version == 1:  # if the file version is 1, then
+            name = k2_reader.c_string(clip_chunk.read(32))  # NUL padded name of the bone
+        boneindex = read_int(clip_chunk)  # read the bone index
+        keytype = read_int(clip_chunk)  # read the animation key type
+        numkeys = read_int(clip_chunk)  # read the number of animation keys
+        if version > 1:  # if the file version is greater than 1, then
+            namelength = struct.unpack("B", clip_chunk.read(1))[0]  # read the length of the bone name
+            name = clip_chunk.read(namelength).decode('utf8', 'replace')  # the name of the bone
+            clip_chunk.read(1)  # read 1 byte - value 0
+
+        if name not in motions:  # if the name of the bone is not in the motions dictionary, then
+            motions[name] = {}
+        dlog("%s,boneindex: %d,keytype: %d,numkeys: %d", name, boneindex, keytype, numkeys)
+        if keytype == MKEY_VISIBILITY:  # if the key type is visibility, then
+            data = struct.unpack("%dB" % numkeys, clip_chunk.read(numkeys))  # read Byte
+        else:  # if not, then
+            data = struct.unpack("<%df" % numkeys, clip_chunk.read(numkeys * 4))  # read Float
+        motions[name][keytype] = list(data)  # convert the data string to a list
+        clip_chunk.skip()  # skip the error test
+    return motions
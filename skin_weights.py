@@ -0,0 +1,113 @@
+import numpy as np
+
+
+class SkinWeights:
+    """Per vertex bone influences stored as a CSR table.
+
+    Influences of vertex i are bones[offsets[i]:offsets[i + 1]] with the
+    matching weights, bone indices are indices into the exported skeleton.
+    """
+
+    def __init__(self, offsets, bones, weights):
+        self.offsets = offsets
+        self.bones = bones
+        self.weights = weights
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def counts(self):
+        return np.diff(self.offsets)
+
+    def rows(self):
+        # vertex index of every influence
+        return np.repeat(np.arange(len(self)), self.counts())
+
+    def take(self, order):
+        order = np.asarray(order, dtype=np.int64)
+        counts = self.counts()[order]
+        offsets = np.zeros(len(order) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        index = np.repeat(self.offsets[order] - offsets[:-1], counts) + np.arange(offsets[-1])
+        return SkinWeights(offsets, self.bones[index], self.weights[index])
+
+    def limit(self, max_influences=0, min_weight=0.0):
+        """Drops weak influences and renormalizes the remaining weights.
+
+        The strongest influence of a vertex is always kept.
+
+        :return: limited weights and the number of dropped influences
+        """
+        rows = self.rows()
+        # strongest first within each vertex
+        order = np.lexsort((-self.weights, rows))
+        rows = rows[order]
+        rank = np.arange(len(rows)) - self.offsets[rows]
+        keep = self.weights[order] >= min_weight
+        if max_influences > 0:
+            keep &= rank < max_influences
+        keep |= rank == 0
+        order = order[keep]
+        rows = rows[keep]
+
+        weights = self.weights[order]
+        totals = np.bincount(rows, weights, minlength=len(self))
+        weights = (weights / np.where(totals > 0.0, totals, 1.0)[rows]).astype(np.float32)
+        offsets = np.zeros(len(self) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=len(self)), out=offsets[1:])
+        return SkinWeights(offsets, self.bones[order], weights), len(self.weights) - len(weights)
+
+    def bone_bounds(self, positions, inv_bind):
+        """Bounds of the vertices influenced by every bone, in bone space.
+
+        :param inv_bind: (bones, 4, 4) inverse bind matrices
+        :return: (bones, 6) min xyz, max xyz, +inf/-inf for unused bones
+        """
+        bounds = np.empty((len(inv_bind), 6))
+        bounds[:, :3] = np.inf
+        bounds[:, 3:] = -np.inf
+        if len(self.bones) == 0:
+            return bounds
+        order = np.argsort(self.bones, kind='stable')
+        bones = self.bones[order].astype(np.int64)
+        matrices = inv_bind[bones]
+        points = np.einsum('nij,nj->ni', matrices[:, :3, :3], positions[self.rows()[order]]) + matrices[:, :3, 3]
+        starts = np.flatnonzero(np.r_[True, bones[1:] != bones[:-1]])
+        bounds[bones[starts], :3] = np.minimum.reduceat(points, starts)
+        bounds[bones[starts], 3:] = np.maximum.reduceat(points, starts)
+        return bounds
+
+    def lnk1_payload(self):
+        # per vertex: int count, count float weights, count uint bone indices
+        counts = self.counts()
+        rows = self.rows()
+        starts = self.offsets[:-1] * 2 + np.arange(len(self))
+        rank = np.arange(len(rows)) - self.offsets[rows]
+        words = np.empty(len(self) + 2 * len(self.bones), dtype='<u4')
+        words[starts] = counts
+        words[starts[rows] + 1 + rank] = self.weights.astype('<f4').view('<u4')
+        words[starts[rows] + 1 + counts[rows] + rank] = self.bones
+        return words
+
+
+def skin_weights_from_groups(counts, groups, weights, group_bones):
+    """Builds skin weights from flattened vertex group assignments.
+
+    :param counts: number of vertex group assignments of every vertex
+    :param groups: vertex group index of every assignment
+    :param weights: weight of every assignment
+    :param group_bones: vertex group index -> bone index, groups missing here
+        do not deform and are dropped
+    """
+    counts = np.asarray(counts, dtype=np.int64)
+    groups = np.asarray(groups, dtype=np.int64)
+    weights = np.asarray(weights, dtype=np.float32)
+    lut = np.full(max(list(group_bones) + [int(groups.max(initial=-1))]) + 1, -1, dtype=np.int64)
+    for group, bone in group_bones.items():
+        lut[group] = bone
+    bones = lut[groups]
+    mask = bones >= 0
+    rows = np.repeat(np.arange(len(counts)), counts)[mask]
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=len(counts)), out=offsets[1:])
+    return SkinWeights(offsets, bones[mask].astype(np.uint32), weights[mask])
@@ -0,0 +1,81 @@
+# bpy-free surf (collision hull) generation. The exporter builds the convex
+# hull of each marked object with bmesh and turns its triangles into the
+# planes, feature edges and bounds of a surf chunk here.
+#
+# Planes are (nx, ny, nz, d) with the normal pointing out of the hull and
+# n . p = d for points on the plane. Edges are stored as their two end points.
+
+import numpy as np
+
+from .create_mesh_data import positions_bounding_box
+from .k2_reader import K2Surf
+
+# custom properties marking hull objects and holding their surf flags
+SURF_PROPERTY = 'k2_surf'
+SURF_FLAGS_PROPERTY = 'k2_surf_flags'
+
+
+def triangle_planes(points, tris):
+    """Plane of every triangle, degenerate triangles get a zero normal.
+
+    :return: (tris, 4) planes and a mask of the non degenerate triangles
+    """
+    a = points[tris[:, 0]]
+    normals = np.cross(points[tris[:, 1]] - a, points[tris[:, 2]] - a)
+    length = np.linalg.norm(normals, axis=1)
+    valid = length > 1e-12
+    normals /= np.where(valid, length, 1.0)[:, None]
+    normals[~valid] = 0.0
+    return np.column_stack([normals, np.einsum('ij,ij->i', normals, a)]), valid
+
+
+def merge_planes(planes, tolerance=1e-4):
+    """Merges (nearly) coplanar planes.
+
+    :return: unique planes and the unique plane index of every input plane
+    """
+    keys = np.floor(planes / tolerance + 0.5).astype(np.int64)
+    _, first, inverse = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+    return planes[first], inverse.reshape(-1)
+
+
+def feature_edges(tris, tri_planes):
+    """Edges between triangles on different planes and open edges.
+
+    :return: (edges, 2) vertex indices
+    """
+    corners = np.stack([tris, np.roll(tris, -1, axis=1)], axis=2).reshape(-1, 2)
+    corners.sort(axis=1)
+    edges, inverse, counts = np.unique(corners, axis=0, return_inverse=True, return_counts=True)
+    inverse = inverse.reshape(-1)
+    corner_planes = np.repeat(tri_planes, 3)
+    low = np.full(len(edges), np.iinfo(np.int64).max)
+    high = np.full(len(edges), -1)
+    np.minimum.at(low, inverse, corner_planes)
+    np.maximum.at(high, inverse, corner_planes)
+    return edges[(low != high) | (counts == 1)]
+
+
+def hull_surf(points, tris, index=0, flags=0):
+    """K2Surf of a triangulated convex hull.
+
+    Unused points and degenerate triangles are dropped, triangles facing
+    the inside are flipped, coplanar triangles share one plane and edges
+    inside a plane are left out.
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+    tris = np.array(tris, dtype=np.int64).reshape(-1, 3)
+    planes, valid = triangle_planes(points, tris)
+    if len(tris):
+        # the centroid of a convex hull is inside of every plane
+        inward = planes[:, :3] @ points[np.unique(tris)].mean(axis=0) > planes[:, 3]
+        tris[inward] = tris[inward][:, ::-1]
+        planes[inward] = 0.0 - planes[inward]
+    tris = tris[valid]
+    used, tris = np.unique(tris, return_inverse=True)
+    tris = tris.reshape(-1, 3)
+    points = points[used]
+    planes, tri_planes = merge_planes(planes[valid])
+    edges = feature_edges(tris, tri_planes)
+    return K2Surf(index, positions_bounding_box(points), flags, planes, points,
+                  points[edges].reshape(-1, 6), tris)
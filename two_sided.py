@@ -0,0 +1,100 @@
+# bpy-free handling of two-sided faces. K2 stores them as a second triangle
+# with reversed winding, usually on copies of the vertices with flipped
+# normals. The importer merges such pairs into one face flagged two-sided,
+# the exporter adds the reversed copies back. Both are linear in the number
+# of faces: triangles are matched by hashing their sorted corner triple.
+
+import numpy as np
+
+# boolean face attribute holding the flag in Blender
+TWO_SIDED_ATTRIBUTE = 'k2_two_sided'
+
+
+def position_ids(positions):
+    """Index of the first vertex at the same position, for every vertex."""
+    # + 0.0 turns -0.0 into 0.0 so both hash the same
+    positions = np.ascontiguousarray(np.asarray(positions, dtype=np.float32).reshape(-1, 3) + 0.0)
+    first = {}
+    rows = positions.view(np.dtype((np.void, 12))).ravel().tolist()
+    return np.array([first.setdefault(row, i) for i, row in enumerate(rows)], dtype=np.int64)
+
+
+def face_keys(faces):
+    """Sorted corner triple and winding parity of every triangle."""
+    keys = np.sort(faces, axis=1)
+    # with the lowest corner rotated to the front the winding is odd if the
+    # other two descend
+    first = np.argmin(faces, axis=1)
+    rows = np.arange(len(faces))
+    odd = faces[rows, (first + 1) % 3] > faces[rows, (first + 2) % 3]
+    return keys, odd
+
+
+def facing(positions, normals, faces):
+    # > 0 for triangles wound the way their vertex normals point
+    positions = np.asarray(positions, dtype=np.float64).reshape(-1, 3)
+    corners = positions[faces]
+    face_normals = np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+    vertex_normals = np.asarray(normals, dtype=np.float64).reshape(-1, 3)[faces].sum(axis=1)
+    return np.einsum('ij,ij->i', face_normals, vertex_normals)
+
+
+def find_two_sided(positions, faces, normals=None):
+    """Pairs every triangle with a reversed duplicate on the same positions.
+
+    Of each pair the triangle facing along its vertex normals is kept, the
+    first one without normals.
+
+    :return: mask of the faces to keep and the two-sided flag of every face
+    """
+    faces = np.asarray(faces, dtype=np.int64).reshape(-1, 3)
+    keys, odd = face_keys(position_ids(positions)[faces])
+    score = facing(positions, normals, faces).tolist() if normals is not None and len(faces) else None
+    degenerate = (keys[:, 0] == keys[:, 1]) | (keys[:, 1] == keys[:, 2])
+    keep = np.ones(len(faces), dtype=bool)
+    two_sided = np.zeros(len(faces), dtype=bool)
+    unmatched = ({}, {})  # per winding: corner triple -> face indices
+    for i, (key, winding, skip) in enumerate(zip(map(tuple, keys.tolist()), odd.tolist(), degenerate.tolist())):
+        if skip:
+            continue
+        other = unmatched[not winding].get(key)
+        if other:
+            j = other.pop()
+            if score is not None and score[i] > score[j]:
+                i, j = j, i
+            two_sided[j] = True
+            keep[i] = False
+        else:
+            unmatched[winding].setdefault(key, []).append(i)
+    return keep, two_sided
+
+
+def drop_faces(faces, keep, num_verts):
+    """Removes faces and the vertices only they used.
+
+    :return: remaining faces on the new vertex indices, the old index of
+        every new vertex and the new index of every old vertex (-1 if removed)
+    """
+    faces = np.asarray(faces, dtype=np.int64).reshape(-1, 3)
+    used = np.ones(num_verts, dtype=bool)
+    used[faces[~keep].ravel()] = False
+    used[faces[keep].ravel()] = True
+    order = np.flatnonzero(used)
+    remap = np.full(num_verts, -1, dtype=np.int64)
+    remap[order] = np.arange(len(order))
+    return remap[faces[keep]], order, remap
+
+
+def back_faces(faces, two_sided, num_verts):
+    """Reversed copies of the two-sided faces on copies of their vertices.
+
+    :return: the faces to append and the old index of every appended vertex,
+        the copies are numbered from num_verts on
+    """
+    front = np.asarray(faces, dtype=np.int64).reshape(-1, 3)[two_sided]
+    used = np.zeros(num_verts, dtype=bool)
+    used[front.ravel()] = True
+    order = np.flatnonzero(used)
+    remap = np.full(num_verts, -1, dtype=np.int64)
+    remap[order] = np.arange(num_verts, num_verts + len(order))
+    return remap[front][:, ::-1], order
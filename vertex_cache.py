@@ -0,0 +1,140 @@
+# Post-transform vertex cache optimization of triangle index buffers.
+#
+# Triangles are reordered with Tom Forsyth's "Linear-Speed Vertex Cache
+# Optimisation" greedy scoring, vertices are then renumbered in order of
+# first use so the vertex fetch is sequential as well.
+
+CACHE_SIZE = 32
+CACHE_DECAY_POWER = 1.5
+LAST_TRI_SCORE = 0.75
+VALENCE_BOOST_SCALE = 2.0
+VALENCE_BOOST_POWER = 0.5
+
+# size of the FIFO cache used to measure ACMR
+FIFO_SIZE = 16
+
+
+def vertex_score(cache_pos, remaining):
+    if remaining == 0:
+        # no triangles left, never pick it again
+        return -1.0
+    score = 0.0
+    if cache_pos >= 0:
+        if cache_pos < 3:
+            # the three vertices of the last triangle get a fixed score so
+            # they are not preferred over the rest of the cache
+            score = LAST_TRI_SCORE
+        else:
+            scaler = 1.0 / (CACHE_SIZE - 3)
+            score = (1.0 - (cache_pos - 3) * scaler) ** CACHE_DECAY_POWER
+    # bonus for vertices with few triangles left, gets rid of lone triangles
+    score += VALENCE_BOOST_SCALE * remaining ** -VALENCE_BOOST_POWER
+    return score
+
+
+def optimize_faces(faces, num_verts):
+    num_faces = len(faces)
+    if num_faces == 0:
+        return []
+    vert_tris = [[] for _ in range(num_verts)]
+    for fi, f in enumerate(faces):
+        for v in f:
+            vert_tris[v].append(fi)
+
+    cache_pos = [-1] * num_verts
+    scores = [vertex_score(-1, len(tris)) for tris in vert_tris]
+    tri_scores = [scores[a] + scores[b] + scores[c] for a, b, c in faces]
+    tri_added = [False] * num_faces
+
+    cache = []
+    result = []
+    best = max(range(num_faces), key=tri_scores.__getitem__)
+    next_unadded = 0
+    while best >= 0:
+        tri_added[best] = True
+        f = faces[best]
+        result.append(f)
+        for v in f:
+            vert_tris[v].remove(best)
+            if v in cache:
+                cache.remove(v)
+        cache[0:0] = f
+
+        # update scores of everything that is (or just was) in the cache
+        touched = set()
+        for pos, v in enumerate(cache):
+            if pos >= CACHE_SIZE:
+                cache_pos[v] = -1
+            else:
+                cache_pos[v] = pos
+            scores[v] = vertex_score(cache_pos[v], len(vert_tris[v]))
+            touched.update(vert_tris[v])
+        del cache[CACHE_SIZE:]
+
+        best = -1
+        best_score = -1.0
+        for fi in touched:
+            a, b, c = faces[fi]
+            score = scores[a] + scores[b] + scores[c]
+            tri_scores[fi] = score
+            if score > best_score:
+                best_score = score
+                best = fi
+        if best < 0:
+            # cache ran dry, continue with the next untouched triangle
+            while next_unadded < num_faces and tri_added[next_unadded]:
+                next_unadded += 1
+            if next_unadded < num_faces:
+                best = next_unadded
+    return result
+
+
+def reorder_vertices(faces, num_verts):
+    """Renumbers vertices in order of first use.
+
+    :return: remapped faces and the new order (new index -> old index)
+    """
+    remap = [-1] * num_verts
+    order = []
+    for f in faces:
+        for v in f:
+            if remap[v] < 0:
+                remap[v] = len(order)
+                order.append(v)
+    # keep unreferenced vertices at the end
+    for v in range(num_verts):
+        if remap[v] < 0:
+            remap[v] = len(order)
+            order.append(v)
+    return [[remap[v] for v in f] for f in faces], order
+
+
+def optimize_mesh(faces, num_verts):
+    """Optimizes the triangle and vertex order of one mesh.
+
+    Module level and bpy-free so the exporter can run it in worker processes.
+
+    :return: optimized faces, the new vertex order (new index -> old index)
+        and the ACMR before and after
+    """
+    acmr = calc_acmr(faces)
+    faces, order = reorder_vertices(optimize_faces(faces, num_verts), num_verts)
+    return faces, order, acmr, calc_acmr(faces)
+
+
+def calc_acmr(faces, fifo_size=FIFO_SIZE):
+    """Average cache miss ratio (transformed vertices per triangle)."""
+    if len(faces) == 0:
+        return 0.0
+    cache = set()
+    fifo = []
+    misses = 0
+    for f in faces:
+        for v in f:
+            if v not in cache:
+                misses += 1
+                cache.add(v)
+                fifo.append(v)
+                if len(fifo) > fifo_size:
+                    cache.discard(fifo.pop(0))
+    return misses / len(faces)